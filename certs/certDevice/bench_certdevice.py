@@ -0,0 +1,278 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from cryptography import __version__ as cryptography_version
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+import crypto_utils
+import verify_signature as verify_signature_module
+from ca_material import clear_cache
+from crypto_utils import verify_certificate as verify_handshake_certificate, compute_shared_secret
+from decrypt_key import decrypt_key
+from encrypt_key import encrypt_key
+from generate_device_cert import generate_device_cert
+from revoke_device_cert import revoke_device_cert
+from verify_device_cert import verify_certificate as verify_device_certificate, clear_verified_cache
+from verify_signature import verify_signature
+
+# Benchmark suite for the certDevice entry points.
+#
+# Builds a throwaway CA and a synthetic fleet in a temp directory, then times
+# every entry point both in-process and through the spawn-per-call path that
+# Node uses today. Prints one JSON report (ops/sec and p50/p95/p99 latency in
+# milliseconds) so results can be diffed between releases.
+#
+#   python bench_certdevice.py [--devices N] [--spawn-iterations M] [--output report.json]
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_PASSPHRASE = "bench-passphrase"
+
+def create_throwaway_ca(directory):
+    key = ec.generate_private_key(ec.SECP256R1())
+    subject = x509.Name([
+        x509.NameAttribute(NameOID.COUNTRY_NAME, "VN"),
+        x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "Hanoi"),
+        x509.NameAttribute(NameOID.LOCALITY_NAME, "Giangvo"),
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, "MyIoT"),
+        x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, "IoT"),
+        # Same subject as the real CA so device certificates have the production size
+        x509.NameAttribute(NameOID.COMMON_NAME, "MyCA"),
+    ])
+    now = datetime.utcnow()
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1))
+        .not_valid_after(now + timedelta(days=30))
+        .add_extension(x509.BasicConstraints(ca=True, path_length=0), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+
+    ca_cert_path = os.path.join(directory, "ca-cert.pem")
+    ca_key_path = os.path.join(directory, "ca-key.pem")
+    encrypted_key_path = os.path.join(directory, "ca-key.encrypted.pem")
+    with open(ca_cert_path, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(ca_key_path, "wb") as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        ))
+    encrypt_key(ca_key_path, encrypted_key_path, BENCH_PASSPHRASE)
+    return ca_cert_path, ca_key_path, encrypted_key_path
+
+def create_fleet(count, ca_cert_path, ca_key_path, profile="standard"):
+    # The handshake verifier only accepts the configured certificate lengths, so
+    # keep issuing until the fleet has enough of those
+    fleet = []
+    i = 0
+    while len(fleet) < count:
+        if i > 20 * count + 100:
+            raise RuntimeError(f"Could not issue enough device certificates of lengths {sorted(crypto_utils.ACCEPTED_CERT_LENGTHS)} for the fleet")
+        issued = generate_device_cert(f"bench-{i:06d}", ca_cert_path, ca_key_path, profile)
+        i += 1
+        if len(issued["certificate"]) // 2 not in crypto_utils.ACCEPTED_CERT_LENGTHS:
+            continue
+        private_key = serialization.load_der_private_key(bytes.fromhex(issued["private_key"]), password=None)
+        data = json.dumps({"device_id": issued["device_id"], "temperature": 21.5, "humidity": 60})
+        issued["data"] = data
+        issued["signature"] = private_key.sign(data.encode("utf-8"), ec.ECDSA(hashes.SHA256())).hex()
+        client_numbers = ec.generate_private_key(ec.SECP256R1()).public_key().public_numbers()
+        issued["pub_key_x"] = format(client_numbers.x, "064x")
+        issued["pub_key_y"] = format(client_numbers.y, "064x")
+        fleet.append(issued)
+    return fleet
+
+def percentile(sorted_samples, p):
+    if not sorted_samples:
+        return None
+    index = max(0, min(len(sorted_samples) - 1, int(round(p / 100.0 * len(sorted_samples))) - 1))
+    return sorted_samples[index]
+
+def summarize(samples, failures):
+    samples = sorted(samples)
+    total = sum(samples)
+    return {
+        "iterations": len(samples),
+        "failures": failures,
+        "ops_per_second": round(len(samples) / total, 2) if total > 0 else None,
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3)
+    }
+
+def run_in_process(call, items, succeeded):
+    samples = []
+    failures = 0
+    for item in items:
+        start = time.perf_counter()
+        result = call(item)
+        samples.append(time.perf_counter() - start)
+        if not succeeded(result):
+            failures += 1
+    return summarize(samples, failures)
+
+def run_spawned(argv_for, items, cwd):
+    samples = []
+    failures = 0
+    for item in items:
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable] + argv_for(item), cwd=cwd, capture_output=True, text=True)
+        samples.append(time.perf_counter() - start)
+        if completed.returncode != 0 or '"error"' in completed.stdout:
+            failures += 1
+    return summarize(samples, failures)
+
+def reset_caches():
+    clear_cache()
+    clear_verified_cache()
+    with crypto_utils._verified_lock:
+        crypto_utils._verified.clear()
+    with verify_signature_module._public_keys_lock:
+        verify_signature_module._public_keys.clear()
+
+def compare_profiles(ca_cert_path, ca_key_path, count=200):
+    # Certificate size and cold (uncached) verify time per certificate profile
+    from generate_device_cert import PROFILES
+    report = {}
+    for profile in PROFILES:
+        issued = [generate_device_cert(f"bench-{i:06d}", ca_cert_path, ca_key_path, profile) for i in range(count)]
+        sizes = sorted(len(item["certificate"]) // 2 for item in issued)
+        every_length = frozenset(sizes)
+        reset_caches()
+        handshake = run_in_process(
+            lambda d: verify_handshake_certificate(d["certificate"], ca_cert_path, every_length),
+            issued, lambda r: r["status"] == "success"
+        )
+        full = run_in_process(
+            lambda d: verify_device_certificate(d["certificate"], d["private_key"], ca_cert_path),
+            issued, lambda r: r["status"] == "success"
+        )
+        report[profile] = {
+            "min_bytes": sizes[0],
+            "max_bytes": sizes[-1],
+            "mean_bytes": round(sum(sizes) / len(sizes), 1),
+            "crypto_utils.verify_certificate": handshake,
+            "verify_device_cert.verify_certificate": full
+        }
+    return report
+
+def run_benchmarks(devices=200, spawn_iterations=10):
+    work_dir = tempfile.mkdtemp(prefix="certdevice-bench-")
+    previous_cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        ca_cert_path, ca_key_path, encrypted_key_path = create_throwaway_ca(work_dir)
+        with open(ca_cert_path, "r") as f:
+            ca_cert_pem = f.read()
+        fleet = create_fleet(devices, ca_cert_path, ca_key_path)
+        kdf_items = range(max(3, min(devices, 10)))
+
+        def script(name):
+            return os.path.join(SCRIPT_DIR, name)
+
+        benchmarks = {
+            "generate_device_cert": (
+                lambda d: generate_device_cert(d["device_id"], ca_cert_path, ca_key_path),
+                lambda r: "error" not in r,
+                lambda d: [script("generate_device_cert.py"), d["device_id"], ca_cert_path, ca_key_path],
+                fleet
+            ),
+            "verify_device_cert.verify_certificate": (
+                lambda d: verify_device_certificate(d["certificate"], d["private_key"], ca_cert_path),
+                lambda r: r["status"] == "success",
+                lambda d: [script("verify_device_cert.py"), d["certificate"], d["private_key"], ca_cert_path],
+                fleet
+            ),
+            "crypto_utils.verify_certificate": (
+                lambda d: verify_handshake_certificate(d["certificate"], ca_cert_pem),
+                lambda r: r["status"] == "success",
+                lambda d: [script("crypto_utils.py"), "verify_certificate", d["certificate"], ca_cert_pem],
+                fleet
+            ),
+            "compute_shared_secret": (
+                lambda d: compute_shared_secret(d["pub_key_x"], d["pub_key_y"]),
+                lambda r: r["status"] == "success",
+                lambda d: [script("crypto_utils.py"), "compute_shared_secret", d["pub_key_x"], d["pub_key_y"]],
+                fleet
+            ),
+            "verify_signature": (
+                lambda d: verify_signature(d["data"], d["signature"], d["certificate"]),
+                lambda r: r["status"] == "success",
+                lambda d: [script("verify_signature.py"), d["data"], d["signature"], d["certificate"]],
+                fleet
+            ),
+            "revoke_device_cert": (
+                lambda d: revoke_device_cert(d["device_id"], ca_cert_path, ca_key_path, d["serial"]),
+                lambda r: r["status"] == "success",
+                lambda d: [script("revoke_device_cert.py"), d["device_id"], ca_cert_path, ca_key_path, d["serial"]],
+                fleet
+            ),
+            "decrypt_key": (
+                lambda _: decrypt_key(encrypted_key_path, BENCH_PASSPHRASE),
+                lambda r: "PRIVATE KEY" in r,
+                lambda _: [script("decrypt_key.py"), encrypted_key_path, BENCH_PASSPHRASE],
+                kdf_items
+            ),
+        }
+
+        results = {}
+        for name, (call, succeeded, argv_for, items) in benchmarks.items():
+            reset_caches()
+            in_process = run_in_process(call, items, succeeded)
+            spawned = run_spawned(argv_for, list(items)[:spawn_iterations], work_dir) if spawn_iterations else None
+            results[name] = {"in_process": in_process, "spawn_per_call": spawned}
+
+        return {
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "certificate_profiles": compare_profiles(ca_cert_path, ca_key_path, max(devices, 20)),
+            "python": platform.python_version(),
+            "cryptography": cryptography_version,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "devices": devices,
+            "spawn_iterations": spawn_iterations,
+            "results": results
+        }
+    finally:
+        os.chdir(previous_cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    devices = 200
+    spawn_iterations = 10
+    output = None
+    try:
+        while args:
+            option = args.pop(0)
+            if option == "--devices":
+                devices = int(args.pop(0))
+            elif option == "--spawn-iterations":
+                spawn_iterations = int(args.pop(0))
+            elif option == "--output":
+                output = args.pop(0)
+            else:
+                raise ValueError(f"Unknown option: {option}")
+    except (IndexError, ValueError) as e:
+        print(json.dumps({"error": f"Usage: python bench_certdevice.py [--devices N] [--spawn-iterations M] [--output FILE] ({str(e)})"}))
+        sys.exit(1)
+
+    report = run_benchmarks(devices, spawn_iterations)
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
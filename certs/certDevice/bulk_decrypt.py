@@ -0,0 +1,186 @@
+import json
+import sys
+import time
+from collections import Counter
+
+# Bulk ChaCha20-Poly1305 decryption for archived sensor payloads.
+#
+# Input is a stream of EncryptedSensorData records (a mongoexport of the
+# collection, one JSON object per line) with device_id, nonce, tag and the
+# ciphertext in "encrypted_data" (or "ciphertext"). Only ChaCha20-Poly1305
+# records are decrypted; other encryption_type values (AES-GCM, AES-CCM) are
+# reported as unsupported_encryption, and a record without the field is taken
+# to be ChaCha20-Poly1305. Keys are the devices'
+# shared secrets from a devices export. Every pool process gets the key map
+# once and builds one AEAD object per device the first time it sees it, then
+# decrypts, authenticates and JSON-parses whole chunks of records.
+#
+# Output is JSONL (one result per record, in input order) or columnar batches
+# (one JSON object of equal-length column lists per chunk). A summary with
+# records/sec and failure counts by reason goes to stderr.
+#
+#   python bulk_decrypt.py <records.jsonl|-> <devices.jsonl> [--workers N] [--chunk N] [--columnar]
+
+# Record fields copied into every result
+ECHO_FIELDS = ("_id", "id", "device_id", "timestamp", "received_at")
+SUPPORTED_ENCRYPTION = "ChaCha20-Poly1305"
+
+def load_device_keys(source):
+    # devices export (JSONL or JSON array) -> {device_id: shared_secret hex}
+    text = source.read()
+    devices = json.loads(text) if text.lstrip().startswith("[") else [json.loads(line) for line in text.splitlines() if line.strip()]
+    return {device["device_id"]: device["shared_secret"] for device in devices if device.get("shared_secret")}
+
+class RecordDecryptor:
+    def __init__(self, device_keys):
+        self.device_keys = device_keys
+        self._aead = {}
+        # device_id -> why its shared secret is unusable
+        self._invalid = {}
+
+    def aead_for(self, device_id):
+        # None when the device has no key; ValueError (cached per device) for an unusable one
+        from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+        aead = self._aead.get(device_id)
+        if aead is None:
+            if device_id in self._invalid:
+                raise ValueError(self._invalid[device_id])
+            secret = self.device_keys.get(device_id)
+            if secret is None:
+                return None
+            try:
+                key = bytes.fromhex(secret)
+                if len(key) != 32:
+                    raise ValueError(f"shared secret must be 32 bytes, got {len(key)}")
+                aead = self._aead[device_id] = ChaCha20Poly1305(key)
+            except (ValueError, TypeError) as e:
+                self._invalid[device_id] = f"Invalid shared secret: {str(e)}"
+                raise ValueError(self._invalid[device_id])
+        return aead
+
+    def decrypt(self, record):
+        from cryptography.exceptions import InvalidTag
+
+        result = {field: record[field] for field in ECHO_FIELDS if field in record}
+        encryption_type = record.get("encryption_type") or SUPPORTED_ENCRYPTION
+        if encryption_type != SUPPORTED_ENCRYPTION:
+            return {**result, "status": "error", "reason": "unsupported_encryption", "message": f"Unsupported encryption type: {encryption_type}"}
+        try:
+            aead = self.aead_for(record.get("device_id"))
+        except ValueError as e:
+            return {**result, "status": "error", "reason": "invalid_key", "message": str(e)}
+        if aead is None:
+            return {**result, "status": "error", "reason": "missing_key", "message": "No shared secret for device"}
+        try:
+            nonce = bytes.fromhex(record["nonce"])
+            sealed = bytes.fromhex(record.get("encrypted_data") or record["ciphertext"]) + bytes.fromhex(record["tag"])
+            if len(nonce) != 12:
+                raise ValueError(f"nonce must be 12 bytes, got {len(nonce)}")
+        except (KeyError, ValueError, TypeError) as e:
+            return {**result, "status": "error", "reason": "invalid_record", "message": str(e)}
+
+        try:
+            plaintext = aead.decrypt(nonce, sealed, None)
+        except InvalidTag:
+            return {**result, "status": "error", "reason": "auth_failed", "message": "Authentication tag does not match"}
+        try:
+            return {**result, "status": "success", "decrypted_data": json.loads(plaintext)}
+        except (ValueError, UnicodeDecodeError) as e:
+            return {**result, "status": "error", "reason": "bad_json", "message": str(e), "decrypted_hex": plaintext.hex()}
+
+    def decrypt_chunk(self, records):
+        return [self.decrypt(record) for record in records]
+
+# Per-process decryptor, created once by the pool initializer
+_worker_decryptor = None
+
+def _init_worker(device_keys):
+    global _worker_decryptor
+    _worker_decryptor = RecordDecryptor(device_keys)
+
+def _decrypt_in_worker(records):
+    return _worker_decryptor.decrypt_chunk(records)
+
+def _chunks(records, chunk_size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def decrypt_stream(records, device_keys, workers=None, chunk_size=512):
+    # Yields one list of results per chunk, chunks in input order
+    from multiprocessing import Pool
+    with Pool(workers, initializer=_init_worker, initargs=(device_keys,)) as pool:
+        yield from pool.imap(_decrypt_in_worker, _chunks(records, chunk_size))
+
+def to_columns(results):
+    # One batch as equal-length columns; payload fields become data.<name> columns
+    data_fields = []
+    for result in results:
+        for name in result.get("decrypted_data") or {}:
+            if name not in data_fields:
+                data_fields.append(name)
+
+    columns = {field: [result.get(field) for result in results] for field in ECHO_FIELDS + ("status", "reason")}
+    for name in data_fields:
+        columns[f"data.{name}"] = [(result.get("decrypted_data") or {}).get(name) for result in results]
+    return {"rows": len(results), "columns": {name: values for name, values in columns.items() if any(v is not None for v in values)}}
+
+def run(records, device_keys, out=sys.stdout, workers=None, chunk_size=512, columnar=False):
+    total = 0
+    failures = Counter()
+    start = time.perf_counter()
+    for results in decrypt_stream(records, device_keys, workers, chunk_size):
+        total += len(results)
+        failures.update(result["reason"] for result in results if result["status"] != "success")
+        if columnar:
+            out.write(json.dumps(to_columns(results)) + "\n")
+        else:
+            out.write("".join(json.dumps(result) + "\n" for result in results))
+    elapsed = time.perf_counter() - start
+    failed = sum(failures.values())
+    return {
+        "records": total,
+        "decrypted": total - failed,
+        "failed": failed,
+        "failures": dict(failures),
+        "elapsed_seconds": round(elapsed, 3),
+        "records_per_second": round(total / elapsed, 1) if elapsed > 0 else None
+    }
+
+if __name__ == "__main__":
+    usage = "Usage: python bulk_decrypt.py <records.jsonl|-> <devices.jsonl> [--workers N] [--chunk N] [--columnar]"
+    args = sys.argv[1:]
+    options = {}
+    try:
+        records_path, devices_path = args.pop(0), args.pop(0)
+        while args:
+            option = args.pop(0)
+            if option == "--workers":
+                options["workers"] = int(args.pop(0))
+            elif option == "--chunk":
+                options["chunk_size"] = int(args.pop(0))
+            elif option == "--columnar":
+                options["columnar"] = True
+            else:
+                raise ValueError(f"Unknown option: {option}")
+    except (IndexError, ValueError) as e:
+        print(json.dumps({"error": f"{usage} ({str(e)})"}))
+        sys.exit(1)
+
+    try:
+        with open(devices_path, "r") as f:
+            device_keys = load_device_keys(f)
+        source = sys.stdin if records_path == "-" else open(records_path, "r")
+        with source:
+            records = (json.loads(line) for line in source if line.strip())
+            summary = run(records, device_keys, **options)
+        print(json.dumps(summary), file=sys.stderr)
+        sys.exit(0 if summary["failed"] == 0 else 1)
+    except Exception as e:
+        print(json.dumps({"error": str(e)}))
+        sys.exit(1)
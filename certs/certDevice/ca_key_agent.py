@@ -0,0 +1,157 @@
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from cryptography.hazmat.primitives import serialization
+
+from ca_material import load_ca_cert
+from decrypt_key import decrypt_key_bytes, zeroize
+from generate_device_cert import issue_device_cert
+from revoke_device_cert import revoke_device_certs
+from ca_worker import dispatch, serve_socket
+
+# Unlock-once CA key agent.
+#
+# The encrypted CA key is decrypted (PBKDF2 + AES-CBC) once and the private key
+# object stays in memory; certificate and CRL signing requests are served over a
+# local Unix socket using the ca_worker line-delimited JSON protocol. With a TTL
+# the key is dropped when it expires and the agent stays locked until an
+# 'unlock' request supplies the passphrase again.
+#
+# The passphrase is read from CA_KEY_PASSPHRASE, never from argv, and unlocking
+# runs in the background so the agent starts accepting connections immediately.
+
+class CAKeyAgent:
+    def __init__(self, encrypted_path, ca_cert_path="ca-cert.pem", ttl_seconds=None):
+        self.encrypted_path = encrypted_path
+        self.ca_cert_path = ca_cert_path
+        self.ttl_seconds = ttl_seconds
+        self._key = None
+        self._expires_at = None
+        self._lock = threading.Lock()
+        self._unlocked = threading.Event()
+        self._unlock_pending = False
+        self._timer = None
+
+    def unlock(self, passphrase):
+        self._unlock_pending = True
+        try:
+            pem = decrypt_key_bytes(self.encrypted_path, passphrase)
+            try:
+                key = serialization.load_pem_private_key(pem, password=None)
+            finally:
+                zeroize(pem)
+        finally:
+            self._unlock_pending = False
+
+        with self._lock:
+            self._key = key
+            if self.ttl_seconds:
+                self._expires_at = time.monotonic() + self.ttl_seconds
+                if self._timer is not None:
+                    self._timer.cancel()
+                self._timer = threading.Timer(self.ttl_seconds, self.lock)
+                self._timer.daemon = True
+                self._timer.start()
+            self._unlocked.set()
+
+    def lock(self):
+        # Dropping the last reference frees the OpenSSL key, which clears the private scalar
+        with self._lock:
+            self._key = None
+            self._expires_at = None
+            self._unlocked.clear()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def key(self, wait_seconds=0):
+        # Only wait while an unlock is actually running (e.g. the startup unlock)
+        if wait_seconds and self._unlock_pending:
+            self._unlocked.wait(wait_seconds)
+        with self._lock:
+            if self._key is None:
+                raise RuntimeError("CA key agent is locked")
+            return self._key
+
+    def status(self):
+        with self._lock:
+            return {
+                "unlocked": self._key is not None,
+                "expires_in": round(self._expires_at - time.monotonic(), 1) if self._expires_at else None
+            }
+
+# Requests waiting for the background unlock give up after this many seconds
+UNLOCK_WAIT_SECONDS = 30
+
+def handle_sign_certificate(agent, params):
+    ca_key = agent.key(UNLOCK_WAIT_SECONDS)
+    return issue_device_cert(params["device_id"], load_ca_cert(agent.ca_cert_path), ca_key)
+
+def handle_sign_crl(agent, params):
+    # entries may be empty to just re-sign and publish the CRL
+    ca_key = agent.key(UNLOCK_WAIT_SECONDS)
+    options = {name: params[name] for name in ("rebase_interval_hours", "max_delta_entries", "delta_validity_hours",
+                                               "ca_data_dir", "delta_crl_path") if name in params}
+    return revoke_device_certs(
+        params.get("entries", []),
+        load_ca_cert(agent.ca_cert_path),
+        ca_key,
+        params.get("crl_path", "ca_data/crl.pem"),
+        params.get("delta", False),
+        **options
+    )
+
+def handle_unlock(agent, params):
+    agent.unlock(params["passphrase"])
+    return {"status": "success", **agent.status()}
+
+def handle_lock(agent, params):
+    agent.lock()
+    return {"status": "success", **agent.status()}
+
+def handle_status(agent, params):
+    return {"status": "success", **agent.status()}
+
+def agent_handlers(agent):
+    return {
+        "sign_certificate": partial(handle_sign_certificate, agent),
+        "sign_crl": partial(handle_sign_crl, agent),
+        "unlock": partial(handle_unlock, agent),
+        "lock": partial(handle_lock, agent),
+        "status": partial(handle_status, agent),
+    }
+
+def unlock_in_background(agent, passphrase):
+    def run():
+        try:
+            agent.unlock(passphrase)
+        except Exception as e:
+            print(json.dumps({"status": "error", "message": f"Unlock failed: {str(e)}"}), file=sys.stderr)
+
+    agent._unlock_pending = True
+    thread = threading.Thread(target=run, name="ca-key-unlock", daemon=True)
+    thread.start()
+    return thread
+
+if __name__ == "__main__":
+    # python ca_key_agent.py <encrypted_key> <socket_path> [ca_cert] [ttl_seconds]
+    if len(sys.argv) < 3:
+        print(json.dumps({"error": "Usage: python ca_key_agent.py <encrypted_key> <socket_path> [ca_cert] [ttl_seconds]"}))
+        sys.exit(1)
+
+    encrypted_path, socket_path = sys.argv[1:3]
+    ca_cert_path = sys.argv[3] if len(sys.argv) > 3 else "ca-cert.pem"
+    ttl_seconds = float(sys.argv[4]) if len(sys.argv) > 4 else None
+
+    agent = CAKeyAgent(encrypted_path, ca_cert_path, ttl_seconds)
+    passphrase = os.environ.pop("CA_KEY_PASSPHRASE", None)
+    if passphrase:
+        unlock_in_background(agent, passphrase)
+        del passphrase
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as executor:
+        serve_socket(socket_path, executor, partial(dispatch, handlers=agent_handlers(agent)))
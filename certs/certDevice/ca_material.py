@@ -0,0 +1,75 @@
+import hashlib
+import os
+import threading
+from collections import namedtuple
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
+
+# Parsed CA material shared by the generate/verify/revoke paths.
+# Entries are keyed by absolute path and re-parsed only when the file's
+# mtime or size changes, so a rotated CA is picked up without a restart.
+
+CAMaterial = namedtuple("CAMaterial", [
+    "cert",
+    "public_key",
+    "subject",
+    "key_identifier",
+    "authority_key_identifier",
+    "fingerprint",
+])
+
+_cache = {}
+_lock = threading.Lock()
+
+def _parse_ca_cert(pem_bytes):
+    cert = x509.load_pem_x509_certificate(pem_bytes)
+    public_key = cert.public_key()
+    ski = x509.SubjectKeyIdentifier.from_public_key(public_key)
+    return CAMaterial(
+        cert=cert,
+        public_key=public_key,
+        subject=cert.subject,
+        key_identifier=ski.digest,
+        authority_key_identifier=x509.AuthorityKeyIdentifier.from_issuer_subject_key_identifier(ski),
+        fingerprint=hashlib.sha256(cert.public_bytes(serialization.Encoding.DER)).hexdigest(),
+    )
+
+def _parse_ca_key(pem_bytes):
+    return serialization.load_pem_private_key(pem_bytes, password=None)
+
+def _load(kind, path, parse):
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _lock:
+        entry = _cache.get((kind, path))
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+    with open(path, "rb") as f:
+        value = parse(f.read())
+    with _lock:
+        _cache[(kind, path)] = (stamp, value)
+    return value
+
+def load_ca_cert(ca_cert_path="ca-cert.pem"):
+    return _load("cert", ca_cert_path, _parse_ca_cert)
+
+def load_ca_key(ca_key_path="ca-key.pem"):
+    return _load("key", ca_key_path, _parse_ca_key)
+
+def load_ca_pem(ca_cert_pem):
+    # For callers that receive the CA as a PEM string; keyed by content hash
+    if isinstance(ca_cert_pem, str):
+        ca_cert_pem = ca_cert_pem.encode("ascii")
+    digest = hashlib.sha256(ca_cert_pem).hexdigest()
+    with _lock:
+        entry = _cache.get(("pem", digest))
+    if entry is None:
+        entry = (None, _parse_ca_cert(ca_cert_pem))
+        with _lock:
+            _cache[("pem", digest)] = entry
+    return entry[1]
+
+def clear_cache():
+    with _lock:
+        _cache.clear()
@@ -0,0 +1,275 @@
+import json
+import os
+import sys
+import socketserver
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ca_material import load_ca_cert, load_ca_key, clear_cache
+from generate_device_cert import issue_device_cert
+from verify_device_cert import verify_certificate, clear_verified_cache
+from revoke_device_cert import revoke_with_ca, issuing_ca
+from revocation_store import DEFAULT_DB_PATH, open_store, is_revoked
+from verify_signature import verify_signature, verify_signatures
+from decrypt_key import decrypt_key
+from crypto_utils import compute_shared_secret
+from ecdh_key_pool import EphemeralKeyPool
+from identity_inventory import IdentityInventory
+from session_tickets import full_handshake, resume_session
+from wire_format import encode_frame, read_frames
+
+# Persistent CA worker: one interpreter serves many cert operations.
+#
+# Protocol: one JSON object per line.
+#   request:  {"id": "42", "type": "generate", "params": {"device_id": "esp32-01"}}
+#   response: {"id": "42", "type": "generate", "result": {...}}
+# Responses may come back out of order; callers match them by "id".
+#
+# With --binary the same objects travel as length-prefixed CBOR frames, with
+# certificates, keys, signatures and CRLs as raw bytes instead of hex.
+
+DEFAULT_CA_CERT = "ca-cert.pem"
+DEFAULT_CA_KEY = "ca-key.pem"
+
+# Set from --ecdh-pool at startup; None disables the pool
+key_pool = None
+# Set from --inventory at startup (passphrase from CERT_INVENTORY_PASSPHRASE)
+inventory = None
+
+def handle_generate(params):
+    ca = load_ca_cert(params.get("ca_cert_path", DEFAULT_CA_CERT))
+    ca_key = load_ca_key(params.get("ca_key_path", DEFAULT_CA_KEY))
+    return issue_device_cert(params["device_id"], ca, ca_key, profile=params.get("profile", "standard"))
+
+def handle_verify(params):
+    # Root-issued or shard-issued (issuer resolved by AKI); the CA certificate is cached either way
+    return verify_certificate(params["certificate"], params["private_key"], params.get("ca_cert_path", DEFAULT_CA_CERT))
+
+def handle_revoke(params):
+    # Revoked by the CA that signed the certificate (root or shard, by AKI), into that CA's store and CRL
+    root = load_ca_cert(params.get("ca_cert_path", DEFAULT_CA_CERT))
+    shard, ca, ca_key, ca_data_dir = issuing_ca(params.get("certificate"), params["serial"], root,
+                                                params.get("ca_key_path", DEFAULT_CA_KEY))
+    crl_path = os.path.join(ca_data_dir, "crl.pem") if shard is not None else params.get("crl_path", "ca_data/crl.pem")
+    return revoke_with_ca(params["device_id"], ca, ca_key, params["serial"], crl_path, ca_data_dir, shard)
+
+def handle_is_revoked(params):
+    store = open_store(params.get("db_path", DEFAULT_DB_PATH), params.get("index_file", "ca_data/index.txt"))
+    return {"status": "success", "revoked": is_revoked(store, params["serials"])}
+
+def handle_verify_signature(params):
+    return verify_signature(params["data"], params["signature"], params["certificate"])
+
+def handle_verify_signatures(params):
+    items = [(item["data"], item["signature"], item["certificate"]) for item in params["items"]]
+    return {"status": "success", "results": verify_signatures(items)}
+
+def handle_compute_shared_secret(params):
+    return compute_shared_secret(params["pub_key_x"], params["pub_key_y"], key_pool)
+
+def handle_handshake(params):
+    # Certificate check + ECDH, returning a resumption ticket with the shared secret
+    return full_handshake(params["certificate"], params.get("ca_cert_path", DEFAULT_CA_CERT),
+                          params["pub_key_x"], params["pub_key_y"], key_pool, params.get("lifetime"))
+
+def handle_resume_session(params):
+    # The revocation store comes from the sealed ticket, never from the request
+    return resume_session(params["ticket"], params["certificate"], params["client_nonce"])
+
+def handle_key_pool_stats(params):
+    if key_pool is None:
+        return {"status": "error", "message": "ECDH key pool is disabled"}
+    return {"status": "success", **key_pool.stats()}
+
+def handle_bind_identity(params):
+    # Onboarding from the pre-issued inventory; plain issuance when it is disabled
+    if inventory is None:
+        return handle_generate(params)
+    return inventory.bind(params["device_id"])
+
+def handle_inventory_stats(params):
+    if inventory is None:
+        return {"status": "error", "message": "Identity inventory is disabled"}
+    return {"status": "success", **inventory.stats()}
+
+def handle_decrypt_key(params):
+    pem = decrypt_key(params["encrypted_path"], params["passphrase"])
+    return {"status": "success", "private_key": pem}
+
+def handle_reload(params):
+    clear_cache()
+    clear_verified_cache()
+    return {"status": "success", "message": "CA and verification caches cleared"}
+
+HANDLERS = {
+    "generate": handle_generate,
+    "verify": handle_verify,
+    "revoke": handle_revoke,
+    "is_revoked": handle_is_revoked,
+    "verify_signature": handle_verify_signature,
+    "verify_signatures": handle_verify_signatures,
+    "compute_shared_secret": handle_compute_shared_secret,
+    "handshake": handle_handshake,
+    "resume_session": handle_resume_session,
+    "key_pool_stats": handle_key_pool_stats,
+    "bind_identity": handle_bind_identity,
+    "inventory_stats": handle_inventory_stats,
+    "decrypt_key": handle_decrypt_key,
+    "reload": handle_reload,
+}
+
+def dispatch(request, handlers=HANDLERS):
+    request_id = request.get("id")
+    request_type = request.get("type")
+    handler = handlers.get(request_type)
+    if handler is None:
+        return {"id": request_id, "type": request_type, "error": f"Unknown request type: {request_type}"}
+    try:
+        return {"id": request_id, "type": request_type, "result": handler(request.get("params") or {})}
+    except KeyError as e:
+        return {"id": request_id, "type": request_type, "error": f"Missing parameter: {e.args[0]}"}
+    except Exception as e:
+        return {"id": request_id, "type": request_type, "error": str(e)}
+
+def answer(request, respond, dispatch=dispatch):
+    # Runs in the executor: every request gets exactly one reply, whatever goes wrong
+    try:
+        if not isinstance(request, dict):
+            response = {"id": None, "status": "error", "error": "Request must be a JSON object"}
+        else:
+            try:
+                response = dispatch(request)
+            except Exception as e:
+                response = {"id": request.get("id"), "type": request.get("type"), "status": "error", "error": str(e)}
+        respond(response)
+    except Exception as e:
+        # Unencodable response or a closed connection; nothing more can be sent
+        print(json.dumps({"error": f"Could not answer request: {str(e)}"}), file=sys.stderr)
+
+def serve_lines(lines, write, executor, dispatch=dispatch):
+    write_lock = threading.Lock()
+
+    def respond(response):
+        line = json.dumps(response) + "\n"
+        with write_lock:
+            write(line)
+
+    futures = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as e:
+            respond({"id": None, "error": f"Invalid JSON: {str(e)}"})
+            continue
+        futures.append(executor.submit(answer, request, respond, dispatch))
+        futures = [f for f in futures if not f.done()]
+
+    for future in futures:
+        future.result()
+
+def serve_frames(stream, write, executor, dispatch=dispatch):
+    # Binary mode: length-prefixed CBOR frames in both directions (see wire_format)
+    write_lock = threading.Lock()
+
+    def respond(response):
+        frame = encode_frame(response)
+        with write_lock:
+            write(frame)
+
+    def reject(message):
+        # Payload did not decode; the next frame is still readable
+        respond({"id": None, "status": "error", "error": f"Invalid frame: {message}"})
+
+    futures = []
+    try:
+        for request in read_frames(stream, reject):
+            futures.append(executor.submit(answer, request, respond, dispatch))
+            futures = [f for f in futures if not f.done()]
+    except ValueError as e:
+        # A bad length prefix or a truncated frame leaves the stream out of sync, so stop reading
+        respond({"id": None, "status": "error", "error": f"Invalid frame: {str(e)}"})
+
+    for future in futures:
+        future.result()
+
+def serve_stdio(executor, binary=False):
+    if binary:
+        def write_frame(frame):
+            sys.stdout.buffer.write(frame)
+            sys.stdout.buffer.flush()
+
+        serve_frames(sys.stdin.buffer, write_frame, executor)
+        return
+
+    def write(line):
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+    serve_lines(sys.stdin, write, executor)
+
+def serve_socket(socket_path, executor, dispatch=dispatch, binary=False):
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            if binary:
+                def write_frame(frame):
+                    self.wfile.write(frame)
+                    self.wfile.flush()
+
+                serve_frames(self.rfile, write_frame, executor, dispatch)
+                return
+
+            def write(line):
+                self.wfile.write(line.encode("utf-8"))
+                self.wfile.flush()
+
+            serve_lines((line.decode("utf-8") for line in self.rfile), write, executor, dispatch)
+
+    with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as server:
+        os.chmod(socket_path, 0o600)
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(socket_path)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    socket_path = None
+    workers = os.cpu_count() or 4
+    pool_depth = 0
+    binary = False
+    inventory_path = None
+    try:
+        while args:
+            option = args.pop(0)
+            if option == "--socket":
+                socket_path = args.pop(0)
+            elif option == "--workers":
+                workers = int(args.pop(0))
+            elif option == "--ecdh-pool":
+                pool_depth = int(args.pop(0))
+            elif option == "--binary":
+                binary = True
+            elif option == "--inventory":
+                inventory_path = args.pop(0)
+            else:
+                raise ValueError(f"Unknown option: {option}")
+    except (IndexError, ValueError) as e:
+        print(json.dumps({"error": f"Usage: python ca_worker.py [--socket PATH] [--workers N] [--ecdh-pool DEPTH] [--binary] [--inventory DB] ({str(e)})"}))
+        sys.exit(1)
+
+    if pool_depth > 0:
+        key_pool = EphemeralKeyPool(pool_depth).start()
+    if inventory_path:
+        inventory = IdentityInventory(inventory_path, ca_cert_path=DEFAULT_CA_CERT, ca_key_path=DEFAULT_CA_KEY).start()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if socket_path:
+            serve_socket(socket_path, executor, binary=binary)
+        else:
+            serve_stdio(executor, binary)
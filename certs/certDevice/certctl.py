@@ -0,0 +1,137 @@
+import sys
+import json
+import importlib
+
+# Single entry point for the certDevice scripts.
+#
+#   python certctl.py <command> [args...]
+#   python certctl.py profile [runs]
+#
+# Nothing from cryptography is imported here. Each command names the module
+# and function that implement it; the module is imported only when that
+# command runs, so e.g. 'ecdh' never pays for x509 or multiprocessing.
+
+COMMANDS = {
+    # command: (module, function, argument names)
+    "verify": ("crypto_utils", "verify_certificate", ["cert_hex", "ca_cert"]),
+    "ecdh": ("crypto_utils", "compute_shared_secret", ["pub_key_x", "pub_key_y"]),
+    "generate": ("generate_device_cert", "generate_device_cert", ["device_id", "ca_cert_path", "ca_key_path"]),
+    "verify-device": ("verify_device_cert", "verify_certificate", ["cert_hex", "private_key_hex", "ca_cert_path"]),
+    "verify-signature": ("verify_signature", "verify_signature", ["data", "signature_hex", "cert_hex"]),
+    "revoke": ("revoke_device_cert", "revoke_device_cert", ["device_id", "ca_cert_path", "ca_key_path", "serial"]),
+    "decrypt-key": ("decrypt_key", "decrypt_key", ["encrypted_key", "passphrase"]),
+}
+
+def usage():
+    lines = ["Usage: python certctl.py <command> [args...]"]
+    for name, (_, _, arg_names) in COMMANDS.items():
+        lines.append(f"  {name} " + " ".join(f"<{arg}>" for arg in arg_names))
+    lines.append("  profile [runs]")
+    return "\n".join(lines)
+
+def run_command(name, args):
+    module_name, function_name, arg_names = COMMANDS[name]
+    if len(args) != len(arg_names):
+        return {"status": "error", "message": f"{name} expects {len(arg_names)} arguments: {', '.join(arg_names)}"}
+    function = getattr(importlib.import_module(module_name), function_name)
+    return function(*args)
+
+def is_failure(result):
+    return isinstance(result, dict) and (result.get("status") == "error" or "error" in result)
+
+def parse_import_times(stderr):
+    # Top-level modules from 'python -X importtime', heaviest cumulative time first
+    imports = []
+    for line in stderr.splitlines():
+        parts = line[len("import time:"):].split("|")
+        if not line.startswith("import time:") or len(parts) != 3:
+            continue
+        cumulative_us, name = parts[1].strip(), parts[2][1:]
+        # Skip the header line and nested imports (indented names)
+        if not cumulative_us.isdigit() or name.startswith(" "):
+            continue
+        imports.append({"module": name, "cumulative_ms": round(int(cumulative_us) / 1000, 2)})
+    return sorted(imports, key=lambda item: item["cumulative_ms"], reverse=True)
+
+# The module-level imports crypto_utils.py had before they were made lazy; the
+# profile replays them in front of the script to measure the old cold start
+EAGER_IMPORTS = (
+    "from cryptography import x509; "
+    "from cryptography.hazmat.primitives import hashes, serialization; "
+    "from cryptography.hazmat.primitives.asymmetric import ec; "
+    "from cryptography.hazmat.primitives.ciphers import Cipher, algorithms; "
+    "from cryptography.hazmat.backends import default_backend; "
+    "import base64, multiprocessing, runpy; "
+    "runpy.run_path({script!r}, run_name='__main__')"
+)
+
+def profile(runs=10):
+    # Cold-start comparison for the hottest spawned calls: eager imports vs. the script vs. certctl
+    import os
+    import statistics
+    import subprocess
+    import tempfile
+    import time
+    from bench_certdevice import create_throwaway_ca, create_fleet
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory(prefix="certctl-profile-") as work_dir:
+        ca_cert_path, ca_key_path, _ = create_throwaway_ca(work_dir)
+        device = create_fleet(1, ca_cert_path, ca_key_path)[0]
+        crypto_utils_path = os.path.join(script_dir, "crypto_utils.py")
+        eager = ["-c", EAGER_IMPORTS.format(script=crypto_utils_path)]
+        certctl = [os.path.join(script_dir, "certctl.py")]
+        cases = {
+            "verify": (
+                ["verify_certificate", device["certificate"], ca_cert_path],
+                ["verify", device["certificate"], ca_cert_path]
+            ),
+            "ecdh": (
+                ["compute_shared_secret", device["pub_key_x"], device["pub_key_y"]],
+                ["ecdh", device["pub_key_x"], device["pub_key_y"]]
+            ),
+        }
+
+        def cold_start(argv):
+            samples = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                subprocess.run([sys.executable] + argv, cwd=work_dir, capture_output=True)
+                samples.append(time.perf_counter() - start)
+            return round(statistics.median(samples) * 1000, 2)
+
+        report = {"runs": runs, "commands": {}}
+        for name, (script_args, certctl_args) in cases.items():
+            traced = subprocess.run([sys.executable, "-X", "importtime"] + certctl + certctl_args, cwd=work_dir, capture_output=True, text=True)
+            eager_ms = cold_start(eager + script_args)
+            script_ms = cold_start([crypto_utils_path] + script_args)
+            certctl_ms = cold_start(certctl + certctl_args)
+            report["commands"][name] = {
+                "eager_imports_median_ms": eager_ms,
+                "crypto_utils_median_ms": script_ms,
+                "certctl_median_ms": certctl_ms,
+                "reduction_percent": round(100 * (eager_ms - certctl_ms) / eager_ms, 1) if eager_ms else None,
+                "heaviest_imports": parse_import_times(traced.stderr)[:8]
+            }
+        return report
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
+        print(usage())
+        sys.exit(0 if len(sys.argv) >= 2 else 1)
+
+    command, args = sys.argv[1], sys.argv[2:]
+    try:
+        if command == "profile":
+            print(json.dumps(profile(int(args[0]) if args else 10), indent=2))
+            sys.exit(0)
+        if command not in COMMANDS:
+            print(json.dumps({"status": "error", "message": f"Unknown command: {command}"}))
+            sys.exit(1)
+
+        result = run_command(command, args)
+        print(result if isinstance(result, str) else json.dumps(result))
+        sys.exit(1 if is_failure(result) else 0)
+    except Exception as e:
+        print(json.dumps({"status": "error", "message": f"Script error: {str(e)}"}))
+        sys.exit(1)
@@ -1,59 +1,219 @@
+import os
 import sys
+import re
 import json
-import base64
+import hashlib
 import binascii
-from cryptography import x509
-from cryptography.hazmat.primitives import serialization, hashes
+import threading
+from collections import OrderedDict
+from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms
 from cryptography.hazmat.backends import default_backend
 from cryptography.exceptions import InvalidSignature
 from datetime import datetime
 
-def verify_certificate(cert_hex, ca_cert_pem):
+from timing import operation, stage
+
+# x509, ciphers/AEAD and multiprocessing are imported inside the functions that need them:
+# these scripts are spawned per call, and compute_shared_secret needs none of them.
+
+NON_HEX = re.compile('[^0-9a-fA-F]')
+
+def parse_cert_lengths(spec):
+    # "520,390-405" -> {520, 390, ..., 405}
+    lengths = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        low, _, high = part.partition("-")
+        lengths.update(range(int(low), int(high or low) + 1))
+    return frozenset(lengths)
+
+# DER sizes of the certificate profiles in use. The standard profile is 520 bytes
+# (give or take the ECDSA signature length); compact certificates depend on the
+# device ID length, so deployments that issue them list their sizes in
+# CERT_ACCEPTED_LENGTHS, e.g. "520,395-405".
+ACCEPTED_CERT_LENGTHS = parse_cert_lengths(os.environ.get("CERT_ACCEPTED_LENGTHS", "520"))
+
+# Handshake LRU: (SHA-256 of cert DER, root CA fingerprint) -> verified certificate facts.
+# Only successful verifications are cached; the validity window is re-checked on every hit.
+# Certificates from the sharded issuing CAs (issuing_shards.py) are checked against the
+# intermediate their AKI names, which is itself checked against the root once.
+VERIFIED_CACHE_SIZE = 65536
+_verified = OrderedDict()
+_verified_lock = threading.Lock()
+
+def _load_ca(ca_cert_pem):
+    # Accept either the CA PEM text or a path to it; both are parsed once and cached
+    from ca_material import load_ca_cert, load_ca_pem
+    if ca_cert_pem.lstrip().startswith("-----BEGIN"):
+        return load_ca_pem(ca_cert_pem)
+    return load_ca_cert(ca_cert_pem)
+
+def _validity_result(entry, now):
+    if now < entry["not_valid_before"] or now > entry["not_valid_after"]:
+        return {"status": "error", "message": "Certificate is not valid at current time"}
+    result = {
+        "status": "success",
+        "subject": entry["subject"],
+        "issuer": entry["issuer"],
+        "valid_from": entry["not_valid_before"].isoformat(),
+        "valid_to": entry["not_valid_after"].isoformat()
+    }
+    if entry.get("shard") is not None:
+        result["shard"] = entry["shard"]
+    return result
+
+@operation("verify_certificate")
+def verify_certificate(cert_hex, ca_cert_pem, accepted_lengths=None):
     try:
-        clean_cert = ''.join(filter(lambda x: x in '0123456789abcdefABCDEF', cert_hex))
-        if len(clean_cert) != 1040:
-            return {"status": "error", "message": f"Certificate length incorrect: expected 1040, got {len(clean_cert)}"}
+        accepted_lengths = accepted_lengths or ACCEPTED_CERT_LENGTHS
+        clean_cert = NON_HEX.sub('', cert_hex)
+        if len(clean_cert) % 2 or len(clean_cert) // 2 not in accepted_lengths:
+            return {"status": "error", "message": f"Certificate length incorrect: expected one of {sorted(accepted_lengths)} bytes, got {len(clean_cert) / 2:g}"}
 
         cert_bytes = binascii.unhexlify(clean_cert)
-        if len(cert_bytes) != 520:
-            return {"status": "error", "message": f"Certificate bytes length incorrect: expected 520, got {len(cert_bytes)}"}
-
-        cert_pem = f"-----BEGIN CERTIFICATE-----\n{base64.b64encode(cert_bytes).decode('ascii')}\n-----END CERTIFICATE-----"
-        cert = x509.load_pem_x509_certificate(cert_pem.encode('ascii'), default_backend())
-        ca_cert = x509.load_pem_x509_certificate(ca_cert_pem.encode('ascii'), default_backend())
-
-        ca_public_key = ca_cert.public_key()
-        if isinstance(ca_public_key, ec.EllipticCurvePublicKey):
-            ca_public_key.verify(
-                cert.signature,
-                cert.tbs_certificate_bytes,
-                ec.ECDSA(hashes.SHA256())
-            )
-        else:
-            return {"status": "error", "message": "Unsupported CA public key type"}
-
-        if cert.issuer != ca_cert.subject:
-            return {"status": "error", "message": "Certificate issuer does not match CA subject"}
 
+        with stage("ca_load"):
+            ca = _load_ca(ca_cert_pem)
         now = datetime.utcnow()
-        if now < cert.not_valid_before or now > cert.not_valid_after:
-            return {"status": "error", "message": "Certificate is not valid at current time"}
+        cache_key = (hashlib.sha256(cert_bytes).digest(), ca.fingerprint)
+        with _verified_lock:
+            entry = _verified.get(cache_key)
+            if entry is not None:
+                _verified.move_to_end(cache_key)
+        if entry is not None:
+            return _validity_result(entry, now)
 
-        return {
-            "status": "success",
+        with stage("parse"):
+            from cryptography import x509
+            cert = x509.load_der_x509_certificate(cert_bytes)
+
+        # The root, or the issuing shard CA named by the AKI (chained to the root once per process)
+        with stage("issuer"):
+            if cert.issuer == ca.subject:
+                shard, issuer = None, ca
+            else:
+                from issuing_shards import issuer_for
+                try:
+                    shard, issuer = issuer_for(cert, ca)
+                except ValueError as e:
+                    return {"status": "error", "message": str(e)}
+
+        issuer_public_key = issuer.public_key
+        if isinstance(issuer_public_key, ec.EllipticCurvePublicKey):
+            with stage("signature"):
+                issuer_public_key.verify(
+                    cert.signature,
+                    cert.tbs_certificate_bytes,
+                    ec.ECDSA(hashes.SHA256())
+                )
+        else:
+            return {"status": "error", "message": "Unsupported CA public key type"}
+
+        # A cached result must not outlive the intermediate that signed the certificate
+        entry = {
             "subject": cert.subject.rfc4514_string(),
             "issuer": cert.issuer.rfc4514_string(),
-            "valid_from": cert.not_valid_before.isoformat(),
-            "valid_to": cert.not_valid_after.isoformat()
+            "not_valid_before": max(cert.not_valid_before, issuer.cert.not_valid_before),
+            "not_valid_after": min(cert.not_valid_after, issuer.cert.not_valid_after),
+            "shard": shard
         }
+        with _verified_lock:
+            _verified[cache_key] = entry
+            if len(_verified) > VERIFIED_CACHE_SIZE:
+                _verified.popitem(last=False)
+
+        return _validity_result(entry, now)
     except InvalidSignature:
         return {"status": "error", "message": "Certificate verification failed: invalid signature"}
     except Exception as e:
         return {"status": "error", "message": f"Error verifying certificate: {str(e)}"}
 
-def compute_shared_secret(pub_key_x, pub_key_y):
+_stream_ca = None
+
+def _init_stream_worker(ca_cert_pem):
+    global _stream_ca
+    _stream_ca = ca_cert_pem
+    _load_ca(ca_cert_pem)
+
+def _verify_in_worker(cert_hex):
+    return verify_certificate(cert_hex, _stream_ca)
+
+def verify_certificate_stream(records, ca_cert_pem, workers=None, chunk_size=1024):
+    # records: iterable of dicts with "certificate" (hex); other keys such as "id" or
+    # "device_id" are echoed back. Yields one result per record, in input order.
+    # Certificates already verified in this process are answered from the LRU without
+    # touching the pool; only misses are spread over the worker processes.
+    from multiprocessing import Pool
+    with Pool(workers, initializer=_init_stream_worker, initargs=(ca_cert_pem,)) as pool:
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                yield from _verify_chunk(chunk, ca_cert_pem, pool)
+                chunk = []
+        if chunk:
+            yield from _verify_chunk(chunk, ca_cert_pem, pool)
+
+def _verify_chunk(chunk, ca_cert_pem, pool):
+    results = [None] * len(chunk)
+    misses = []
+    for i, record in enumerate(chunk):
+        result = _cached_result(record.get("certificate") or "", ca_cert_pem)
+        if result is None:
+            misses.append(i)
+        else:
+            results[i] = result
+
+    if misses:
+        verified = pool.map(_verify_in_worker, [chunk[i].get("certificate") or "" for i in misses], chunksize=32)
+        for i, result in zip(misses, verified):
+            results[i] = result
+            if result["status"] == "success":
+                _remember(chunk[i]["certificate"], ca_cert_pem, result)
+
+    for record, result in zip(chunk, results):
+        for key in ("id", "device_id"):
+            if key in record:
+                result[key] = record[key]
+        yield result
+
+def _cache_key(cert_hex, ca_cert_pem):
+    cert_bytes = binascii.unhexlify(NON_HEX.sub('', cert_hex))
+    return (hashlib.sha256(cert_bytes).digest(), _load_ca(ca_cert_pem).fingerprint)
+
+def _cached_result(cert_hex, ca_cert_pem):
+    try:
+        key = _cache_key(cert_hex, ca_cert_pem)
+    except (binascii.Error, ValueError):
+        return None
+    with _verified_lock:
+        entry = _verified.get(key)
+        if entry is not None:
+            _verified.move_to_end(key)
+    if entry is None:
+        return None
+    return _validity_result(entry, datetime.utcnow())
+
+def _remember(cert_hex, ca_cert_pem, result):
+    # Copy a worker's successful verification into the parent's LRU
+    entry = {
+        "subject": result["subject"],
+        "issuer": result["issuer"],
+        "not_valid_before": datetime.fromisoformat(result["valid_from"]),
+        "not_valid_after": datetime.fromisoformat(result["valid_to"]),
+        "shard": result.get("shard")
+    }
+    with _verified_lock:
+        _verified[_cache_key(cert_hex, ca_cert_pem)] = entry
+        if len(_verified) > VERIFIED_CACHE_SIZE:
+            _verified.popitem(last=False)
+
+@operation("compute_shared_secret")
+def compute_shared_secret(pub_key_x, pub_key_y, key_pool=None):
+    # key_pool: optional ecdh_key_pool.EphemeralKeyPool supplying pre-generated server keys
     try:
         if not pub_key_x or not pub_key_y:
             return {"status": "error", "message": "Public key coordinates cannot be empty"}
@@ -68,7 +228,11 @@ def compute_shared_secret(pub_key_x, pub_key_y):
         except ValueError:
             return {"status": "error", "message": f"Invalid hex values: X={pub_key_x[:10]}..., Y={pub_key_y[:10]}..."}
 
-        private_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        with stage("keygen"):
+            if key_pool is not None:
+                private_key = key_pool.take()
+            else:
+                private_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
         server_pub_key = private_key.public_key()
         server_pub_numbers = server_pub_key.public_numbers()
         server_pub_x = format(server_pub_numbers.x, '064x')
@@ -84,7 +248,8 @@ def compute_shared_secret(pub_key_x, pub_key_y):
         except ValueError as e:
             return {"status": "error", "message": f"Failed to create public key: {str(e)}"}
 
-        shared_secret = private_key.exchange(ec.ECDH(), client_pub_key)
+        with stage("exchange"):
+            shared_secret = private_key.exchange(ec.ECDH(), client_pub_key)
         return {
             "status": "success",
             "shared_secret": shared_secret.hex(),
@@ -94,7 +259,8 @@ def compute_shared_secret(pub_key_x, pub_key_y):
     except Exception as e:
         return {"status": "error", "message": f"Error computing shared secret: {str(e)}"}
 
-# def decrypt_data(ciphertext, tag, nonce, shared_secret):
+@operation("decrypt_data")
+def decrypt_data(ciphertext, tag, nonce, shared_secret):
     try:
         # Validate input types and formats
         if not isinstance(ciphertext, str) or not ciphertext or not all(c in '0123456789abcdefABCDEF' for c in ciphertext):
@@ -119,21 +285,19 @@ def compute_shared_secret(pub_key_x, pub_key_y):
         if len(key) != 32:
             return {"status": "error", "message": f"Invalid shared secret: must be 32 bytes, got {len(key)}"}
 
-        # Pad nonce to 16 bytes (128 bits) to satisfy cryptography's ChaCha20 requirement
-        if len(nonce_bytes) == 12:
-            # Pad with 4 zero bytes at the end (common for ChaCha20 compatibility)
-            nonce_bytes = nonce_bytes + b'\x00\x00\x00\x00'
-        elif len(nonce_bytes) != 16:
-            return {"status": "error", "message": f"Invalid nonce length after decoding: must be 12 or 16 bytes, got {len(nonce_bytes)}"}
+        if len(nonce_bytes) != 12:
+            return {"status": "error", "message": f"Invalid nonce length after decoding: must be 12 bytes, got {len(nonce_bytes)}"}
 
-        # Decrypt using ChaCha20-Poly1305
+        # Decrypt and authenticate with ChaCha20-Poly1305 (RFC 8439), no AAD, as Node.js does
         try:
-            cipher = Cipher(algorithms.ChaCha20(key, nonce_bytes), mode=None, backend=default_backend())
-            decryptor = cipher.decryptor()
-            # Combine ciphertext and tag for decryption, as Node.js does
-            decrypted = decryptor.update(ciphertext_bytes + tag_bytes)
+            from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+            from cryptography.exceptions import InvalidTag
+            with stage("decrypt"):
+                decrypted = ChaCha20Poly1305(key).decrypt(nonce_bytes, ciphertext_bytes + tag_bytes, None)
+        except InvalidTag:
+            return {"status": "error", "message": "ChaCha20-Poly1305 authentication failed: tag does not match"}
         except Exception as e:
-            return {"status": "error", "message": f"ChaCha20 decryption error: {str(e)}"}
+            return {"status": "error", "message": f"ChaCha20-Poly1305 decryption error: {str(e)}"}
 
         # Attempt to decode and parse as JSON
         try:
@@ -161,10 +325,18 @@ if __name__ == "__main__":
         elif action == "compute_shared_secret" and len(sys.argv) >= 4:
             pub_key_x, pub_key_y = sys.argv[2:4]
             result = compute_shared_secret(pub_key_x, pub_key_y)
-        # elif action == "decrypt_data" and len(sys.argv) >= 6:
-        #     # Use only the first set of arguments to handle duplicates
-        #     ciphertext, tag, nonce, shared_secret = sys.argv[2:6]
-        #     result = decrypt_data(ciphertext, tag, nonce, shared_secret)
+        elif action == "verify_certificate_stream" and len(sys.argv) >= 3:
+            # JSONL handshake records on stdin -> JSONL results on stdout, same order
+            ca_cert_pem = sys.argv[2]
+            workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+            records = (json.loads(line) for line in sys.stdin if line.strip())
+            for result in verify_certificate_stream(records, ca_cert_pem, workers):
+                sys.stdout.write(json.dumps(result) + "\n")
+            sys.exit(0)
+        elif action == "decrypt_data" and len(sys.argv) >= 6:
+            # Use only the first set of arguments to handle duplicates
+            ciphertext, tag, nonce, shared_secret = sys.argv[2:6]
+            result = decrypt_data(ciphertext, tag, nonce, shared_secret)
         else:
             result = {"status": "error", "message": f"Invalid action or insufficient arguments: action={action}, args={sys.argv[2:]}"}
         print(json.dumps(result))
@@ -5,14 +5,22 @@ from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.backends import default_backend
 
+from timing import operation, stage
+
 def unpad_data(data: bytes) -> bytes:
     """Xóa padding PKCS7."""
     padding_length = data[-1]
     return data[:-padding_length]
 
-def decrypt_key(encrypted_path: str, passphrase: str) -> str:
+@operation("decrypt_key")
+def decrypt_key_bytes(encrypted_path: str, passphrase: str) -> bytearray:
+    """Giải mã và trả về PEM dạng bytearray để người gọi có thể xóa sau khi dùng.
+
+    Khóa AES và bản rõ chỉ nằm trong bytearray (update_into / derive_into), không có
+    bản sao bytes nào của PEM bị bỏ lại trong bộ nhớ.
+    """
     # Đọc file mã hóa
-    with open(encrypted_path, "rb") as f:
+    with stage("file_io"), open(encrypted_path, "rb") as f:
         data = f.read()
         salt, iv, encrypted_pem = data[:16], data[16:32], data[32:]
 
@@ -24,14 +32,41 @@ def decrypt_key(encrypted_path: str, passphrase: str) -> str:
         iterations=100000,
         backend=default_backend()
     )
-    key = kdf.derive(passphrase.encode())
+    key = bytearray(32)
+    with stage("kdf"):
+        if hasattr(kdf, "derive_into"):
+            kdf.derive_into(passphrase.encode(), key)
+        else:
+            # cryptography < 45 chỉ trả về bytes; bản sao này không xóa được
+            key[:] = kdf.derive(passphrase.encode())
 
-    # Giải mã
-    cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
-    decryptor = cipher.decryptor()
-    decrypted_pem = unpad_data(decryptor.update(encrypted_pem) + decryptor.finalize())
+    # Giải mã thẳng vào bytearray
+    try:
+        with stage("decrypt"):
+            decryptor = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend()).decryptor()
+            decrypted_pem = bytearray(len(encrypted_pem) + 15)
+            length = decryptor.update_into(encrypted_pem, decrypted_pem)
+            decryptor.finalize()
+    finally:
+        zeroize(key)
 
-    return decrypted_pem.decode('utf-8')
+    # Xóa padding PKCS7 tại chỗ: ghi 0 phần đuôi rồi mới cắt
+    length -= decrypted_pem[length - 1]
+    decrypted_pem[length:] = bytes(len(decrypted_pem) - length)
+    del decrypted_pem[length:]
+    return decrypted_pem
+
+def zeroize(buffer: bytearray):
+    """Ghi đè bộ đệm bằng 0."""
+    buffer[:] = bytes(len(buffer))
+
+def decrypt_key(encrypted_path: str, passphrase: str) -> str:
+    # Giao diện dòng lệnh cần str, nên bản sao này không xóa được; dùng decrypt_key_bytes khi cần xóa
+    decrypted_pem = decrypt_key_bytes(encrypted_path, passphrase)
+    try:
+        return decrypted_pem.decode('utf-8')
+    finally:
+        zeroize(decrypted_pem)
 
 if __name__ == "__main__":
     if len(sys.argv) != 3:
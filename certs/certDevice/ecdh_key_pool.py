@@ -0,0 +1,84 @@
+import json
+import queue
+import sys
+import threading
+import time
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.backends import default_backend
+
+# Pool of pre-generated ephemeral SECP256R1 server keys for ECDH handshakes.
+# A background thread keeps the pool at its configured depth; each handshake
+# takes one key, uses it once and drops it. When the pool runs dry the caller
+# generates a key inline and the miss is counted, so the depth can be sized
+# from the counters.
+
+class EphemeralKeyPool:
+    def __init__(self, depth=256):
+        self.depth = depth
+        self._keys = queue.Queue(maxsize=depth)
+        self._stats_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._fill, name="ecdh-key-pool", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _fill(self):
+        while not self._stop.is_set():
+            key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+            with self._stats_lock:
+                self.generated += 1
+            while not self._stop.is_set():
+                try:
+                    self._keys.put(key, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+
+    def take(self):
+        try:
+            key = self._keys.get_nowait()
+            with self._stats_lock:
+                self.hits += 1
+            return key
+        except queue.Empty:
+            with self._stats_lock:
+                self.misses += 1
+            return ec.generate_private_key(ec.SECP256R1(), default_backend())
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "depth": self._keys.qsize(),
+                "capacity": self.depth,
+                "hits": self.hits,
+                "misses": self.misses,
+                "generated": self.generated
+            }
+
+if __name__ == "__main__":
+    # python ecdh_key_pool.py [depth] [seconds]: fill a pool and report how fast it refills
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    pool = EphemeralKeyPool(depth).start()
+    time.sleep(seconds)
+    start = time.perf_counter()
+    for _ in range(depth):
+        pool.take()
+    drained = time.perf_counter() - start
+    stats = pool.stats()
+    pool.stop()
+    stats["drain_seconds"] = round(drained, 6)
+    print(json.dumps(stats))
@@ -0,0 +1,351 @@
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from ca_material import load_ca_cert
+from generate_device_cert import DEVICE_SUBJECT
+from issuing_shards import ShardSet
+from renewal_scheduler import parse_expiry
+from revocation_store import DEFAULT_DB_PATH, QUERY_CHUNK, connect, normalize_serial
+
+# Fleet-wide certificate audit over a registry export.
+#
+# Streams a mongoexport of the devices collection (JSONL, or a JSON array) and
+# checks every record: CA signature (root, or the issuing shard found by the
+# authority key identifier), subject (DEVICE_SUBJECT, or CN=<device_id> for the
+# compact profile), and that the record's serial and expiry match the
+# certificate. Parsing and ECDSA run in a process pool; the parent cross-checks
+# the results against the registry status and the revocation stores.
+#
+# Findings:
+#   unparseable          certificate missing or not DER, or the registry line
+#                        is not a JSON object (reported with its line number)
+#   unknown_issuer       AKI matches neither the root nor a shard
+#   signature_failed     issuer name or ECDSA signature does not check out
+#   subject_mismatch     unexpected subject for the profile / device ID
+#   record_mismatch      registry serial or expiry differs from the certificate
+#   expired              notAfter has passed and the device is not revoked
+#   expiring             active, notAfter within --warn-days
+#   revoked_but_active   serial is in a revocation store, registry says active
+#   revocation_missing   registry says revoked, no revocation store has the serial
+#
+# Re-audits are incremental: the per-record results of the signature, subject
+# and record checks are kept in a SQLite state file, keyed by device ID and a
+# digest of (certificate, serial, expiry, CA set). Unchanged records skip the
+# pool entirely; the time- and status-dependent checks above are recomputed
+# from the stored notAfter on every run, so they never go stale.
+#
+# Records with findings are written as JSONL to stdout, the summary to stderr.
+#
+#   python fleet_audit.py <registry|-> [--ca ca-cert.pem] [--shards DIR]
+#       [--revocations DB]... [--state FILE] [--full] [--warn-days N] [--workers N]
+
+DEFAULT_STATE_PATH = "ca_data/audit_state.db"
+DEFAULT_WARN = timedelta(days=30)
+# Records read, looked up in the state file and sent to the pool together
+AUDIT_CHUNK = 4096
+
+STATIC_FINDINGS = ("unparseable", "unknown_issuer", "signature_failed", "subject_mismatch", "record_mismatch")
+FINDINGS = STATIC_FINDINGS + ("expired", "expiring", "revoked_but_active", "revocation_missing")
+
+def iter_registry(source):
+    # JSONL is streamed line by line; a JSON array has to be loaded whole. A line
+    # (or array element) that is not a JSON object comes out as {"line" or "index",
+    # "unparseable": reason}, so one bad record does not end the audit
+    first = source.read(1)
+    while first and first.isspace():
+        first = source.read(1)
+    if first == "[":
+        for index, record in enumerate(json.loads(first + source.read())):
+            yield record if isinstance(record, dict) else {"index": index, "unparseable": "Record is not an object"}
+        return
+    line = first + source.readline()
+    number = 1
+    while line:
+        if line.strip():
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                record = {"line": number, "unparseable": f"Invalid JSON: {e}"}
+            if not isinstance(record, dict):
+                record = {"line": number, "unparseable": "Record is not an object"}
+            yield record
+        line = source.readline()
+        number += 1
+
+def load_issuers(ca_cert_path, shards=None):
+    # {authority key identifier (hex): (shard index or None, CA certificate path)}
+    root = load_ca_cert(ca_cert_path)
+    issuers = {root.key_identifier.hex(): (None, ca_cert_path)}
+    if shards is not None:
+        if root.fingerprint != shards.manifest["root_fingerprint"]:
+            raise ValueError("Root certificate does not match the shard manifest")
+        for index in range(shards.count):
+            intermediate = load_ca_cert(shards.cert_path(index))
+            try:
+                root.public_key.verify(
+                    intermediate.cert.signature,
+                    intermediate.cert.tbs_certificate_bytes,
+                    ec.ECDSA(hashes.SHA256())
+                )
+            except InvalidSignature:
+                raise ValueError(f"Issuing CA {index} has an invalid root signature")
+            issuers[intermediate.key_identifier.hex()] = (index, shards.cert_path(index))
+    return issuers
+
+def ca_set_digest(issuers):
+    # Changes whenever a CA certificate is replaced, which invalidates every stored result
+    digest = hashlib.sha256()
+    for key_identifier in sorted(issuers):
+        digest.update(load_ca_cert(issuers[key_identifier][1]).fingerprint.encode("ascii"))
+    return digest.digest()
+
+def load_revoked(db_paths):
+    # {serial: reason} across every revocation store
+    revoked = {}
+    for db_path in db_paths:
+        if os.path.exists(db_path):
+            revoked.update(connect(db_path).execute("SELECT serial, reason FROM revoked"))
+    return revoked
+
+def record_digest(record, ca_digest):
+    digest = hashlib.sha256(ca_digest)
+    for key in ("certificate", "serial", "expiry"):
+        value = record.get(key)
+        digest.update(json.dumps(value if not isinstance(value, dict) else value.get("$date")).encode("utf-8"))
+    return digest.digest()
+
+# Pool workers: every process loads the CA set once
+_audit_issuers = None
+
+def _init_audit_worker(issuers):
+    global _audit_issuers
+    _audit_issuers = {key_identifier: (index, load_ca_cert(path)) for key_identifier, (index, path) in issuers.items()}
+
+def _audit_in_worker(record):
+    return check_certificate(record, _audit_issuers)
+
+def check_certificate(record, issuers):
+    # The checks that only depend on the record and the CA set; the result is cached
+    facts = {"findings": [], "not_valid_after": None, "shard": None}
+    try:
+        cert = x509.load_der_x509_certificate(bytes.fromhex(record["certificate"]))
+        facts["not_valid_after"] = cert.not_valid_after.isoformat()
+    except Exception:
+        facts["findings"].append("unparseable")
+        return facts
+
+    try:
+        aki = cert.extensions.get_extension_for_class(x509.AuthorityKeyIdentifier).value.key_identifier
+        issuer = issuers.get((aki or b"").hex())
+    except x509.ExtensionNotFound:
+        issuer = None
+    if issuer is None:
+        facts["findings"].append("unknown_issuer")
+    else:
+        facts["shard"], ca = issuer
+        try:
+            if cert.issuer != ca.subject:
+                raise InvalidSignature()
+            ca.public_key.verify(cert.signature, cert.tbs_certificate_bytes, ec.ECDSA(hashes.SHA256()))
+        except InvalidSignature:
+            facts["findings"].append("signature_failed")
+
+    compact = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, str(record.get("device_id")))])
+    if cert.subject != DEVICE_SUBJECT and cert.subject != compact:
+        facts["findings"].append("subject_mismatch")
+
+    try:
+        serial_matches = normalize_serial(record.get("serial") or "") == format(cert.serial_number, "X")
+        expiry_matches = abs(parse_expiry(record["expiry"]) - cert.not_valid_after) < timedelta(seconds=1)
+    except (KeyError, TypeError, ValueError):
+        serial_matches = expiry_matches = False
+    if not (serial_matches and expiry_matches):
+        facts["findings"].append("record_mismatch")
+    return facts
+
+def open_state(state_path):
+    os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok=True)
+    conn = sqlite3.connect(state_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS audited (
+            device_id TEXT PRIMARY KEY,
+            digest BLOB NOT NULL,
+            facts TEXT NOT NULL
+        ) WITHOUT ROWID
+    """)
+    return conn
+
+def _stored_facts(conn, keyed):
+    # {device_id: facts} for the records whose stored digest still matches
+    stored = {}
+    device_ids = list(keyed)
+    for i in range(0, len(device_ids), QUERY_CHUNK):
+        part = device_ids[i:i + QUERY_CHUNK]
+        placeholders = ",".join("?" * len(part))
+        for device_id, digest, facts in conn.execute(
+                f"SELECT device_id, digest, facts FROM audited WHERE device_id IN ({placeholders})", part):
+            if digest == keyed[device_id]:
+                stored[device_id] = json.loads(facts)
+    return stored
+
+def cross_check(record, facts, revoked, now, warn):
+    findings = list(facts["findings"])
+    status = record.get("status", "active")
+    if facts["not_valid_after"] and status != "revoked":
+        not_valid_after = datetime.fromisoformat(facts["not_valid_after"])
+        if not_valid_after < now:
+            findings.append("expired")
+        elif status == "active" and not_valid_after < now + warn:
+            findings.append("expiring")
+    try:
+        serial = normalize_serial(record.get("serial") or "")
+    except ValueError:
+        serial = None
+    if serial in revoked and status == "active":
+        findings.append("revoked_but_active")
+    if status == "revoked" and serial not in revoked:
+        findings.append("revocation_missing")
+    return findings
+
+def audit_fleet(records, ca_cert_path="ca-cert.pem", shards_dir=None, revocation_dbs=(DEFAULT_DB_PATH,),
+                state_path=DEFAULT_STATE_PATH, full=False, warn=DEFAULT_WARN, workers=None, chunk_size=AUDIT_CHUNK):
+    # Yields (record, facts, findings, reused) per record, in input order
+    from multiprocessing import Pool
+
+    shards = ShardSet(shards_dir) if shards_dir else None
+    issuers = load_issuers(ca_cert_path, shards)
+    ca_digest = ca_set_digest(issuers)
+    revocation_dbs = list(revocation_dbs)
+    if shards is not None:
+        revocation_dbs += [shards.revocation_db(index) for index in range(shards.count)]
+    revoked = load_revoked(revocation_dbs)
+    now = datetime.utcnow()
+    state = open_state(state_path) if state_path else None
+
+    with Pool(workers, initializer=_init_audit_worker, initargs=(issuers,)) as pool:
+        chunk = []
+        for record in records:
+            if not isinstance(record, dict):
+                record = {"unparseable": "Record is not an object"}
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                yield from _audit_chunk(chunk, pool, state, full, ca_digest, revoked, now, warn)
+                chunk = []
+        if chunk:
+            yield from _audit_chunk(chunk, pool, state, full, ca_digest, revoked, now, warn)
+    if state is not None:
+        state.close()
+
+def _audit_chunk(chunk, pool, state, full, ca_digest, revoked, now, warn):
+    # Unreadable registry lines skip the pool and the state file
+    readable = [i for i, record in enumerate(chunk) if "unparseable" not in record]
+    digests = {i: record_digest(chunk[i], ca_digest) for i in readable}
+    keyed = {chunk[i]["device_id"]: digests[i] for i in readable if "device_id" in chunk[i]}
+    stored = _stored_facts(state, keyed) if state is not None and not full else {}
+
+    misses = [i for i in readable if chunk[i].get("device_id") not in stored]
+    audited = pool.map(_audit_in_worker, [chunk[i] for i in misses], chunksize=64) if misses else []
+    results = dict(zip(misses, audited))
+
+    if state is not None and misses:
+        state.executemany(
+            "INSERT OR REPLACE INTO audited (device_id, digest, facts) VALUES (?, ?, ?)",
+            [(chunk[i]["device_id"], digests[i], json.dumps(results[i])) for i in misses if "device_id" in chunk[i]]
+        )
+        state.commit()
+
+    for i, record in enumerate(chunk):
+        if "unparseable" in record:
+            yield record, {"findings": ["unparseable"], "not_valid_after": None, "shard": None}, ["unparseable"], False
+            continue
+        reused = i not in results
+        facts = stored[record["device_id"]] if reused else results[i]
+        yield record, facts, cross_check(record, facts, revoked, now, warn), reused
+
+def run_audit(source, out=sys.stdout, **options):
+    counts = dict.fromkeys(FINDINGS, 0)
+    records = reused = healthy = 0
+    start = time.perf_counter()
+    for record, facts, findings, was_reused in audit_fleet(iter_registry(source), **options):
+        records += 1
+        reused += was_reused
+        if not findings:
+            healthy += 1
+            continue
+        for finding in findings:
+            counts[finding] += 1
+        finding = {
+            "device_id": record.get("device_id"),
+            "serial": record.get("serial"),
+            "status": record.get("status", "active"),
+            "not_valid_after": facts["not_valid_after"],
+            "shard": facts["shard"],
+            "findings": findings
+        }
+        if "unparseable" in record:
+            # Where the unreadable registry record sits in the export, and why
+            finding.update({key: record[key] for key in ("line", "index") if key in record})
+            finding["error"] = record["unparseable"]
+        out.write(json.dumps(finding) + "\n")
+    elapsed = time.perf_counter() - start
+    return {
+        "records": records,
+        "audited": records - reused,
+        "unchanged": reused,
+        "healthy": healthy,
+        "findings": counts,
+        "elapsed_seconds": round(elapsed, 3),
+        "records_per_second": round(records / elapsed, 1) if elapsed > 0 else None
+    }
+
+if __name__ == "__main__":
+    usage = ("Usage: python fleet_audit.py <registry|-> [--ca ca-cert.pem] [--shards DIR] [--revocations DB]... "
+             "[--state FILE] [--full] [--warn-days N] [--workers N]")
+    args = sys.argv[1:]
+    try:
+        registry_path = args.pop(0)
+        options = {}
+        revocation_dbs = []
+        while args:
+            option = args.pop(0)
+            if option == "--ca":
+                options["ca_cert_path"] = args.pop(0)
+            elif option == "--shards":
+                options["shards_dir"] = args.pop(0)
+            elif option == "--revocations":
+                revocation_dbs.append(args.pop(0))
+            elif option == "--state":
+                options["state_path"] = args.pop(0)
+            elif option == "--full":
+                options["full"] = True
+            elif option == "--warn-days":
+                options["warn"] = timedelta(days=float(args.pop(0)))
+            elif option == "--workers":
+                options["workers"] = int(args.pop(0))
+            else:
+                raise ValueError(f"Unknown option: {option}")
+        if revocation_dbs:
+            options["revocation_dbs"] = revocation_dbs
+    except (IndexError, ValueError) as e:
+        print(json.dumps({"error": f"{usage} ({str(e)})"}))
+        sys.exit(1)
+
+    try:
+        with (sys.stdin if registry_path == "-" else open(registry_path, "r")) as source:
+            summary = run_audit(source, **options)
+        print(json.dumps(summary), file=sys.stderr)
+    except Exception as e:
+        print(json.dumps({"error": str(e)}))
+        sys.exit(1)
@@ -1,76 +1,103 @@
 import json
+import os
 import sys
+import time
 from datetime import datetime, timedelta
 from cryptography import x509
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.x509.oid import NameOID
 
-def generate_device_cert(device_id, ca_cert_path="ca-cert.pem", ca_key_path="ca-key.pem"):
+from ca_material import load_ca_cert, load_ca_key
+from timing import operation, stage
+
+DEVICE_SUBJECT = x509.Name([
+    x509.NameAttribute(NameOID.COUNTRY_NAME, "VN"),
+    x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "Hanoi"),
+    x509.NameAttribute(NameOID.LOCALITY_NAME, "Giangvo"),
+    x509.NameAttribute(NameOID.ORGANIZATION_NAME, "MyIoT"),
+    x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, "IoT"),
+    x509.NameAttribute(NameOID.COMMON_NAME, "ESP32_Sensor"),
+])
+
+DEFAULT_VALIDITY = timedelta(days=365)
+
+# Certificate profiles:
+#   standard - the six-attribute DEVICE_SUBJECT, SKI + AKI, 160-bit serial (~520 bytes)
+#   compact  - subject CN=<device_id> only, AKI only, 71-bit serial (~400 bytes with a
+#              10-character device ID); for constrained devices that store and parse
+#              the certificate on every handshake
+PROFILES = ("standard", "compact")
+
+def load_ca(ca_cert_path="ca-cert.pem", ca_key_path="ca-key.pem"):
+    with stage("ca_load"):
+        return load_ca_cert(ca_cert_path), load_ca_key(ca_key_path)
+
+@operation("generate")
+def generate_device_cert(device_id, ca_cert_path="ca-cert.pem", ca_key_path="ca-key.pem", profile="standard"):
     try:
-        # Load CA certificate
-        with open(ca_cert_path, "rb") as f:
-            ca_cert = x509.load_pem_x509_certificate(f.read())
+        ca, ca_key = load_ca(ca_cert_path, ca_key_path)
+        return issue_device_cert(device_id, ca, ca_key, profile=profile)
+    except Exception as e:
+        return {"error": str(e)}
+
+def generate_device_key():
+    # Device private key (ECDSA secp256r1)
+    return ec.generate_private_key(ec.SECP256R1())
 
-        # Load CA private key
-        with open(ca_key_path, "rb") as f:
-            ca_key = serialization.load_pem_private_key(f.read(), password=None)
+@operation("issue")
+def issue_device_cert(device_id, ca, ca_key, device_private_key=None, validity=DEFAULT_VALIDITY, profile="standard"):
+    try:
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown certificate profile: {profile}")
 
-        # Generate device private key (ECDSA secp256r1)
-        device_private_key = ec.generate_private_key(ec.SECP256R1())
+        # Generate device private key unless one was pre-generated
+        if device_private_key is None:
+            with stage("keygen"):
+                device_private_key = generate_device_key()
         device_public_key = device_private_key.public_key()
 
-        # Create CSR
-        builder = x509.CertificateSigningRequestBuilder()
-        builder = builder.subject_name(x509.Name([
-            x509.NameAttribute(NameOID.COUNTRY_NAME, "VN"),
-            x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "Hanoi"),
-            x509.NameAttribute(NameOID.LOCALITY_NAME, "Giangvo"),
-            x509.NameAttribute(NameOID.ORGANIZATION_NAME, "MyIoT"),
-            x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, "IoT"),
-            x509.NameAttribute(NameOID.COMMON_NAME, f"ESP32_Sensor"),
-        ]))
-        csr = builder.sign(device_private_key, hashes.SHA256())
-
-        # Calculate Subject Key Identifier
-        pub_bytes = device_public_key.public_bytes(
-            encoding=serialization.Encoding.DER,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        )
-        ski = x509.SubjectKeyIdentifier.from_public_key(device_public_key)
-
-        # Calculate Authority Key Identifier
-        aki = x509.AuthorityKeyIdentifier.from_issuer_public_key(ca_cert.public_key())
-
-        # Sign CSR to create device certificate
-        builder = x509.CertificateBuilder()
-        builder = builder.subject_name(csr.subject)
-        builder = builder.issuer_name(ca_cert.subject)
-        builder = builder.public_key(csr.public_key())
-        builder = builder.serial_number(x509.random_serial_number())
-        builder = builder.not_valid_before(datetime.utcnow())
-        builder = builder.not_valid_after(datetime.utcnow() + timedelta(days=365))
-        builder = builder.add_extension(ski, critical=False)
-        builder = builder.add_extension(aki, critical=False)
-        device_cert = builder.sign(ca_key, hashes.SHA256())
-
-        # Convert certificate to DER and then to hex
-        device_cert_der = device_cert.public_bytes(serialization.Encoding.DER)
-        device_cert_hex = device_cert_der.hex()
-
-        # Convert private key to DER without optional public key
-        device_private_key_der = device_private_key.private_bytes(
-            encoding=serialization.Encoding.DER,
-            format=serialization.PrivateFormat.TraditionalOpenSSL,  # Use ECPrivateKey format
-            encryption_algorithm=serialization.NoEncryption()
-        )
-        device_private_key_hex = device_private_key_der.hex()
-
-        # Get serial number in hex format
-        serial_number = format(device_cert.serial_number, 'X')
-
-        # Generate expiry date (ISO 8601 format)
-        expiry = device_cert.not_valid_after.isoformat()
+        # Sign device certificate directly; the subject is fixed, so a CSR adds nothing
+        with stage("build"):
+            builder = x509.CertificateBuilder()
+            if profile == "compact":
+                builder = builder.subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, device_id)]))
+                # 71 random bits: 9 random bytes with the top bit shifted out, so the
+                # positive DER integer stays 9 bytes (72 bits would need a 0x00 pad byte)
+                builder = builder.serial_number(int.from_bytes(os.urandom(9), "big") >> 1 or 1)
+            else:
+                builder = builder.subject_name(DEVICE_SUBJECT)
+                builder = builder.serial_number(x509.random_serial_number())
+            builder = builder.issuer_name(ca.subject)
+            builder = builder.public_key(device_public_key)
+            now = datetime.utcnow()
+            builder = builder.not_valid_before(now)
+            builder = builder.not_valid_after(now + validity)
+            if profile == "standard":
+                # Calculate Subject Key Identifier
+                builder = builder.add_extension(x509.SubjectKeyIdentifier.from_public_key(device_public_key), critical=False)
+            builder = builder.add_extension(ca.authority_key_identifier, critical=False)
+        with stage("sign"):
+            device_cert = builder.sign(ca_key, hashes.SHA256())
+
+        with stage("serialize"):
+            # Convert certificate to DER and then to hex
+            device_cert_der = device_cert.public_bytes(serialization.Encoding.DER)
+            device_cert_hex = device_cert_der.hex()
+
+            # Convert private key to DER without optional public key
+            device_private_key_der = device_private_key.private_bytes(
+                encoding=serialization.Encoding.DER,
+                format=serialization.PrivateFormat.TraditionalOpenSSL,  # Use ECPrivateKey format
+                encryption_algorithm=serialization.NoEncryption()
+            )
+            device_private_key_hex = device_private_key_der.hex()
+
+            # Get serial number in hex format
+            serial_number = format(device_cert.serial_number, 'X')
+
+            # Generate expiry date (ISO 8601 format)
+            expiry = device_cert.not_valid_after.isoformat()
 
         return {
             "device_id": device_id,
@@ -83,17 +110,76 @@ def generate_device_cert(device_id, ca_cert_path="ca-cert.pem", ca_key_path="ca-
     except Exception as e:
         return {"error": str(e)}
 
+# Batch issuance: every pool process loads the CA once, then issues many certificates
+_batch_ca = None
+_batch_profile = "standard"
+
+def _init_batch_worker(ca_cert_path, ca_key_path, profile="standard"):
+    global _batch_ca, _batch_profile
+    _batch_ca = load_ca(ca_cert_path, ca_key_path)
+    _batch_profile = profile
+
+def _issue_in_worker(device_id):
+    ca, ca_key = _batch_ca
+    return issue_device_cert(device_id, ca, ca_key, profile=_batch_profile)
+
+def generate_device_certs(device_ids, ca_cert_path="ca-cert.pem", ca_key_path="ca-key.pem", workers=None, chunksize=32, profile="standard"):
+    from multiprocessing import Pool
+
+    # Fail fast in the parent instead of inside every pool initializer
+    load_ca(ca_cert_path, ca_key_path)
+
+    with Pool(workers, initializer=_init_batch_worker, initargs=(ca_cert_path, ca_key_path, profile)) as pool:
+        for result in pool.imap(_issue_in_worker, device_ids, chunksize):
+            yield result
+
+def run_batch(source, ca_cert_path, ca_key_path, workers=None, out=sys.stdout):
+    device_ids = (line.strip() for line in source if line.strip())
+    issued = 0
+    failed = 0
+    start = time.perf_counter()
+    for result in generate_device_certs(device_ids, ca_cert_path, ca_key_path, workers):
+        if "error" in result:
+            failed += 1
+        else:
+            issued += 1
+        out.write(json.dumps(result) + "\n")
+    elapsed = time.perf_counter() - start
+    return {
+        "issued": issued,
+        "failed": failed,
+        "elapsed_seconds": round(elapsed, 3),
+        "certs_per_second": round(issued / elapsed, 1) if elapsed > 0 else None
+    }
+
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print(json.dumps({"error": "Device ID, CA certificate path and CA key path are required"}))
+    if len(sys.argv) >= 5 and sys.argv[1] == "--batch":
+        # python generate_device_cert.py --batch <device_ids_file|-> <ca_cert> <ca_key> [workers]
+        source_path, ca_cert_path, ca_key_path = sys.argv[2:5]
+        workers = int(sys.argv[5]) if len(sys.argv) > 5 else None
+        try:
+            if source_path == "-":
+                summary = run_batch(sys.stdin, ca_cert_path, ca_key_path, workers)
+            else:
+                with open(source_path, "r") as source:
+                    summary = run_batch(source, ca_cert_path, ca_key_path, workers)
+            print(json.dumps(summary), file=sys.stderr)
+        except Exception as e:
+            print(json.dumps({"error": str(e)}))
+            sys.exit(1)
+        sys.exit(0)
+
+    if len(sys.argv) not in (4, 5):
+        print(json.dumps({"error": "Device ID, CA certificate path and CA key path are required (optional: standard|compact profile)"}))
         sys.exit(1)
 
     device_id = sys.argv[1]
     ca_cert_path = sys.argv[2]
     ca_key_path = sys.argv[3]
+    profile = sys.argv[4] if len(sys.argv) > 4 else "standard"
     
     try:
-        result = generate_device_cert(device_id, ca_cert_path, ca_key_path)
+        result = generate_device_cert(device_id, ca_cert_path, ca_key_path, profile)
         print(json.dumps(result))
     except Exception as e:
         print(json.dumps({"error": str(e)}))
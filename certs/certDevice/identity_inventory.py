@@ -0,0 +1,406 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+from generate_device_cert import load_ca, issue_device_cert, generate_device_certs
+
+# Pre-provisioned device identity inventory.
+#
+# Standard-profile certificates carry the fixed DEVICE_SUBJECT, not the device
+# ID, so complete identities (key + certificate + serial) can be issued before
+# anyone asks for them. They wait in an SQLite pool with the private keys sealed
+# by AES-256-GCM (key from PBKDF2 over CERT_INVENTORY_PASSPHRASE, the serial as
+# associated data). Registering a device takes the oldest available identity and
+# binds it to the device ID in one transaction: no keygen, no signing.
+#
+# A refill thread tops the pool up to high_water whenever it falls below
+# low_water, and otherwise only when no device has registered for idle_seconds.
+# Identities with less than min_remaining validity left are not handed out.
+# The serials still in stock can be revoked in bulk (revoke-unused).
+#
+# The compact profile puts the device ID in the subject and cannot be pre-issued.
+#
+#   python identity_inventory.py fill <inventory.db> <ca_cert> <ca_key> <count> [workers]
+#   python identity_inventory.py bind <inventory.db> <device_id> [ca_cert] [ca_key]
+#   python identity_inventory.py stats <inventory.db>
+#   python identity_inventory.py revoke-unused <inventory.db> <ca_cert> <ca_key> [--stale] [--ca-data DIR] [--shards DIR]
+#   python identity_inventory.py bench <inventory.db> <ca_cert> <ca_key> [count]
+
+KDF_ITERATIONS = 100000
+MIN_REMAINING = timedelta(days=300)
+
+class IdentityInventory:
+    def __init__(self, db_path, passphrase=None, ca_cert_path="ca-cert.pem", ca_key_path="ca-key.pem",
+                 low_water=100, high_water=500, idle_seconds=30.0, min_remaining=MIN_REMAINING):
+        passphrase = passphrase or os.environ.get("CERT_INVENTORY_PASSPHRASE")
+        if not passphrase:
+            raise ValueError("Inventory passphrase is required (CERT_INVENTORY_PASSPHRASE)")
+        self.db_path = os.path.abspath(db_path)
+        self.ca_cert_path = ca_cert_path
+        self.ca_key_path = ca_key_path
+        self.low_water = low_water
+        self.high_water = high_water
+        self.idle_seconds = idle_seconds
+        self.min_remaining = min_remaining
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        self._last_bind = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.issued = 0
+        self._aead = AESGCM(self._derive_key(passphrase))
+
+    def connection(self):
+        # One connection per thread; sqlite3 connections are not shareable across threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = self._local.conn = sqlite3.connect(self.db_path, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS identities (
+                    serial TEXT PRIMARY KEY,
+                    certificate BLOB NOT NULL,
+                    sealed_key BLOB,
+                    expiry TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'available',
+                    device_id TEXT UNIQUE,
+                    bound_at TEXT
+                ) WITHOUT ROWID
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS identities_state ON identities (state, created_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        return conn
+
+    def _derive_key(self, passphrase):
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            meta = dict(conn.execute("SELECT name, value FROM meta").fetchall())
+            salt = bytes.fromhex(meta["kdf_salt"]) if "kdf_salt" in meta else os.urandom(16)
+            key = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=KDF_ITERATIONS).derive(passphrase.encode())
+            # A sealed constant tells a wrong passphrase apart from a corrupt key
+            if "key_check" in meta:
+                sealed = bytes.fromhex(meta["key_check"])
+                try:
+                    AESGCM(key).decrypt(sealed[:12], sealed[12:], None)
+                except InvalidTag:
+                    raise ValueError("Wrong inventory passphrase")
+            else:
+                nonce = os.urandom(12)
+                conn.execute("INSERT INTO meta VALUES ('kdf_salt', ?)", (salt.hex(),))
+                conn.execute("INSERT INTO meta VALUES ('key_check', ?)", ((nonce + AESGCM(key).encrypt(nonce, b"inventory", None)).hex(),))
+            conn.execute("COMMIT")
+            return key
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _seal(self, serial, private_key_der):
+        nonce = os.urandom(12)
+        return nonce + self._aead.encrypt(nonce, private_key_der, serial.encode("ascii"))
+
+    def _unseal(self, serial, sealed):
+        return self._aead.decrypt(sealed[:12], sealed[12:], serial.encode("ascii"))
+
+    def store(self, issued):
+        # issued: results of issue_device_cert (standard profile)
+        now = datetime.utcnow().isoformat()
+        rows = [(
+            item["serial"],
+            bytes.fromhex(item["certificate"]),
+            self._seal(item["serial"], bytes.fromhex(item["private_key"])),
+            item["expiry"],
+            now
+        ) for item in issued if "error" not in item]
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("INSERT INTO identities (serial, certificate, sealed_key, expiry, created_at) VALUES (?, ?, ?, ?, ?)", rows)
+        conn.execute("COMMIT")
+        with self._stats_lock:
+            self.issued += len(rows)
+        return len(rows)
+
+    def fill(self, count, workers=0, chunk=64):
+        # workers=0 issues in this thread (the refiller); otherwise a process pool
+        if workers:
+            issued = generate_device_certs(("inventory" for _ in range(count)), self.ca_cert_path, self.ca_key_path, workers)
+            batch = []
+            stored = 0
+            for item in issued:
+                batch.append(item)
+                if len(batch) >= chunk:
+                    stored += self.store(batch)
+                    batch = []
+            return stored + (self.store(batch) if batch else 0)
+
+        ca, ca_key = load_ca(self.ca_cert_path, self.ca_key_path)
+        stored = 0
+        while stored < count and not self._stop.is_set():
+            batch = [issue_device_cert("inventory", ca, ca_key) for _ in range(min(chunk, count - stored))]
+            stored += self.store(batch)
+        return stored
+
+    def _fresh_after(self):
+        return (datetime.utcnow() + self.min_remaining).isoformat()
+
+    def available(self):
+        return self.connection().execute(
+            "SELECT COUNT(*) FROM identities WHERE state = 'available' AND expiry > ?", (self._fresh_after(),)
+        ).fetchone()[0]
+
+    def bind(self, device_id):
+        # Hands the oldest fresh identity to device_id; issues one inline if the pool is empty
+        conn = self.connection()
+        now = datetime.utcnow().isoformat()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM identities WHERE device_id = ?", (device_id,)).fetchone():
+                conn.execute("ROLLBACK")
+                return {"error": f"Device {device_id} already has an identity; revoke it first"}
+            row = conn.execute(
+                "SELECT serial, certificate, sealed_key, expiry FROM identities "
+                "WHERE state = 'available' AND expiry > ? ORDER BY created_at LIMIT 1",
+                (self._fresh_after(),)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE identities SET state = 'bound', device_id = ?, bound_at = ?, sealed_key = NULL WHERE serial = ?",
+                    (device_id, now, row[0])
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        self._last_bind = time.monotonic()
+        self._wake.set()
+        if row is None:
+            with self._stats_lock:
+                self.misses += 1
+            ca, ca_key = load_ca(self.ca_cert_path, self.ca_key_path)
+            result = issue_device_cert(device_id, ca, ca_key)
+            if "error" in result:
+                return result
+            # Signing ran outside the transaction: a concurrent bind may have won meanwhile
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                existing = conn.execute(
+                    "SELECT serial, certificate, expiry FROM identities WHERE device_id = ?", (device_id,)
+                ).fetchone()
+                if existing is None:
+                    conn.execute(
+                        "INSERT INTO identities (serial, certificate, expiry, created_at, state, device_id, bound_at) "
+                        "VALUES (?, ?, ?, ?, 'bound', ?, ?)",
+                        (result["serial"], bytes.fromhex(result["certificate"]), result["expiry"], now, device_id, now)
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            if existing is not None:
+                # The winner's key was handed out with its binding and is not kept here
+                serial, certificate, expiry = existing
+                return {
+                    "device_id": device_id,
+                    "certificate": certificate.hex(),
+                    "serial": serial,
+                    "expiry": expiry,
+                    "already_bound": True
+                }
+            return result
+
+        with self._stats_lock:
+            self.hits += 1
+        serial, certificate, sealed_key, expiry = row
+        return {
+            "device_id": device_id,
+            "certificate": certificate.hex(),
+            "private_key": self._unseal(serial, sealed_key).hex(),
+            "serial": serial,
+            "expiry": expiry
+        }
+
+    def unused_serials(self, stale_only=False):
+        query = "SELECT serial FROM identities WHERE state = 'available'"
+        params = ()
+        if stale_only:
+            query += " AND expiry <= ?"
+            params = (self._fresh_after(),)
+        return [serial for (serial,) in self.connection().execute(query, params)]
+
+    def revoke_unused(self, stale_only=False, reason="cessationOfOperation", ca_data_dir="ca_data", shards_dir=None):
+        # Revokes the leftover stock and drops the sealed keys. Every identity is revoked
+        # by the CA that signed it, picked by its AKI: the inventory's CA (CRL and store in
+        # ca_data_dir) or one of the issuing shards (that shard's own ca_data).
+        from cryptography import x509
+        from cryptography.x509.oid import ExtensionOID
+        from ca_material import load_ca_cert, load_ca_key
+        from issuing_shards import shard_set
+        from revoke_device_cert import revoke_device_certs
+
+        query = "SELECT serial, certificate FROM identities WHERE state = 'available'"
+        params = ()
+        if stale_only:
+            query += " AND expiry <= ?"
+            params = (self._fresh_after(),)
+        rows = self.connection().execute(query, params).fetchall()
+        if not rows:
+            return {"status": "success", "revoked": [], "already_revoked": []}
+
+        # key identifier (hex) -> (CA certificate, CA key, ca_data directory)
+        issuers = {load_ca_cert(self.ca_cert_path).key_identifier.hex(): (self.ca_cert_path, self.ca_key_path, ca_data_dir)}
+        shards = shard_set(shards_dir)
+        if shards is not None:
+            for key_identifier, index in shards.by_key_identifier.items():
+                issuers.setdefault(key_identifier, (shards.cert_path(index), shards.key_path(index), shards.ca_data_dir(index)))
+
+        by_issuer = {}
+        unknown_issuer = []
+        for serial, certificate in rows:
+            try:
+                aki = x509.load_der_x509_certificate(certificate).extensions.get_extension_for_oid(
+                    ExtensionOID.AUTHORITY_KEY_IDENTIFIER).value.key_identifier.hex()
+            except (x509.ExtensionNotFound, AttributeError, ValueError):
+                aki = None
+            if aki in issuers:
+                by_issuer.setdefault(aki, []).append(serial)
+            else:
+                unknown_issuer.append(serial)
+
+        conn = self.connection()
+        results = {}
+        for aki, serials in by_issuer.items():
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("UPDATE identities SET state = 'revoking' WHERE serial = ? AND state = 'available'", [(s,) for s in serials])
+            conn.execute("COMMIT")
+
+            ca_cert_path, ca_key_path, issuer_data_dir = issuers[aki]
+            result = results[aki] = revoke_device_certs(
+                [{"serial": serial, "device_id": None, "reason": reason} for serial in serials],
+                load_ca_cert(ca_cert_path), load_ca_key(ca_key_path),
+                crl_path=os.path.join(issuer_data_dir, "crl.pem"),
+                ca_data_dir=issuer_data_dir
+            )
+            if result["status"] == "success":
+                update = "UPDATE identities SET state = 'revoked', sealed_key = NULL WHERE serial = ? AND state = 'revoking'"
+            else:
+                update = "UPDATE identities SET state = 'available' WHERE serial = ? AND state = 'revoking'"
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(update, [(serial,) for serial in serials])
+            conn.execute("COMMIT")
+
+        failed = [aki for aki, result in results.items() if result["status"] != "success"]
+        return {
+            "status": "error" if failed or unknown_issuer else "success",
+            "revoked": [serial for result in results.values() for serial in result.get("revoked", [])],
+            "already_revoked": [serial for result in results.values() for serial in result.get("already_revoked", [])],
+            "unknown_issuer": unknown_issuer,
+            "issuers": results
+        }
+
+    def _refill(self):
+        while not self._stop.is_set():
+            try:
+                available = self.available()
+                idle = time.monotonic() - self._last_bind >= self.idle_seconds
+                if available < self.low_water or (idle and available < self.high_water):
+                    self.fill(self.high_water - available)
+            except Exception as e:
+                print(json.dumps({"error": f"Identity inventory refill: {str(e)}"}), file=sys.stderr)
+            self._wake.wait(min(self.idle_seconds, 5.0))
+            self._wake.clear()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._refill, name="identity-inventory", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        counts = dict(self.connection().execute("SELECT state, COUNT(*) FROM identities GROUP BY state").fetchall())
+        with self._stats_lock:
+            return {
+                "available": self.available(),
+                "states": counts,
+                "low_water": self.low_water,
+                "high_water": self.high_water,
+                "hits": self.hits,
+                "misses": self.misses,
+                "issued": self.issued
+            }
+
+def benchmark(inventory, count=200):
+    # Onboarding latency: bind from the pool vs. issuing while the device waits
+    ca, ca_key = load_ca(inventory.ca_cert_path, inventory.ca_key_path)
+    inventory.fill(count)
+    report = {}
+    for name, call in (("issue_on_demand", lambda i: issue_device_cert(f"bench-live-{i}", ca, ca_key)),
+                       ("bind_from_inventory", lambda i: inventory.bind(f"bench-{time.time_ns()}-{i}"))):
+        samples = []
+        for i in range(count):
+            start = time.perf_counter()
+            result = call(i)
+            samples.append(time.perf_counter() - start)
+            if "error" in result:
+                raise RuntimeError(result["error"])
+        samples.sort()
+        report[name] = {
+            "p50_ms": round(samples[len(samples) // 2] * 1000, 3),
+            "p99_ms": round(samples[int(len(samples) * 0.99) - 1] * 1000, 3)
+        }
+    report["stats"] = inventory.stats()
+    return report
+
+if __name__ == "__main__":
+    usage = ("Usage: python identity_inventory.py fill <db> <ca_cert> <ca_key> <count> [workers] | bind <db> <device_id> [ca_cert] [ca_key] | "
+             "stats <db> | revoke-unused <db> <ca_cert> <ca_key> [--stale] [--ca-data DIR] [--shards DIR] | bench <db> <ca_cert> <ca_key> [count]")
+    args = sys.argv[1:]
+    try:
+        action = args[0] if args else None
+        if action == "fill" and len(args) in (5, 6):
+            inventory = IdentityInventory(args[1], ca_cert_path=args[2], ca_key_path=args[3])
+            stored = inventory.fill(int(args[4]), int(args[5]) if len(args) > 5 else os.cpu_count())
+            result = {"status": "success", "stored": stored, **inventory.stats()}
+        elif action == "bind" and len(args) in (3, 5):
+            result = IdentityInventory(args[1], *([None] + args[3:5] if len(args) == 5 else [])).bind(args[2])
+        elif action == "stats" and len(args) == 2:
+            result = {"status": "success", **IdentityInventory(args[1]).stats()}
+        elif action == "revoke-unused" and len(args) >= 4:
+            inventory = IdentityInventory(args[1], ca_cert_path=args[2], ca_key_path=args[3])
+            options = args[4:]
+            result = inventory.revoke_unused(
+                stale_only="--stale" in options,
+                ca_data_dir=options[options.index("--ca-data") + 1] if "--ca-data" in options else "ca_data",
+                shards_dir=options[options.index("--shards") + 1] if "--shards" in options else None
+            )
+        elif action == "bench" and len(args) in (4, 5):
+            inventory = IdentityInventory(args[1], ca_cert_path=args[2], ca_key_path=args[3])
+            result = benchmark(inventory, int(args[4]) if len(args) > 4 else 200)
+        else:
+            result = {"error": usage}
+        print(json.dumps(result))
+        sys.exit(1 if "error" in result or result.get("status") == "error" else 0)
+    except Exception as e:
+        print(json.dumps({"error": str(e)}))
+        sys.exit(1)
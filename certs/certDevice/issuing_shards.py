@@ -0,0 +1,411 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+from datetime import datetime, timedelta
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID, ExtensionOID
+
+from ca_material import load_ca_cert, load_ca_key
+from generate_device_cert import issue_device_cert, PROFILES
+from revoke_device_cert import revoke_device_certs
+from verify_device_cert import verify_certificate_with_ca
+
+# Sharded issuing CAs.
+#
+# The root CA (ca-cert.pem / ca-key.pem) only signs N intermediate issuing CAs;
+# every device certificate and CRL is signed by one of them. A device belongs to
+# shard sha256(device_id) mod N, so any process or node that has the shard
+# directory can issue, revoke and publish for it without coordinating with the
+# others, and each CRL only lists its own shard's revocations.
+#
+#   shards/manifest.json          root fingerprint and one entry per shard
+#   shards/shard-NN/ca-cert.pem   intermediate certificate (CA:TRUE, pathlen 0)
+#   shards/shard-NN/ca-key.pem    intermediate key
+#   shards/shard-NN/ca_data/      index.txt, revocations.db, crl.pem of that shard
+#
+# Verification looks the issuer up by the certificate's authority key identifier,
+# checks the intermediate against the root once per process, then runs the usual
+# device checks with the intermediate as CA and the shard's revocation store.
+# issuer_for() does the same lookup for the verifiers that are only given the
+# root (crypto_utils, verify_device_cert, the session handshake); they find the
+# shards in CERT_SHARDS_DIR (default "shards").
+#
+# Intermediate subjects copy the root's and use CN=ICnn, as long as the root's
+# CN=MyCA, so device certificates keep the production length (see
+# CERT_ACCEPTED_LENGTHS). The shard count is fixed once created: changing N
+# would move devices to other shards.
+#
+#   python issuing_shards.py create <root_cert> <root_key> <count> [shards_dir]
+#   python issuing_shards.py issue <device_id> [shards_dir] [standard|compact]
+#   python issuing_shards.py issue-batch <device_ids_file|-> [shards_dir] [workers]
+#   python issuing_shards.py revoke <entries.json|-> [shards_dir]
+#   python issuing_shards.py verify <cert_hex> <private_key_hex> <root_cert> [shards_dir]
+#   python issuing_shards.py selftest
+
+DEFAULT_SHARDS_DIR = "shards"
+# Where the verifiers (crypto_utils, verify_device_cert, the handshake) look for the manifest
+SHARDS_DIR = os.environ.get("CERT_SHARDS_DIR", DEFAULT_SHARDS_DIR)
+INTERMEDIATE_VALIDITY = timedelta(days=5 * 365)
+
+def shard_for(device_id, count):
+    digest = hashlib.sha256(device_id.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+def shard_dir(shards_dir, index):
+    return os.path.join(shards_dir, f"shard-{index:02d}")
+
+def build_intermediate(root, root_key, index, validity=INTERMEDIATE_VALIDITY):
+    key = ec.generate_private_key(ec.SECP256R1())
+    subject = x509.Name([
+        attr if attr.oid != NameOID.COMMON_NAME else x509.NameAttribute(NameOID.COMMON_NAME, f"IC{index:02d}")
+        for attr in root.subject
+    ])
+    now = datetime.utcnow()
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(root.subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(min(now + validity, root.cert.not_valid_after))
+        .add_extension(x509.BasicConstraints(ca=True, path_length=0), critical=True)
+        .add_extension(x509.KeyUsage(
+            digital_signature=False, content_commitment=False, key_encipherment=False,
+            data_encipherment=False, key_agreement=False, key_cert_sign=True, crl_sign=True,
+            encipher_only=False, decipher_only=False
+        ), critical=True)
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+        .add_extension(root.authority_key_identifier, critical=False)
+        .sign(root_key, hashes.SHA256())
+    )
+    return cert, key
+
+def create_shards(root_cert_path, root_key_path, count, shards_dir=DEFAULT_SHARDS_DIR):
+    if os.path.exists(os.path.join(shards_dir, "manifest.json")):
+        raise ValueError(f"Shards already exist in {shards_dir}")
+    if not 1 <= count <= 100:
+        raise ValueError("Shard count must be between 1 and 100")
+    root = load_ca_cert(root_cert_path)
+    root_key = load_ca_key(root_key_path)
+
+    shards = []
+    for index in range(count):
+        cert, key = build_intermediate(root, root_key, index)
+        directory = shard_dir(shards_dir, index)
+        os.makedirs(directory)
+        with open(os.path.join(directory, "ca-cert.pem"), "wb") as f:
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+        fd = os.open(os.path.join(directory, "ca-key.pem"), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption()
+            ))
+        shards.append({
+            "index": index,
+            "subject": cert.subject.rfc4514_string(),
+            "fingerprint": hashlib.sha256(cert.public_bytes(serialization.Encoding.DER)).hexdigest(),
+            "key_identifier": x509.SubjectKeyIdentifier.from_public_key(key.public_key()).digest.hex(),
+            "expiry": cert.not_valid_after.isoformat()
+        })
+
+    manifest = {"count": count, "root_fingerprint": root.fingerprint, "shards": shards}
+    with open(os.path.join(shards_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+class ShardSet:
+    def __init__(self, shards_dir=DEFAULT_SHARDS_DIR):
+        self.shards_dir = shards_dir
+        with open(os.path.join(shards_dir, "manifest.json"), "r") as f:
+            self.manifest = json.load(f)
+        self.count = self.manifest["count"]
+        self.by_key_identifier = {shard["key_identifier"]: shard["index"] for shard in self.manifest["shards"]}
+        # Fingerprints of intermediates already checked against the root
+        self._chained = set()
+        self._lock = threading.Lock()
+
+    def cert_path(self, index):
+        return os.path.join(shard_dir(self.shards_dir, index), "ca-cert.pem")
+
+    def key_path(self, index):
+        return os.path.join(shard_dir(self.shards_dir, index), "ca-key.pem")
+
+    def ca_data_dir(self, index):
+        return os.path.join(shard_dir(self.shards_dir, index), "ca_data")
+
+    def revocation_db(self, index):
+        return os.path.join(self.ca_data_dir(index), "revocations.db")
+
+    def shard_for(self, device_id):
+        return shard_for(device_id, self.count)
+
+    def issue(self, device_id, profile="standard", **options):
+        index = self.shard_for(device_id)
+        intermediate = load_ca_cert(self.cert_path(index))
+        result = issue_device_cert(device_id, intermediate, load_ca_key(self.key_path(index)), profile=profile, **options)
+        if "error" not in result:
+            # The device needs the intermediate to present a full chain
+            result["shard"] = index
+            result["issuer_certificate"] = intermediate.cert.public_bytes(serialization.Encoding.DER).hex()
+        return result
+
+    def revoke(self, entries, delta=False, **crl_options):
+        # Groups entries by issuing shard (from "shard", or the AKI of "certificate") and publishes
+        # one CRL per touched shard. The device_id hash is not used: legacy root-issued and
+        # inventory-bound certificates were not issued by shard_for(device_id)
+        by_shard = {}
+        for entry in entries:
+            if entry.get("shard") is not None:
+                index = int(entry["shard"])
+            elif entry.get("certificate"):
+                index = self.issuing_shard(x509.load_der_x509_certificate(bytes.fromhex(entry["certificate"])))
+                if index is None:
+                    return {"status": "error", "message": f"Certificate was not issued by a shard: {entry.get('serial')}"}
+            else:
+                return {"status": "error", "message": f"Entry needs certificate or shard: {entry.get('serial')}"}
+            if not 0 <= index < self.count:
+                return {"status": "error", "message": f"Unknown shard: {index}"}
+            by_shard.setdefault(index, []).append(entry)
+
+        results = {}
+        for index, shard_entries in sorted(by_shard.items()):
+            ca_data_dir = self.ca_data_dir(index)
+            results[index] = revoke_device_certs(
+                shard_entries,
+                load_ca_cert(self.cert_path(index)),
+                load_ca_key(self.key_path(index)),
+                crl_path=os.path.join(ca_data_dir, "crl.pem"),
+                delta=delta,
+                ca_data_dir=ca_data_dir,
+                delta_crl_path=os.path.join(ca_data_dir, "delta-crl.pem"),
+                **crl_options
+            )
+        failed = [index for index, result in results.items() if result["status"] != "success"]
+        return {
+            "status": "error" if failed else "success",
+            "failed_shards": failed,
+            "shards": {str(index): result for index, result in results.items()}
+        }
+
+    def issuing_shard(self, cert):
+        # Shard whose intermediate key identifier matches the certificate's AKI, None otherwise
+        try:
+            aki = cert.extensions.get_extension_for_oid(ExtensionOID.AUTHORITY_KEY_IDENTIFIER).value.key_identifier
+        except x509.ExtensionNotFound:
+            return None
+        return self.by_key_identifier.get((aki or b"").hex())
+
+    def resolve_issuer(self, cert, root):
+        # Issuing CA of a device certificate, checked against the root once per process
+        index = self.issuing_shard(cert)
+        if index is None:
+            raise ValueError("Certificate was not issued by a known issuing CA")
+        intermediate = load_ca_cert(self.cert_path(index))
+
+        with self._lock:
+            chained = intermediate.fingerprint in self._chained
+        if not chained:
+            if intermediate.cert.issuer != root.subject:
+                raise ValueError(f"Issuing CA {index} was not issued by the root")
+            try:
+                root.public_key.verify(
+                    intermediate.cert.signature,
+                    intermediate.cert.tbs_certificate_bytes,
+                    ec.ECDSA(hashes.SHA256())
+                )
+            except InvalidSignature:
+                raise ValueError(f"Issuing CA {index} has an invalid root signature")
+            constraints = intermediate.cert.extensions.get_extension_for_oid(ExtensionOID.BASIC_CONSTRAINTS).value
+            if not constraints.ca:
+                raise ValueError(f"Issuing CA {index} is not a CA certificate")
+            with self._lock:
+                self._chained.add(intermediate.fingerprint)
+
+        now = datetime.utcnow()
+        if not intermediate.cert.not_valid_before <= now <= intermediate.cert.not_valid_after:
+            raise ValueError(f"Issuing CA {index} is not valid at current time")
+        return index, intermediate
+
+    def verify(self, cert_hex, private_key_hex, root_cert_path="ca-cert.pem"):
+        try:
+            root = load_ca_cert(root_cert_path)
+            if root.fingerprint != self.manifest["root_fingerprint"]:
+                raise ValueError("Root certificate does not match the shard manifest")
+            cert = x509.load_der_x509_certificate(bytes.fromhex(cert_hex))
+            index, intermediate = self.resolve_issuer(cert, root)
+        except Exception as e:
+            return {"status": "error", "message": str(e)}
+
+        result = verify_certificate_with_ca(cert_hex, private_key_hex, intermediate, self.revocation_db(index))
+        result["shard"] = index
+        return result
+
+# Shard sets opened by the verifiers, per directory; the manifest is read once per process
+_shard_sets = {}
+_shard_sets_lock = threading.Lock()
+
+def shard_set(shards_dir=None):
+    # Cached ShardSet for shards_dir (default CERT_SHARDS_DIR), None when there is no manifest
+    shards_dir = shards_dir or SHARDS_DIR
+    with _shard_sets_lock:
+        shards = _shard_sets.get(shards_dir)
+    if shards is None:
+        if not os.path.exists(os.path.join(shards_dir, "manifest.json")):
+            return None
+        shards = ShardSet(shards_dir)
+        with _shard_sets_lock:
+            shards = _shard_sets.setdefault(shards_dir, shards)
+    return shards
+
+def issuer_for(cert, root, shards_dir=None):
+    # (shard index, issuing CA) of a device certificate: the root itself for
+    # certificates it signed directly, otherwise the intermediate named by the AKI
+    if cert.issuer == root.subject:
+        return None, root
+    shards = shard_set(shards_dir)
+    if shards is None:
+        raise ValueError("Certificate issuer does not match CA subject")
+    if shards.manifest["root_fingerprint"] != root.fingerprint:
+        raise ValueError("Root certificate does not match the shard manifest")
+    return shards.resolve_issuer(cert, root)
+
+# Batch issuance: every pool process opens the shard set once; each shard's CA is
+# loaded on first use, so all shards sign in parallel
+_batch_shards = None
+
+def _init_batch_worker(shards_dir):
+    global _batch_shards
+    _batch_shards = ShardSet(shards_dir)
+
+def _issue_in_worker(device_id):
+    return _batch_shards.issue(device_id)
+
+def issue_devices(device_ids, shards_dir=DEFAULT_SHARDS_DIR, workers=None, chunksize=32):
+    from multiprocessing import Pool
+    ShardSet(shards_dir)
+    with Pool(workers, initializer=_init_batch_worker, initargs=(shards_dir,)) as pool:
+        yield from pool.imap(_issue_in_worker, device_ids, chunksize)
+
+def self_check(count=3):
+    # Shard-issued certificates through every verifier that is only given the root:
+    # crypto_utils.verify_certificate, verify_device_cert and the session handshake,
+    # then a resume before and after revoking in the shard's store. Root-issued
+    # certificates must still pass and a foreign intermediate must not.
+    import tempfile
+    import crypto_utils
+    import issuing_shards
+    import session_tickets
+    import verify_device_cert
+    from bench_certdevice import create_throwaway_ca
+    from revoke_device_cert import revoke_device_cert
+
+    # Set on the imported module: the verifiers import issuing_shards, not __main__.
+    # Lengths vary by a byte or two with the ECDSA signatures of the throwaway CAs.
+    work_dir = tempfile.mkdtemp(prefix="issuing-shards-")
+    previous = issuing_shards.SHARDS_DIR, session_tickets.TICKET_KEYS_PATH, crypto_utils.ACCEPTED_CERT_LENGTHS
+    issuing_shards.SHARDS_DIR = os.path.join(work_dir, "shards")
+    session_tickets.TICKET_KEYS_PATH = os.path.join(work_dir, "ticket-keys.json")
+    crypto_utils.ACCEPTED_CERT_LENGTHS = frozenset(range(400, 600))
+    try:
+        root_cert_path, root_key_path, _ = create_throwaway_ca(work_dir)
+        create_shards(root_cert_path, root_key_path, count, issuing_shards.SHARDS_DIR)
+        foreign_dir = os.path.join(work_dir, "foreign")
+        os.makedirs(foreign_dir)
+        foreign_root, foreign_key, _ = create_throwaway_ca(foreign_dir)
+        create_shards(foreign_root, foreign_key, 1, os.path.join(foreign_dir, "shards"))
+
+        shards = ShardSet(issuing_shards.SHARDS_DIR)
+        numbers = ec.generate_private_key(ec.SECP256R1()).public_key().public_numbers()
+        x, y = format(numbers.x, "064x"), format(numbers.y, "064x")
+        cases = [(f"selftest-{i}", shards.issue(f"selftest-{i}"), True) for i in range(count * 2)]
+        cases.append(("root-issued", issue_device_cert("selftest-root", load_ca_cert(root_cert_path), load_ca_key(root_key_path)), True))
+        cases.append(("foreign-shard", ShardSet(os.path.join(foreign_dir, "shards")).issue("selftest-foreign"), False))
+
+        failures = []
+        for name, issued, expected in cases:
+            outcomes = {
+                "verify_certificate": crypto_utils.verify_certificate(issued["certificate"], root_cert_path),
+                "verify_device_cert": verify_device_cert.verify_certificate(issued["certificate"], issued["private_key"], root_cert_path),
+                "full_handshake": session_tickets.full_handshake(issued["certificate"], root_cert_path, x, y)
+            }
+            for check, result in outcomes.items():
+                if (result["status"] == "success") != expected:
+                    failures.append({"case": name, "check": check, "shard": issued.get("shard"), "result": result})
+
+        # Resumption checks the issuing shard's revocation store, named in the ticket. Both
+        # revoke paths must land there: ShardSet.revoke, and revoke_device_cert given only
+        # the root (the CLI, ca_worker and the server), which resolves the shard by AKI
+        revokers = {
+            "shard_set": lambda name, issued: shards.revoke([
+                {"serial": issued["serial"], "device_id": name, "certificate": issued["certificate"]}]),
+            "revoke_device_cert": lambda name, issued: revoke_device_cert(
+                name, root_cert_path, root_key_path, issued["serial"], certificate=issued["certificate"])
+        }
+        for (name, issued, _), (revoker, revoke) in zip(cases, revokers.items()):
+            ticket = session_tickets.full_handshake(issued["certificate"], root_cert_path, x, y)["ticket"]
+            resumed = session_tickets.resume_session(ticket, issued["certificate"], os.urandom(16).hex())
+            if resumed["status"] != "success" or resumed.get("shard") != issued["shard"]:
+                failures.append({"case": name, "check": "resume_session", "result": resumed})
+            revoked = revoke(name, issued)
+            resumed = session_tickets.resume_session(ticket, issued["certificate"], os.urandom(16).hex())
+            if revoked["status"] != "success" or resumed["status"] == "success":
+                failures.append({"case": name, "check": f"resume_after_{revoker}", "revoked": revoked, "result": resumed})
+        shard_cases = sum(1 for _, issued, _ in cases if issued.get("shard") is not None)
+        return {"status": "success" if not failures else "error", "cases": len(cases), "shard_cases": shard_cases, "failures": failures}
+    finally:
+        issuing_shards.SHARDS_DIR, session_tickets.TICKET_KEYS_PATH, crypto_utils.ACCEPTED_CERT_LENGTHS = previous
+
+if __name__ == "__main__":
+    usage = ("Usage: python issuing_shards.py create <root_cert> <root_key> <count> [shards_dir] | "
+             "issue <device_id> [shards_dir] [standard|compact] | issue-batch <device_ids_file|-> [shards_dir] [workers] | revoke <entries.json|-> [shards_dir] | "
+             "verify <cert_hex> <private_key_hex> <root_cert> [shards_dir] | selftest")
+    args = sys.argv[1:]
+    try:
+        action = args.pop(0) if args else None
+        if action == "create" and len(args) in (3, 4):
+            result = {"status": "success", **create_shards(args[0], args[1], int(args[2]), *args[3:])}
+        elif action == "issue" and len(args) in (1, 2, 3):
+            profile = args[2] if len(args) > 2 else "standard"
+            if profile not in PROFILES:
+                raise ValueError(f"Unknown certificate profile: {profile}")
+            result = ShardSet(*args[1:2]).issue(args[0], profile)
+        elif action == "issue-batch" and len(args) in (1, 2, 3):
+            # JSONL results on stdout, per-shard counts on stderr
+            shards_dir = args[1] if len(args) > 1 else DEFAULT_SHARDS_DIR
+            workers = int(args[2]) if len(args) > 2 else None
+            source = sys.stdin if args[0] == "-" else open(args[0], "r")
+            per_shard = {}
+            failed = 0
+            with source:
+                device_ids = (line.strip() for line in source if line.strip())
+                for issued in issue_devices(device_ids, shards_dir, workers):
+                    if "error" in issued:
+                        failed += 1
+                    else:
+                        per_shard[issued["shard"]] = per_shard.get(issued["shard"], 0) + 1
+                    sys.stdout.write(json.dumps(issued) + "\n")
+            print(json.dumps({"issued": sum(per_shard.values()), "failed": failed, "per_shard": per_shard}), file=sys.stderr)
+            sys.exit(0 if failed == 0 else 1)
+        elif action == "revoke" and len(args) in (1, 2):
+            raw = (sys.stdin.read() if args[0] == "-" else open(args[0], "r").read()).strip()
+            entries = json.loads(raw) if raw.startswith("[") else [json.loads(line) for line in raw.splitlines() if line.strip()]
+            result = ShardSet(*args[1:2]).revoke(entries)
+        elif action == "verify" and len(args) in (3, 4):
+            result = ShardSet(*args[3:4]).verify(args[0], args[1], args[2])
+        elif action == "selftest" and not args:
+            result = self_check()
+        else:
+            result = {"status": "error", "message": usage}
+        print(json.dumps(result))
+        sys.exit(0 if result.get("status", "success") == "success" and "error" not in result else 1)
+    except Exception as e:
+        print(json.dumps({"status": "error", "message": str(e)}))
+        sys.exit(1)
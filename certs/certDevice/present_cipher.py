@@ -0,0 +1,405 @@
+import sys
+import json
+import hashlib
+import hmac
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# PRESENT-CBC decryption for large arrays of 64-bit blocks.
+#
+# Bit-for-bit compatible with crypto/PRESENTCryptoUtils/cryptoUtils.js, which is
+# what the devices and the live MQTT path use. That variant is not textbook
+# PRESENT, so everything below follows the JS code rather than the paper:
+#   - state bit i is bit (i % 8) of byte (i / 8), i.e. a little-endian uint64;
+#   - the inverse pLayer moves bit i to (i * 4) % 63 (bit 63 stays);
+#   - the key schedule keeps k_low as an unbounded integer and substitutes only
+#     the low nibble of the top byte of k_high.
+#
+# Blocks are numpy uint64 arrays and every round is table driven: the inverse
+# pLayer is four 65536-entry lookups (one per 16-bit lane), and because the
+# pLayer is linear the inverse S-box of one round is folded into the
+# permutation table of the next. A round is then four gathers and XORs over the
+# whole array. Round keys are derived once per device key and cached; a batch
+# from many devices keeps one row per key and gathers each round by key index.
+#
+#   python present_cipher.py decrypt_data <ciphertext> <tag> <iv> <shared_secret>
+#   python present_cipher.py --batch <records.jsonl|-> <devices.jsonl>
+#   python present_cipher.py --kat
+#   python present_cipher.py --bench [blocks]
+
+ROUNDS = 32
+MASK64 = (1 << 64) - 1
+
+# --batch decrypts this many records per vectorised pass, so memory stays bounded for any export size
+BATCH_CHUNK = 8192
+
+SBOX = [0xC, 0x5, 0x6, 0xB, 0x9, 0x0, 0xA, 0xD, 0x3, 0xE, 0xF, 0x8, 0x4, 0x7, 0x1, 0x2]
+INV_SBOX = [0x5, 0xE, 0xF, 0x8, 0xC, 0x1, 0x2, 0xD, 0xB, 0x4, 0x6, 0x3, 0x0, 0x7, 0x9, 0xA]
+
+# Known answers from present_decrypt() in cryptoUtils.js: (key, ciphertext block, plaintext block)
+KNOWN_ANSWERS = [
+    ("00000000000000000000000000000000", "0000000000000000", "3ae3af26938213f7"),
+    ("ffffffffffffffffffffffffffffffff", "ffffffffffffffff", "78b0197a8574a768"),
+    ("000102030405060708090a0b0c0d0e0f", "0123456789abcdef", "657a982fd2938e0d"),
+    ("d1a5ac9a015fac2ef7b341673635512a", "122c597083bd438b", "6f5143c883d28ba6"),
+    ("6ab9f1eb8f7d3388f4f9d586f66e99fd", "d0f631ca1ddba8db", "e7fae1e960702ada"),
+    ("015f7e6bc5aeaf483724089e9252cc13", "9c0abe51c6e6655d", "fc2c3e30234cccb9"),
+    ("2f5052c9fd15b19a18c584d013635681", "7c1c97df17c06692", "54c3c6894b712aca"),
+    ("94091dd64a21ffe94214bc6d17deeb43", "0012a3fa000c5dc2", "a888fdd4761b9c00"),
+]
+
+# A whole record checked against decryptData() in cryptoUtils.js:
+# (ciphertext, tag, iv, shared_secret, decrypted JSON)
+KNOWN_RECORD = (
+    "72f679ade626756cec1762cfc911bc88526a1afa33a4ae59452b56427daf83ecc38095808a0d8da0858e0911c9ecf2553e84b6480f310b99",
+    "d86dd7538cf5fc24635a03f98b58ba3d",
+    "0102030405060708",
+    "8f1e2d3c4b5a69788796a5b4c3d2e1f00112233445566778899aabbccddeeff0",
+    {"temperature": 27.5, "humidity": 61, "wifi_rssi": -58}
+)
+
+def _player_target(bit):
+    return 63 if bit == 63 else (bit * 4) % 63
+
+def _byte_permutation_table(target):
+    # table[b, v]: the uint64 produced by moving the bits of value v in byte b
+    table = np.zeros((8, 256), dtype=np.uint64)
+    for b in range(8):
+        for v in range(256):
+            word = 0
+            for j in range(8):
+                if v >> j & 1:
+                    word |= 1 << target(8 * b + j)
+            table[b, v] = word
+    return table
+
+_INV_SBOX_BYTE = np.array([(INV_SBOX[v >> 4] << 4) | INV_SBOX[v & 0xF] for v in range(256)], dtype=np.uint8)
+_SBOX_BYTE = np.array([(SBOX[v >> 4] << 4) | SBOX[v & 0xF] for v in range(256)], dtype=np.uint8)
+
+_PERM = _byte_permutation_table(_player_target)
+_INV_TARGET = {_player_target(bit): bit for bit in range(64)}
+_PERM_INV = _byte_permutation_table(lambda bit: _INV_TARGET[bit])
+
+def _widen(table):
+    # Byte tables (8, 256) -> 16-bit tables (4, 65536): half as many lookups per word
+    low, high = np.arange(65536) & 0xFF, np.arange(65536) >> 8
+    return np.stack([table[2 * k][low] ^ table[2 * k + 1][high] for k in range(4)])
+
+# Decryption: inverse S-box of a byte followed by the inverse pLayer of the next round
+_DECRYPT_TABLE = _widen(_PERM[np.arange(8)[:, None], _INV_SBOX_BYTE[None, :]])
+# Encryption: S-box of a byte followed by the pLayer
+_ENCRYPT_TABLE = _widen(_PERM_INV[np.arange(8)[:, None], _SBOX_BYTE[None, :]])
+_PERM_TABLE = _widen(_PERM)
+
+def _apply_table(words, table):
+    # Four 65536-entry lookups per word, one per 16-bit lane, XOR-ed together
+    lanes = words.view("<u2").reshape(-1, 4)
+    result = table[0].take(lanes[:, 0])
+    for k in range(1, 4):
+        result ^= table[k].take(lanes[:, k])
+    return result
+
+def _permute(words):
+    return _apply_table(np.ascontiguousarray(words, dtype="<u8"), _PERM_TABLE)
+
+def key_schedule(key):
+    # 32 round keys as little-endian uint64 values, following present_key_schedule()
+    k_high = int.from_bytes(key[:8], "big")
+    k_low = int.from_bytes(key[8:16], "big")
+    round_keys = []
+    for i in range(ROUNDS):
+        round_keys.append(int.from_bytes(k_high.to_bytes(8, "big"), "little"))
+        temp = k_high
+        k_high = ((k_high << 61) | (k_low >> 3)) & MASK64
+        k_low = (k_low << 61) | (temp >> 3)
+        k_high = (k_high & 0x0FFFFFFFFFFFFFFF) | (SBOX[(k_high >> 56) & 0x0F] << 56)
+        k_high ^= (i + 1) << 15
+    return np.array(round_keys, dtype="<u8")
+
+# Round keys per 16-byte device key (LRU): (round keys, pLayer-permuted round keys)
+ROUND_KEY_CACHE_SIZE = 4096
+_round_keys = OrderedDict()
+_round_keys_lock = threading.Lock()
+
+def get_round_keys(key):
+    key = bytes(key[:16])
+    with _round_keys_lock:
+        cached = _round_keys.get(key)
+        if cached is not None:
+            _round_keys.move_to_end(key)
+            return cached
+
+    round_keys = key_schedule(key)
+    cached = (round_keys, _permute(round_keys))
+    with _round_keys_lock:
+        _round_keys[key] = cached
+        if len(_round_keys) > ROUND_KEY_CACHE_SIZE:
+            _round_keys.popitem(last=False)
+    return cached
+
+class _RoundKeyGather:
+    # rk[i] for a (K, 32) key table: round i of every block's key, built on demand
+    def __init__(self, table, key_index):
+        self.columns = np.ascontiguousarray(table.T)
+        self.key_index = key_index
+
+    def __getitem__(self, i):
+        return self.columns[i].take(self.key_index)
+
+def decrypt_blocks(blocks, round_keys, permuted_round_keys, key_index=None):
+    # blocks: uint64 array (N,). Round keys are (32,) for one key; with key_index
+    # they are a (K, 32) table of K device keys and key_index (N,) picks the row
+    # for every block, so the per-round keys are gathered one round at a time.
+    if key_index is None:
+        rk, prk = round_keys, permuted_round_keys
+    else:
+        rk = _RoundKeyGather(round_keys, key_index)
+        prk = _RoundKeyGather(permuted_round_keys, key_index)
+    state = _permute(blocks ^ rk[ROUNDS - 1])
+    for i in range(ROUNDS - 2, 0, -1):
+        state = _apply_table(state, _DECRYPT_TABLE)
+        state ^= prk[i]
+    # Last round: inverse S-box only, then the first round key
+    state = state.view(np.uint8)
+    state = _INV_SBOX_BYTE[state].view("<u8")
+    return state ^ rk[0]
+
+def encrypt_blocks(blocks, round_keys, key_index=None):
+    # Inverse of decrypt_blocks; only used to build benchmark and test data
+    rk = round_keys if key_index is None else _RoundKeyGather(round_keys, key_index)
+    state = np.ascontiguousarray(blocks, dtype="<u8")
+    for i in range(ROUNDS - 1):
+        state = _apply_table(state ^ rk[i], _ENCRYPT_TABLE)
+    return state ^ rk[ROUNDS - 1]
+
+def to_blocks(data):
+    return np.frombuffer(data, dtype="<u8")
+
+def cbc_decrypt(ciphertext, iv, key):
+    # One PRESENT-CBC payload; returns the padded plaintext bytes
+    blocks = to_blocks(ciphertext)
+    previous = np.concatenate((to_blocks(iv), blocks[:-1]))
+    return (decrypt_blocks(blocks, *get_round_keys(key)) ^ previous).tobytes()
+
+def cbc_encrypt(plaintext, iv, key):
+    # PKCS7 + PRESENT-CBC, the inverse of decryptData(); for tests and benchmarks
+    padding = 8 - len(plaintext) % 8
+    blocks = to_blocks(plaintext + bytes([padding]) * padding)
+    round_keys, _ = get_round_keys(key)
+    previous = to_blocks(iv)[0]
+    out = np.empty_like(blocks)
+    for i, block in enumerate(blocks):
+        previous = out[i] = encrypt_blocks(np.array([block ^ previous], dtype="<u8"), round_keys)[0]
+    return out.tobytes()
+
+def _tag(ciphertext):
+    return hashlib.sha256(ciphertext).digest()[:16]
+
+def _unpad_and_parse(padded):
+    padding = padded[-1]
+    if padding < 1 or padding > 8:
+        return {"status": "error", "message": f"Invalid PKCS7 padding: padding length {padding}"}
+    if padded[-padding:] != bytes([padding]) * padding:
+        return {"status": "error", "message": "Invalid PKCS7 padding: inconsistent padding bytes"}
+    unpadded = padded[:-padding]
+    try:
+        return {"status": "success", "decrypted_data": json.loads(unpadded)}
+    except (ValueError, UnicodeDecodeError) as e:
+        return {"status": "error", "message": f"Failed to parse JSON: {str(e)}", "decrypted_hex": unpadded.hex()}
+
+def _check_record(ciphertext, tag, iv, key):
+    if len(ciphertext) == 0 or len(ciphertext) % 8:
+        return "Ciphertext length must be a multiple of 8 bytes for PRESENT"
+    if len(iv) != 8:
+        return f"Invalid IV: must be 8 bytes, got {len(iv)}"
+    if len(key) < 16:
+        return f"Invalid shared secret: must be at least 16 bytes, got {len(key)}"
+    if not hmac.compare_digest(_tag(ciphertext), tag):
+        return "Tag verification failed: tag mismatch"
+    return None
+
+def decrypt_data(ciphertext_hex, tag_hex, iv_hex, shared_secret_hex):
+    # Same checks and result as decryptData() in cryptoUtils.js
+    try:
+        ciphertext, tag, iv, key = (bytes.fromhex(value) for value in (ciphertext_hex, tag_hex, iv_hex, shared_secret_hex))
+        error = _check_record(ciphertext, tag, iv, key)
+        if error:
+            return {"status": "error", "message": error}
+        return _unpad_and_parse(cbc_decrypt(ciphertext, iv, key[:16]))
+    except Exception as e:
+        return {"status": "error", "message": f"Decryption failed: {str(e)}"}
+
+def decrypt_records(records):
+    # records: (ciphertext, tag, iv, key) byte strings. All records, whatever the
+    # device, are decrypted in one vectorised pass; results are in input order.
+    # Round keys are one row per distinct device key, picked per block by index.
+    results = [None] * len(records)
+    pending = []
+    for i, (ciphertext, tag, iv, key) in enumerate(records):
+        error = _check_record(ciphertext, tag, iv, key)
+        if error:
+            results[i] = {"status": "error", "message": error}
+        else:
+            pending.append(i)
+    if not pending:
+        return results
+
+    key_ids, round_keys, permuted = {}, [], []
+    blocks, previous, record_keys, lengths = [], [], [], []
+    for i in pending:
+        ciphertext, _, iv, key = records[i]
+        key = bytes(key[:16])
+        key_id = key_ids.get(key)
+        if key_id is None:
+            key_id = key_ids[key] = len(round_keys)
+            rk, prk = get_round_keys(key)
+            round_keys.append(rk)
+            permuted.append(prk)
+        record_blocks = to_blocks(ciphertext)
+        blocks.append(record_blocks)
+        previous.append(to_blocks(iv))
+        previous.append(record_blocks[:-1])
+        record_keys.append(key_id)
+        lengths.append(len(record_blocks))
+
+    key_index = np.repeat(np.array(record_keys, dtype=np.intp), lengths)
+    plain = decrypt_blocks(np.concatenate(blocks), np.stack(round_keys), np.stack(permuted), key_index)
+    plain ^= np.concatenate(previous)
+    offsets = np.cumsum([0] + lengths)
+    for i, start, end in zip(pending, offsets[:-1], offsets[1:]):
+        results[i] = _unpad_and_parse(plain[start:end].tobytes())
+    return results
+
+def reference_decrypt_block(block, key):
+    # Direct port of present_round()/present_decrypt(), one bit at a time
+    round_keys = [int(rk).to_bytes(8, "little") for rk in key_schedule(key)]
+    state = bytearray(b ^ k for b, k in zip(block, round_keys[ROUNDS - 1]))
+    for r in range(ROUNDS - 2, -1, -1):
+        result = 0
+        for i in range(64):
+            bit = (state[i // 8] >> (i % 8)) & 1
+            result |= bit << _player_target(i)
+        state = bytearray(result.to_bytes(8, "little"))
+        state = bytearray((INV_SBOX[v >> 4] << 4) | INV_SBOX[v & 0xF] for v in state)
+        state = bytearray(v ^ k for v, k in zip(state, round_keys[r]))
+    return bytes(state)
+
+def known_answer_test():
+    failures = []
+    for key_hex, ciphertext_hex, expected in KNOWN_ANSWERS:
+        key, block = bytes.fromhex(key_hex), bytes.fromhex(ciphertext_hex)
+        vectorised = decrypt_blocks(to_blocks(block), *get_round_keys(key)).tobytes().hex()
+        reference = reference_decrypt_block(block, key).hex()
+        if vectorised != expected or reference != expected:
+            failures.append({"key": key_hex, "ciphertext": ciphertext_hex, "expected": expected, "vectorised": vectorised, "reference": reference})
+
+    record = decrypt_data(*KNOWN_RECORD[:4])
+    if record.get("decrypted_data") != KNOWN_RECORD[4]:
+        failures.append({"record": KNOWN_RECORD[0], "expected": KNOWN_RECORD[4], "result": record})
+
+    # Round trip through the encryptor with several keys in one batch
+    rng = np.random.default_rng(16)
+    records = []
+    for i in range(32):
+        key = rng.bytes(32)
+        iv = rng.bytes(8)
+        ciphertext = cbc_encrypt(json.dumps({"temperature": i, "humidity": 50 + i}).encode(), iv, key[:16])
+        records.append((ciphertext, _tag(ciphertext), iv, key))
+    round_trip = sum(1 for i, result in enumerate(decrypt_records(records)) if result.get("decrypted_data") != {"temperature": i, "humidity": 50 + i})
+    return {"status": "success" if not failures and not round_trip else "error", "vectors": len(KNOWN_ANSWERS) + 1, "failures": failures, "round_trip_failures": round_trip}
+
+def benchmark(blocks=1 << 20, devices=1000):
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 1 << 63, size=blocks, dtype=np.uint64).astype("<u8")
+    keys = [rng.bytes(16) for _ in range(devices)]
+
+    def rate(run, count):
+        start = time.perf_counter()
+        run()
+        return round(count / (time.perf_counter() - start), 1)
+
+    report = {"blocks": blocks, "devices": devices}
+    sample = data[:64].tobytes()
+    report["reference_blocks_per_second"] = rate(lambda: [reference_decrypt_block(sample[i:i + 8], keys[0]) for i in range(0, len(sample), 8)], 64)
+
+    with _round_keys_lock:
+        _round_keys.clear()
+    report["key_schedule_per_second"] = rate(lambda: [get_round_keys(key) for key in keys], devices)
+    report["single_key_blocks_per_second"] = rate(lambda: decrypt_blocks(data, *get_round_keys(keys[0])), blocks)
+
+    key_index = rng.integers(0, devices, size=blocks)
+    tables = [get_round_keys(key) for key in keys]
+    rk = np.stack([t[0] for t in tables])
+    prk = np.stack([t[1] for t in tables])
+    report["per_block_keys_blocks_per_second"] = rate(lambda: decrypt_blocks(data, rk, prk, key_index), blocks)
+
+    # Whole records from many devices: tag check, CBC and unpadding. The payloads are
+    # random, so they stop at the padding check; JSON parsing is not measured.
+    records = []
+    for i in range(min(20000, blocks // 12)):
+        key = keys[i % devices] + bytes(16)
+        iv = rng.bytes(8)
+        ciphertext = rng.bytes(96)
+        records.append((ciphertext, _tag(ciphertext), iv, key))
+    report["records"] = len(records)
+    report["records_per_second"] = rate(lambda: decrypt_records(records), len(records))
+    return report
+
+if __name__ == "__main__":
+    try:
+        if len(sys.argv) >= 2 and sys.argv[1] == "--kat":
+            result = known_answer_test()
+            print(json.dumps(result))
+            sys.exit(0 if result["status"] == "success" else 1)
+
+        if len(sys.argv) >= 2 and sys.argv[1] == "--bench":
+            blocks = int(sys.argv[2]) if len(sys.argv) > 2 else 1 << 20
+            print(json.dumps(benchmark(blocks)))
+            sys.exit(0)
+
+        if len(sys.argv) == 4 and sys.argv[1] == "--batch":
+            # EncryptedSensorData export lines: device_id, encrypted_data (or ciphertext), tag, iv (or nonce)
+            from bulk_decrypt import ECHO_FIELDS, load_device_keys
+            with open(sys.argv[3], "r") as f:
+                device_keys = load_device_keys(f)
+            source = sys.stdin if sys.argv[2] == "-" else open(sys.argv[2], "r")
+            failed = 0
+            with source:
+                lines = (line for line in source if line.strip())
+                while True:
+                    records = [json.loads(line) for line in itertools.islice(lines, BATCH_CHUNK)]
+                    if not records:
+                        break
+                    inputs = []
+                    for record in records:
+                        try:
+                            inputs.append((
+                                bytes.fromhex(record.get("encrypted_data") or record["ciphertext"]),
+                                bytes.fromhex(record["tag"]),
+                                bytes.fromhex(record.get("iv") or record["nonce"]),
+                                bytes.fromhex(device_keys.get(record.get("device_id"), ""))
+                            ))
+                        except (KeyError, ValueError):
+                            # Fails the length checks and is reported as a bad record
+                            inputs.append((b"", b"", b"", b""))
+                    for record, result in zip(records, decrypt_records(inputs)):
+                        result.update({field: record[field] for field in ECHO_FIELDS if field in record})
+                        if result["status"] != "success":
+                            failed += 1
+                        print(json.dumps(result))
+            sys.exit(0 if failed == 0 else 1)
+
+        if len(sys.argv) == 6 and sys.argv[1] == "decrypt_data":
+            result = decrypt_data(*sys.argv[2:6])
+            print(json.dumps(result))
+            sys.exit(0 if result["status"] == "success" else 1)
+
+        print(json.dumps({"error": "Usage: python present_cipher.py decrypt_data <ciphertext> <tag> <iv> <shared_secret> | --batch <records|-> <devices> | --kat | --bench [blocks]"}))
+        sys.exit(1)
+    except Exception as e:
+        print(json.dumps({"status": "error", "message": f"Script error: {str(e)}"}))
+        sys.exit(1)
@@ -0,0 +1,405 @@
+import asyncio
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from cryptography.hazmat.primitives import serialization
+
+from ca_material import load_ca_cert
+from generate_device_cert import load_ca, generate_device_key, issue_device_cert
+from verify_device_cert import verify_certificate_with_ca
+
+# Asyncio provisioning pipeline.
+#
+# Jobs ({"device_id": ..., optional "id"}) flow through four stages:
+#
+#   keygen -> sign -> self_verify -> emit
+#
+# Every stage has its own bounded input queue and a fixed number of workers.
+# When a stage falls behind its queue fills up and the stage in front of it
+# blocks on put(), all the way back to the job reader, so a slow consumer on
+# the output side throttles the whole rollout instead of piling up results in
+# memory. The CPU stages run in a shared process pool; emit runs in a thread so
+# a blocked pipe only stalls the emit workers.
+#
+# Workers pick up to batch_size queued jobs at a time. A job whose stage
+# attempt fails (an exception or an {"error": ...} result) is retried with
+# exponential backoff; after the last attempt it is emitted as an error record
+# naming the stage. A job that cannot be read (bad JSON, no device_id) goes
+# straight to emit as an error record with stage "parse" and its line number.
+#
+#   python provision_pipeline.py <jobs.jsonl|-> [options]
+
+STAGES = ("keygen", "sign", "self_verify", "emit")
+
+# Stage functions run in the process pool, so they take and return plain data.
+# Each call handles a small batch of jobs to amortise the inter-process hop;
+# results come back in input order, one per job.
+
+def keygen_stage(count):
+    return [
+        generate_device_key().private_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PrivateFormat.TraditionalOpenSSL,
+            encryption_algorithm=serialization.NoEncryption()
+        ).hex()
+        for _ in range(count)
+    ]
+
+def sign_stage(items, ca_cert_path, ca_key_path):
+    # items: (device_id, private_key_hex); load_ca is cached per process
+    ca, ca_key = load_ca(ca_cert_path, ca_key_path)
+    results = []
+    for device_id, private_key_hex in items:
+        try:
+            device_private_key = serialization.load_der_private_key(bytes.fromhex(private_key_hex), password=None)
+            results.append(issue_device_cert(device_id, ca, ca_key, device_private_key))
+        except Exception as e:
+            results.append({"error": str(e)})
+    return results
+
+def self_verify_stage(items, ca_cert_path):
+    # items: (certificate_hex, private_key_hex)
+    ca = load_ca_cert(ca_cert_path)
+    results = []
+    for certificate, private_key_hex in items:
+        result = verify_certificate_with_ca(certificate, private_key_hex, ca)
+        # InvalidSignature carries no message of its own
+        results.append(result if result["status"] == "success" else {"error": result["message"] or "CA signature check failed"})
+    return results
+
+class StageMetrics:
+    def __init__(self, name, queue):
+        self.name = name
+        self.queue = queue
+        self.max_queue_depth = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+        self.busy_seconds = 0.0
+
+    def observe_depth(self):
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def snapshot(self):
+        return {
+            "queue_depth": self.queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "queue_capacity": self.queue.maxsize,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "retries": self.retries,
+            "busy_seconds": round(self.busy_seconds, 3)
+        }
+
+class ProvisioningPipeline:
+    def __init__(self, ca_cert_path="ca-cert.pem", ca_key_path="ca-key.pem", out=sys.stdout,
+                 workers=None, concurrency=None, queue_size=64, batch_size=16, max_attempts=4,
+                 retry_delay=0.5, max_retry_delay=30.0):
+        self.ca_cert_path = ca_cert_path
+        self.ca_key_path = ca_key_path
+        self.out = out
+        self.workers = workers or os.cpu_count() or 4
+        # Per-stage worker counts; emit defaults to one writer
+        self.concurrency = {"keygen": self.workers, "sign": self.workers, "self_verify": self.workers, "emit": 1}
+        self.concurrency.update(concurrency or {})
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._write_lock = threading.Lock()
+        self.emitted = 0
+        self.errors = 0
+
+    def write(self, records):
+        with self._write_lock:
+            self.out.write("".join(json.dumps(record) + "\n" for record in records))
+            self.out.flush()
+
+    async def _attempt(self, stage, metrics, call, jobs):
+        # Runs one stage over a batch; jobs that failed are retried with
+        # exponential backoff, the rest move on. Returns (done, failed) lists.
+        done, failed = [], []
+        attempt = 0
+        while jobs:
+            attempt += 1
+            start = time.perf_counter()
+            try:
+                results = await call(jobs)
+            except Exception as e:
+                results = [{"error": str(e)}] * len(jobs)
+            metrics.busy_seconds += time.perf_counter() - start
+
+            retry = []
+            for job, result in zip(jobs, results):
+                error = result.get("error") if isinstance(result, dict) else None
+                if error is None:
+                    done.append((job, result))
+                elif attempt >= self.max_attempts:
+                    failed.append((job, {"stage": stage, "message": error, "attempts": attempt}))
+                else:
+                    retry.append(job)
+            if retry:
+                metrics.retries += len(retry)
+                await asyncio.sleep(min(self.retry_delay * 2 ** (attempt - 1), self.max_retry_delay))
+            jobs = retry
+        return done, failed
+
+    def _stage_call(self, stage, loop, pool):
+        if stage == "keygen":
+            return lambda jobs: loop.run_in_executor(pool, keygen_stage, len(jobs))
+        if stage == "sign":
+            return lambda jobs: loop.run_in_executor(
+                pool, sign_stage, [(job["device_id"], job["private_key"]) for job in jobs], self.ca_cert_path, self.ca_key_path
+            )
+        if stage == "self_verify":
+            return lambda jobs: loop.run_in_executor(
+                pool, self_verify_stage, [(job["issued"]["certificate"], job["private_key"]) for job in jobs], self.ca_cert_path
+            )
+
+        async def emit(jobs):
+            await loop.run_in_executor(None, self.write, [job["record"] for job in jobs])
+            return [{}] * len(jobs)
+        return emit
+
+    async def _next_batch(self, inbox):
+        # Waits for one job, then takes whatever else is already queued, up to
+        # batch_size. Returns (jobs, stop) where stop means the sentinel was seen.
+        job = await inbox.get()
+        inbox.task_done()
+        if job is None:
+            return [], True
+        jobs = [job]
+        while len(jobs) < self.batch_size and not inbox.empty():
+            job = inbox.get_nowait()
+            inbox.task_done()
+            if job is None:
+                return jobs, True
+            jobs.append(job)
+        return jobs, False
+
+    def _record(self, job, fields):
+        record = dict(fields)
+        if "id" in job:
+            record["id"] = job["id"]
+        return record
+
+    def _rejection(self, job):
+        # Error record for a job that cannot enter the pipeline, None for a valid job
+        if not isinstance(job, dict):
+            return {"device_id": None, "status": "error", "stage": "parse", "message": f"Job is not an object: {job!r}"}
+        if "invalid" in job:
+            message = job["invalid"]
+        elif not isinstance(job.get("device_id"), str) or not job["device_id"]:
+            message = "Job without device_id"
+        else:
+            return None
+        fields = {"device_id": None, "status": "error", "stage": "parse", "message": message}
+        if "line" in job:
+            fields["line"] = job["line"]
+        return self._record(job, fields)
+
+    async def _worker(self, stage, queues, metrics, loop, pool):
+        inbox = queues[stage]
+        next_stage = STAGES[STAGES.index(stage) + 1] if stage != "emit" else None
+        call = self._stage_call(stage, loop, pool)
+        stop = False
+        while not stop:
+            jobs, stop = await self._next_batch(inbox)
+            if not jobs:
+                continue
+            metrics[stage].in_flight += len(jobs)
+            done, failed = await self._attempt(stage, metrics[stage], call, jobs)
+            metrics[stage].in_flight -= len(jobs)
+            metrics[stage].completed += len(done)
+            metrics[stage].failed += len(failed)
+
+            for job, failure in failed:
+                record = self._record(job, {"device_id": job.get("device_id"), "status": "error", **failure})
+                if stage == "emit":
+                    # Nothing downstream left to report through
+                    print(json.dumps(record), file=sys.stderr)
+                    self.errors += 1
+                else:
+                    await self._put(queues, metrics, "emit", {**job, "record": record})
+
+            for job, result in done:
+                if stage == "keygen":
+                    job["private_key"] = result
+                elif stage == "sign":
+                    job["issued"] = result
+                elif stage == "self_verify":
+                    job["record"] = self._record(job, {"status": "success", **job["issued"]})
+                elif job["record"]["status"] == "success":
+                    self.emitted += 1
+                else:
+                    self.errors += 1
+                if next_stage is not None:
+                    await self._put(queues, metrics, next_stage, job)
+
+    async def _put(self, queues, metrics, stage, job):
+        # Blocks while the stage is full: this is the backpressure point
+        await queues[stage].put(job)
+        metrics[stage].observe_depth()
+
+    async def run(self, jobs, metrics_interval=None, metrics_out=sys.stderr):
+        # jobs: an iterable or async iterable of job dicts
+        loop = asyncio.get_running_loop()
+        queues = {stage: asyncio.Queue(maxsize=self.queue_size) for stage in STAGES}
+        metrics = {stage: StageMetrics(stage, queues[stage]) for stage in STAGES}
+        self.metrics = metrics
+        start = time.perf_counter()
+        submitted = 0
+
+        # Fail fast instead of retrying every job against a missing CA; the file reads
+        # run in a thread so the event loop never blocks on disk
+        await loop.run_in_executor(None, load_ca, self.ca_cert_path, self.ca_key_path)
+
+        reporter = None
+        if metrics_interval:
+            async def report():
+                while True:
+                    await asyncio.sleep(metrics_interval)
+                    print(json.dumps({"metrics": self.snapshot()}), file=metrics_out)
+            reporter = asyncio.create_task(report())
+
+        with ProcessPoolExecutor(self.workers) as pool:
+            workers = {
+                stage: [asyncio.create_task(self._worker(stage, queues, metrics, loop, pool)) for _ in range(self.concurrency[stage])]
+                for stage in STAGES
+            }
+
+            try:
+                if not hasattr(jobs, "__aiter__"):
+                    jobs = read_in_thread(jobs, loop)
+                async for job in jobs:
+                    submitted += 1
+                    rejection = self._rejection(job)
+                    if rejection is not None:
+                        # Reported through emit like any other failed job; the run goes on
+                        await self._put(queues, metrics, "emit", {"record": rejection})
+                        continue
+                    await self._put(queues, metrics, "keygen", job)
+            finally:
+                # Drain stage by stage so later stages never see the sentinel early. Also
+                # when the job source raises: jobs already in flight are still emitted
+                for stage in STAGES:
+                    for _ in workers[stage]:
+                        await queues[stage].put(None)
+                    await asyncio.gather(*workers[stage])
+                if reporter is not None:
+                    reporter.cancel()
+
+        elapsed = time.perf_counter() - start
+        return {
+            "submitted": submitted,
+            "issued": self.emitted,
+            "failed": self.errors,
+            "elapsed_seconds": round(elapsed, 3),
+            "certs_per_second": round(self.emitted / elapsed, 1) if elapsed > 0 else None,
+            "stages": self.snapshot()
+        }
+
+    def snapshot(self):
+        return {stage: stage_metrics.snapshot() for stage, stage_metrics in self.metrics.items()}
+
+def read_jobs(source):
+    # JSONL jobs; a bare device id per line is accepted too. A line that is not a
+    # job is yielded as {"line", "invalid"} so the pipeline reports it and goes on
+    for number, line in enumerate(source, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line) if line.startswith("{") else {"device_id": line}
+        except ValueError as e:
+            yield {"line": number, "invalid": f"Invalid JSON: {e}"}
+            continue
+        if not isinstance(job, dict) or "device_id" not in job:
+            invalid = {"line": number, "invalid": f"Job without device_id: {line}"}
+            if isinstance(job, dict) and "id" in job:
+                invalid["id"] = job["id"]
+            yield invalid
+            continue
+        yield job
+
+# Jobs pulled from a plain (file-backed) iterable per trip to the reader thread
+READ_BATCH = 256
+
+async def read_in_thread(jobs, loop):
+    # Iterates a blocking iterable (e.g. read_jobs over a file or stdin) in the default
+    # executor, a batch at a time, so slow input never stalls the event loop
+    iterator = iter(jobs)
+    while True:
+        batch = await loop.run_in_executor(None, lambda: list(itertools.islice(iterator, READ_BATCH)))
+        if not batch:
+            return
+        for job in batch:
+            yield job
+
+async def queue_jobs(queue):
+    # Adapts a local asyncio.Queue to the pipeline; a None item ends the run
+    while True:
+        job = await queue.get()
+        if job is None:
+            return
+        yield job
+
+if __name__ == "__main__":
+    usage = ("Usage: python provision_pipeline.py <jobs.jsonl|-> [--ca-cert PATH] [--ca-key PATH] [--output FILE] "
+             "[--workers N] [--keygen N] [--sign N] [--verify N] [--emit N] [--queue-size N] [--batch-size N] "
+             "[--attempts N] [--retry-delay S] [--metrics-interval S]")
+    args = sys.argv[1:]
+    options = {}
+    concurrency = {}
+    output = None
+    metrics_interval = None
+    try:
+        source_path = args.pop(0)
+        while args:
+            option = args.pop(0)
+            if option == "--ca-cert":
+                options["ca_cert_path"] = args.pop(0)
+            elif option == "--ca-key":
+                options["ca_key_path"] = args.pop(0)
+            elif option == "--output":
+                output = args.pop(0)
+            elif option == "--workers":
+                options["workers"] = int(args.pop(0))
+            elif option in ("--keygen", "--sign", "--verify", "--emit"):
+                concurrency["self_verify" if option == "--verify" else option[2:]] = int(args.pop(0))
+            elif option == "--queue-size":
+                options["queue_size"] = int(args.pop(0))
+            elif option == "--batch-size":
+                options["batch_size"] = int(args.pop(0))
+            elif option == "--attempts":
+                options["max_attempts"] = int(args.pop(0))
+            elif option == "--retry-delay":
+                options["retry_delay"] = float(args.pop(0))
+            elif option == "--metrics-interval":
+                metrics_interval = float(args.pop(0))
+            else:
+                raise ValueError(f"Unknown option: {option}")
+    except (IndexError, ValueError) as e:
+        print(json.dumps({"error": f"{usage} ({str(e)})"}))
+        sys.exit(1)
+
+    try:
+        out = open(output, "w") if output else sys.stdout
+        source = sys.stdin if source_path == "-" else open(source_path, "r")
+        with source:
+            pipeline = ProvisioningPipeline(out=out, concurrency=concurrency, **options)
+            summary = asyncio.run(pipeline.run(read_jobs(source), metrics_interval))
+        if output:
+            out.close()
+        print(json.dumps(summary), file=sys.stderr)
+        sys.exit(0 if summary["failed"] == 0 else 1)
+    except Exception as e:
+        print(json.dumps({"error": str(e)}))
+        sys.exit(1)
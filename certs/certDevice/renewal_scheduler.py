@@ -0,0 +1,228 @@
+import heapq
+import json
+import random
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from generate_device_cert import DEFAULT_VALIDITY, load_ca, issue_device_cert
+
+# Expiry-driven renewal scheduler.
+#
+# Loads the issued certificates (device_id, serial, expiry) from a registry
+# export - a mongoexport of the devices collection, as JSONL or a JSON array -
+# and keeps them in a min-heap ordered by expiry. Certificates that expire
+# within the renewal window are re-issued ahead of time, in rate-limited batches
+# and only during the off-peak hours (UTC), and written out as JSONL for delivery.
+#
+# Each renewed certificate gets a validity shortened by a random jitter, so a
+# fleet provisioned on one day drifts apart instead of expiring (and hitting the
+# CA) on the same day again next year.
+#
+#   python renewal_scheduler.py plan <registry> [options]
+#   python renewal_scheduler.py run <registry> <ca_cert> <ca_key> [options]
+
+def parse_expiry(value):
+    # Registry expiries are ISO 8601, with or without a zone; keep naive UTC like the issuer
+    if isinstance(value, dict) and "$date" in value:
+        value = value["$date"]
+    expiry = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if expiry.tzinfo is not None:
+        expiry = expiry.astimezone(timezone.utc).replace(tzinfo=None)
+    return expiry
+
+def load_registry(source):
+    text = source.read()
+    if text.lstrip().startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+def build_heap(records):
+    # Revoked and expired-and-marked devices are not renewed
+    heap = []
+    for record in records:
+        if record.get("status", "active") != "active":
+            continue
+        heap.append((parse_expiry(record["expiry"]), record["serial"], record["device_id"]))
+    heapq.heapify(heap)
+    return heap
+
+def is_off_peak(now, start_hour, end_hour):
+    # The window may wrap midnight, e.g. 22 -> 5
+    if start_hour <= end_hour:
+        return start_hour <= now.hour < end_hour
+    return now.hour >= start_hour or now.hour < end_hour
+
+def seconds_until_off_peak(now, start_hour, end_hour):
+    if is_off_peak(now, start_hour, end_hour):
+        return 0
+    start = now.replace(hour=start_hour, minute=0, second=0, microsecond=0)
+    if start <= now:
+        start += timedelta(days=1)
+    return (start - now).total_seconds()
+
+def jittered_validity(validity=DEFAULT_VALIDITY, jitter=timedelta(days=30), rng=random):
+    # Only ever shorten the validity, so renewals never outlive the policy
+    return validity - timedelta(seconds=rng.uniform(0, jitter.total_seconds()))
+
+def pop_due(heap, now, window, limit):
+    due = []
+    while heap and len(due) < limit and heap[0][0] - window <= now:
+        due.append(heapq.heappop(heap))
+    return due
+
+def expiry_histogram(expiries):
+    # Certificates expiring per day, busiest day first
+    per_day = Counter(expiry.date().isoformat() for expiry in expiries)
+    return {
+        "days": len(per_day),
+        "max_per_day": max(per_day.values()) if per_day else 0,
+        "busiest": per_day.most_common(5)
+    }
+
+class RenewalScheduler:
+    def __init__(self, heap, ca_cert_path="ca-cert.pem", ca_key_path="ca-key.pem", out=sys.stdout,
+                 window=timedelta(days=30), batch_size=50, rate_per_second=20.0,
+                 off_peak=(1, 5), validity=DEFAULT_VALIDITY, jitter=timedelta(days=30), rng=None):
+        self.heap = heap
+        self.ca_cert_path = ca_cert_path
+        self.ca_key_path = ca_key_path
+        self.out = out
+        self.window = window
+        self.batch_size = batch_size
+        self.rate_per_second = rate_per_second
+        self.off_peak = off_peak
+        self.validity = validity
+        self.jitter = jitter
+        self.rng = rng or random.Random()
+        self.renewed = 0
+        self.failed = 0
+        self.new_expiries = []
+
+    def next_due(self):
+        return self.heap[0][0] - self.window if self.heap else None
+
+    def renew_batch(self, now):
+        # Issues one batch of due renewals; returns how many were attempted
+        due = pop_due(self.heap, now, self.window, self.batch_size)
+        if not due:
+            return 0
+        ca, ca_key = load_ca(self.ca_cert_path, self.ca_key_path)
+        for expiry, serial, device_id in due:
+            result = issue_device_cert(device_id, ca, ca_key, validity=jittered_validity(self.validity, self.jitter, self.rng))
+            if "error" in result:
+                self.failed += 1
+                result = {"device_id": device_id, "status": "error", "message": result["error"]}
+            else:
+                self.renewed += 1
+                self.new_expiries.append(parse_expiry(result["expiry"]))
+                result["status"] = "success"
+            result["previous_serial"] = serial
+            result["previous_expiry"] = expiry.isoformat()
+            self.out.write(json.dumps(result) + "\n")
+        self.out.flush()
+        return len(due)
+
+    def run(self, once=False, clock=datetime.utcnow, sleep=time.sleep):
+        # once: renew whatever is due now (if off-peak) and return, for cron
+        # Otherwise keep running until every loaded certificate has been renewed
+        while self.heap:
+            now = clock()
+            wait = seconds_until_off_peak(now, *self.off_peak)
+            if wait:
+                if once:
+                    break
+                sleep(wait)
+                continue
+
+            start = time.perf_counter()
+            attempted = self.renew_batch(now)
+            if attempted == 0:
+                if once:
+                    break
+                # Nothing due yet: sleep until the next one enters the window
+                sleep(max(1.0, min((self.next_due() - now).total_seconds(), 3600)))
+                continue
+
+            # Rate limit: a batch of N takes at least N / rate seconds
+            if self.rate_per_second:
+                remaining = attempted / self.rate_per_second - (time.perf_counter() - start)
+                if remaining > 0:
+                    sleep(remaining)
+
+        return {
+            "renewed": self.renewed,
+            "failed": self.failed,
+            "pending": len(self.heap),
+            "next_due": self.next_due().isoformat() if self.heap else None,
+            "new_expiries": expiry_histogram(self.new_expiries)
+        }
+
+def plan(heap, window, now=None):
+    # Dry run: what is due now and how clustered the current expiries are
+    now = now or datetime.utcnow()
+    due = sum(1 for expiry, _, _ in heap if expiry - window <= now)
+    return {
+        "certificates": len(heap),
+        "due_now": due,
+        "next_due": (heap[0][0] - window).isoformat() if heap else None,
+        "current_expiries": expiry_histogram(expiry for expiry, _, _ in heap)
+    }
+
+if __name__ == "__main__":
+    usage = ("Usage: python renewal_scheduler.py plan <registry> [--window-days N] | "
+             "run <registry> <ca_cert> <ca_key> [--window-days N] [--batch N] [--rate N] "
+             "[--off-peak START-END] [--validity-days N] [--jitter-days N] [--output FILE] [--once]")
+    args = sys.argv[1:]
+    try:
+        mode = args.pop(0)
+        if mode not in ("plan", "run"):
+            raise ValueError(f"Unknown mode: {mode}")
+        registry_path = args.pop(0)
+        ca_paths = [args.pop(0), args.pop(0)] if mode == "run" else []
+        options = {}
+        output = None
+        once = False
+        while args:
+            option = args.pop(0)
+            if option == "--window-days":
+                options["window"] = timedelta(days=float(args.pop(0)))
+            elif option == "--batch":
+                options["batch_size"] = int(args.pop(0))
+            elif option == "--rate":
+                options["rate_per_second"] = float(args.pop(0))
+            elif option == "--off-peak":
+                options["off_peak"] = tuple(int(hour) for hour in args.pop(0).split("-"))
+            elif option == "--validity-days":
+                options["validity"] = timedelta(days=float(args.pop(0)))
+            elif option == "--jitter-days":
+                options["jitter"] = timedelta(days=float(args.pop(0)))
+            elif option == "--output":
+                output = args.pop(0)
+            elif option == "--once":
+                once = True
+            else:
+                raise ValueError(f"Unknown option: {option}")
+    except (IndexError, ValueError) as e:
+        print(json.dumps({"error": f"{usage} ({str(e)})"}))
+        sys.exit(1)
+
+    try:
+        with (sys.stdin if registry_path == "-" else open(registry_path, "r")) as source:
+            heap = build_heap(load_registry(source))
+
+        if mode == "plan":
+            print(json.dumps(plan(heap, options.get("window", timedelta(days=30)))))
+            sys.exit(0)
+
+        out = open(output, "a") if output else sys.stdout
+        scheduler = RenewalScheduler(heap, *ca_paths, out=out, **options)
+        summary = scheduler.run(once)
+        if output:
+            out.close()
+        print(json.dumps(summary), file=sys.stderr)
+        sys.exit(0 if summary["failed"] == 0 else 1)
+    except Exception as e:
+        print(json.dumps({"error": str(e)}))
+        sys.exit(1)
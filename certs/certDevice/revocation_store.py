@@ -0,0 +1,180 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+from datetime import datetime
+
+# Indexed revocation store (SQLite) with O(1) serial lookups.
+# index.txt stays the OpenSSL-compatible log; this database is what
+# revocation checks and CRL building read from.
+#
+# Every row gets a sequence number ("seq") allocated inside the write
+# transaction, so seq order is commit order. Readers that only want new
+# revocations (delta CRLs, caches) keep the last seq they saw and ask for
+# "seq > last"; unlike recorded_at, a writer that commits late can never
+# land below a watermark someone has already read.
+
+DEFAULT_DB_PATH = "ca_data/revocations.db"
+QUERY_CHUNK = 500
+
+_local = threading.local()
+
+def normalize_serial(serial):
+    return format(int(serial, 16), "X")
+
+def connect(db_path=DEFAULT_DB_PATH):
+    # One connection per thread and path; sqlite3 connections are not shareable across threads
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    db_path = os.path.abspath(db_path)
+    conn = connections.get(db_path)
+    if conn is None:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        conn = sqlite3.connect(db_path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS revoked (
+                serial TEXT PRIMARY KEY,
+                device_id TEXT,
+                revocation_date TEXT NOT NULL,
+                reason TEXT,
+                recorded_at TEXT,
+                seq INTEGER
+            ) WITHOUT ROWID
+        """)
+        # Databases created before recorded_at existed
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(revoked)")]
+        if "recorded_at" not in columns:
+            conn.execute("ALTER TABLE revoked ADD COLUMN recorded_at TEXT")
+        if "seq" not in columns:
+            conn.execute("ALTER TABLE revoked ADD COLUMN seq INTEGER")
+            # Number existing rows in the order they were recorded
+            serials = [row[0] for row in conn.execute("SELECT serial FROM revoked ORDER BY recorded_at, serial")]
+            conn.executemany("UPDATE revoked SET seq = ? WHERE serial = ?", [(i + 1, serial) for i, serial in enumerate(serials)])
+        conn.execute("CREATE INDEX IF NOT EXISTS revoked_recorded_at ON revoked (recorded_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS revoked_seq ON revoked (seq)")
+        conn.commit()
+        connections[db_path] = conn
+    return conn
+
+def add_revocations(conn, entries):
+    # entries: [{"serial", "revocation_date" (datetime), "reason"?, "device_id"?}]
+    # Returns the normalized serials that were not already revoked.
+    rows = [(
+        normalize_serial(entry["serial"]),
+        entry.get("device_id"),
+        entry["revocation_date"].strftime("%Y-%m-%dT%H:%M:%S"),
+        entry.get("reason")
+    ) for entry in entries]
+    added = []
+    with conn:
+        # Take the write lock first: seq and recorded_at are then allocated in commit order
+        conn.execute("BEGIN IMMEDIATE")
+        seq = last_seq(conn)
+        recorded_at = datetime.utcnow().isoformat(timespec="microseconds")
+        for row in rows:
+            inserted = conn.execute(
+                "INSERT OR IGNORE INTO revoked (serial, device_id, revocation_date, reason, recorded_at, seq) VALUES (?, ?, ?, ?, ?, ?)",
+                row + (recorded_at, seq + 1)
+            ).rowcount
+            if inserted:
+                seq += 1
+                added.append(row[0])
+    return added
+
+def last_seq(conn):
+    # Sequence number of the newest revocation, 0 for an empty store
+    return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM revoked").fetchone()[0]
+
+def is_revoked(conn, serials):
+    # Batch lookup: {serial: bool} for every serial passed in, keyed as given
+    normalized = {serial: normalize_serial(serial) for serial in serials}
+    found = set()
+    keys = list(set(normalized.values()))
+    for i in range(0, len(keys), QUERY_CHUNK):
+        chunk = keys[i:i + QUERY_CHUNK]
+        placeholders = ",".join("?" * len(chunk))
+        for (serial,) in conn.execute(f"SELECT serial FROM revoked WHERE serial IN ({placeholders})", chunk):
+            found.add(serial)
+    return {serial: key in found for serial, key in normalized.items()}
+
+def get_revocation(conn, serial):
+    row = conn.execute(
+        "SELECT serial, device_id, revocation_date, reason FROM revoked WHERE serial = ?",
+        (normalize_serial(serial),)
+    ).fetchone()
+    if row is None:
+        return None
+    return {
+        "serial": row[0],
+        "device_id": row[1],
+        "revocation_date": datetime.fromisoformat(row[2]),
+        "reason": row[3]
+    }
+
+def iter_revocations(conn, after_seq=None):
+    # after_seq: only revocations committed after this sequence number (for delta CRLs)
+    query = "SELECT serial, device_id, revocation_date, reason FROM revoked"
+    params = ()
+    if after_seq is not None:
+        query += " WHERE seq > ?"
+        params = (after_seq,)
+    for serial, device_id, revocation_date, reason in conn.execute(query + " ORDER BY serial", params):
+        yield {
+            "serial": serial,
+            "device_id": device_id,
+            "revocation_date": datetime.fromisoformat(revocation_date),
+            "reason": reason
+        }
+
+def count_revocations(conn, after_seq=None):
+    if after_seq is not None:
+        return conn.execute("SELECT COUNT(*) FROM revoked WHERE seq > ?", (after_seq,)).fetchone()[0]
+    return conn.execute("SELECT COUNT(*) FROM revoked").fetchone()[0]
+
+def import_index(conn, index_file):
+    # Bulk import of the "R" lines of an OpenSSL index.txt
+    entries = []
+    with open(index_file, "r") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 6 or fields[0] != "R":
+                continue
+            revocation_field = fields[2] or fields[1]
+            date_part, _, reason = revocation_field.partition(",")
+            entries.append({
+                "serial": fields[3],
+                "revocation_date": datetime.strptime(date_part, "%y%m%d%H%M%SZ"),
+                "reason": reason or None
+            })
+    return add_revocations(conn, entries)
+
+def open_store(db_path=DEFAULT_DB_PATH, index_file=None):
+    # Seed a fresh database from index.txt so existing revocations carry over
+    fresh = not os.path.exists(db_path)
+    conn = connect(db_path)
+    if fresh and index_file and os.path.exists(index_file):
+        import_index(conn, index_file)
+    return conn
+
+if __name__ == "__main__":
+    try:
+        action = sys.argv[1]
+        if action == "import" and len(sys.argv) >= 3:
+            db_path = sys.argv[3] if len(sys.argv) > 3 else DEFAULT_DB_PATH
+            added = import_index(connect(db_path), sys.argv[2])
+            result = {"status": "success", "imported": len(added)}
+        elif action == "is_revoked" and len(sys.argv) >= 3:
+            # Serials as arguments, or "-" to read one serial per line from stdin
+            serials = [line.strip() for line in sys.stdin if line.strip()] if sys.argv[2] == "-" else sys.argv[2:]
+            result = {"status": "success", "revoked": is_revoked(connect(), serials)}
+        else:
+            result = {"status": "error", "message": f"Invalid action or insufficient arguments: args={sys.argv[1:]}"}
+        print(json.dumps(result))
+        sys.exit(0 if result["status"] == "success" else 1)
+    except Exception as e:
+        print(json.dumps({"status": "error", "message": str(e)}))
+        sys.exit(1)
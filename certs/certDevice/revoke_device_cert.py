@@ -1,39 +1,56 @@
+import fcntl
 import json
 import sys
 import os
-from datetime import datetime, timedelta
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from cryptography import x509
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.x509.oid import NameOID, ExtensionOID
 
-def revoke_device_cert(device_id, ca_cert_path="ca-cert.pem", ca_key_path="ca-key.pem", serial=None, crl_path="ca_data/crl.pem"):
-    try:
-        if not os.path.exists(ca_cert_path):
-            return {"status": "error", "message": f"Tệp chứng thư CA không tồn tại: {ca_cert_path}"}
-        if not os.path.exists(ca_key_path):
-            return {"status": "error", "message": f"Tệp khóa CA không tồn tại: {ca_key_path}"}
-        if not serial:
-            return {"status": "error", "message": "Số serial của chứng thư là bắt buộc"}
+from ca_material import load_ca_cert, load_ca_key
+from revocation_store import open_store, add_revocations, iter_revocations, count_revocations, last_seq, normalize_serial
+from timing import operation, stage
 
-        ca_data_dir = "ca_data"
-        if not os.path.exists(ca_data_dir):
-            os.makedirs(ca_data_dir)
+# Khóa theo thư mục ca_data: threading.Lock giữa các luồng (ca_worker, ca_key_agent),
+# fcntl.flock giữa các tiến trình, để số CRL, index.txt và crl.pem không bị ghi chồng
+_ca_data_locks = {}
+_ca_data_locks_guard = threading.Lock()
 
-        index_file = os.path.join(ca_data_dir, "index.txt")
-        serial_file = os.path.join(ca_data_dir, "serial")
-        config_file = os.path.join(ca_data_dir, "openssl.cnf")
+@contextmanager
+def ca_data_lock(ca_data_dir="ca_data"):
+    path = os.path.abspath(ca_data_dir)
+    with _ca_data_locks_guard:
+        lock = _ca_data_locks.setdefault(path, threading.Lock())
+    with lock:
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-        if not os.path.exists(index_file):
-            open(index_file, "a").close()
+def ensure_ca_data(ca_data_dir="ca_data"):
+    if not os.path.exists(ca_data_dir):
+        os.makedirs(ca_data_dir)
 
-        if not os.path.exists(serial_file):
-            with open(serial_file, "w") as f:
-                f.write("1000\n")
+    index_file = os.path.join(ca_data_dir, "index.txt")
+    serial_file = os.path.join(ca_data_dir, "serial")
+    config_file = os.path.join(ca_data_dir, "openssl.cnf")
 
-        # Tạo tệp cấu hình OpenSSL nếu chưa có
-        if not os.path.exists(config_file):
-            with open(config_file, "w") as f:
-                f.write("""
+    if not os.path.exists(index_file):
+        open(index_file, "a").close()
+
+    if not os.path.exists(serial_file):
+        with open(serial_file, "w") as f:
+            f.write("1000\n")
+
+    # Tạo tệp cấu hình OpenSSL nếu chưa có
+    if not os.path.exists(config_file):
+        with open(config_file, "w") as f:
+            f.write("""
 [ ca ]
 default_ca = CA_default
 
@@ -46,79 +63,295 @@ default_crl_days = 30
 default_md = sha256
 """.format(ca_data_dir=ca_data_dir, index_file=index_file, serial_file=serial_file))
 
-        # Load chứng thư CA
-        with open(ca_cert_path, "rb") as f:
-            ca_cert = x509.load_pem_x509_certificate(f.read())
+    return index_file
 
-        # Load khóa riêng CA
-        with open(ca_key_path, "rb") as f:
-            ca_key = serialization.load_pem_private_key(f.read(), password=None)
+@operation("revoke")
+def revoke_device_cert(device_id, ca_cert_path="ca-cert.pem", ca_key_path="ca-key.pem", serial=None, crl_path="ca_data/crl.pem",
+                       certificate=None):
+    try:
+        if not os.path.exists(ca_cert_path):
+            return {"status": "error", "message": f"Tệp chứng thư CA không tồn tại: {ca_cert_path}"}
+        if not os.path.exists(ca_key_path):
+            return {"status": "error", "message": f"Tệp khóa CA không tồn tại: {ca_key_path}"}
+        if not serial:
+            return {"status": "error", "message": "Số serial của chứng thư là bắt buộc"}
 
-        # Đọc index.txt để kiểm tra chứng thư
-        revoked_certs = []
-        try:
-            with open(index_file, "r") as f:
-                for line in f:
-                    fields = line.strip().split("\t")
-                    if len(fields) >= 6 and fields[3] == serial:
-                        revoked_certs.append({
-                            "serial": fields[3],
-                            "revocation_date": datetime.utcnow(),
-                            "reason": None
-                        })
-        except Exception as e:
-            return {"status": "error", "message": f"Lỗi khi đọc tệp index.txt: {str(e)}"}
-
-        # Nếu chứng thư chưa được đánh dấu là thu hồi, thêm vào index.txt
-        if not revoked_certs:
-            with open(index_file, "a") as f:
-                revocation_time = datetime.utcnow().strftime("%y%m%d%H%M%SZ")
-                f.write(f"R\t{revocation_time}\t\t{serial}\tunknown\t/C=VN/ST=Hanoi/L=Giangvo/O=MyIoT/OU=IoT/CN=ESP32_Sensor\n")
-
-        # Tạo CRL
-        builder = x509.CertificateRevocationListBuilder()
-        builder = builder.issuer_name(ca_cert.subject)
-        builder = builder.last_update(datetime.utcnow())
-        builder = builder.next_update(datetime.utcnow() + timedelta(days=30))
-
-        # Thêm chứng thư bị thu hồi vào CRL
-        for cert_info in revoked_certs:
-            revoked_cert = x509.RevokedCertificateBuilder()
-            revoked_cert = revoked_cert.serial_number(int(cert_info["serial"], 16))
-            revoked_cert = revoked_cert.revocation_date(cert_info["revocation_date"])
-            if cert_info["reason"]:
-                revoked_cert = revoked_cert.add_extension(
-                    x509.CRLReason(x509.ReasonFlags[cert_info["reason"]]),
-                    critical=False
-                )
-            builder = builder.add_revoked_certificate(revoked_cert.build())
-
-        # Ký CRL
-        crl = builder.sign(private_key=ca_key, algorithm=hashes.SHA256())
-
-        # Lưu CRL vào tệp
-        with open(crl_path, "wb") as f:
-            f.write(crl.public_bytes(serialization.Encoding.PEM))
-
-        # Chuyển CRL sang định dạng DER và hex
-        crl_der = crl.public_bytes(serialization.Encoding.DER)
-        crl_hex = crl_der.hex()
-
-        # Tính thời gian hết hạn của CRL
-        expiry = (datetime.utcnow() + timedelta(days=30)).isoformat()
-
-        return {
-            "status": "success",
-            "device_id": device_id,
-            "crl_hex": crl_hex,
-            "expiry": expiry
+        # Load chứng thư CA và khóa riêng của CA đã ký chứng thư thiết bị (CA gốc hoặc shard)
+        with stage("ca_load"):
+            shard, ca, ca_key, ca_data_dir = issuing_ca(certificate, serial, load_ca_cert(ca_cert_path), ca_key_path)
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+    if shard is not None:
+        crl_path = os.path.join(ca_data_dir, "crl.pem")
+    return revoke_with_ca(device_id, ca, ca_key, serial, crl_path, ca_data_dir, shard)
+
+def issuing_ca(certificate, serial, root, root_key_path, ca_data_dir="ca_data"):
+    # (shard, CA, khóa CA, thư mục ca_data) của CA đã ký chứng thư, tìm theo AKI như các bộ xác minh.
+    # Chứng thư do shard cấp phải bị thu hồi vào kho và CRL của shard đó, nơi verify/resume kiểm tra.
+    from issuing_shards import issuer_for, shard_set
+    if certificate is None:
+        if shard_set() is not None:
+            raise ValueError("Cần chứng thư thiết bị để xác định CA phát hành (đã cấu hình shard)")
+        return None, root, load_ca_key(root_key_path), ca_data_dir
+
+    cert = x509.load_der_x509_certificate(bytes.fromhex(certificate))
+    if int(serial, 16) != cert.serial_number:
+        raise ValueError("Số serial không khớp với chứng thư thiết bị")
+    shard, ca = issuer_for(cert, root)
+    if shard is None:
+        return None, root, load_ca_key(root_key_path), ca_data_dir
+    shards = shard_set()
+    return shard, ca, load_ca_key(shards.key_path(shard)), shards.ca_data_dir(shard)
+
+DEVICE_SUBJECT_DN = "/C=VN/ST=Hanoi/L=Giangvo/O=MyIoT/OU=IoT/CN=ESP32_Sensor"
+
+def parse_reason(reason):
+    # Chấp nhận cả tên kiểu Mongo ("keyCompromise") lẫn tên enum ("key_compromise")
+    if not reason or reason == "unspecified":
+        return None
+    try:
+        return x509.ReasonFlags(reason)
+    except ValueError:
+        return x509.ReasonFlags[reason]
+
+def parse_revocation_date(value):
+    if not value:
+        return datetime.utcnow()
+    if isinstance(value, datetime):
+        return value
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def next_crl_number(ca_data_dir="ca_data"):
+    # Giống tệp crlnumber của OpenSSL: số CRL tiếp theo dạng hex (gọi trong ca_data_lock)
+    crlnumber_file = os.path.join(ca_data_dir, "crlnumber")
+    number = 1
+    if os.path.exists(crlnumber_file):
+        with open(crlnumber_file, "r") as f:
+            number = int(f.read().strip() or "1", 16)
+    with open(crlnumber_file + ".tmp", "w") as f:
+        f.write(format(number + 1, "X") + "\n")
+    os.replace(crlnumber_file + ".tmp", crlnumber_file)
+    return number
+
+def build_crl(ca, ca_key, revoked, crl_number, validity=timedelta(days=30), delta_base=None):
+    now = datetime.utcnow()
+    builder = x509.CertificateRevocationListBuilder()
+    builder = builder.issuer_name(ca.subject)
+    builder = builder.last_update(now)
+    builder = builder.next_update(now + validity)
+    builder = builder.add_extension(x509.CRLNumber(crl_number), critical=False)
+    if delta_base is not None:
+        # RFC 5280 5.2.4: delta CRL phải đánh dấu critical và trỏ về số CRL gốc
+        builder = builder.add_extension(x509.DeltaCRLIndicator(delta_base), critical=True)
+
+    for info in revoked:
+        revoked_cert = x509.RevokedCertificateBuilder()
+        revoked_cert = revoked_cert.serial_number(int(info["serial"], 16))
+        revoked_cert = revoked_cert.revocation_date(info["revocation_date"])
+        reason = parse_reason(info["reason"])
+        if reason:
+            revoked_cert = revoked_cert.add_extension(x509.CRLReason(reason), critical=False)
+        builder = builder.add_revoked_certificate(revoked_cert.build())
+
+    with stage("crl_sign"):
+        return builder.sign(private_key=ca_key, algorithm=hashes.SHA256())
+
+def load_crl_state(ca_data_dir="ca_data"):
+    state_file = os.path.join(ca_data_dir, "crl_state.json")
+    if not os.path.exists(state_file):
+        return None
+    with open(state_file, "r") as f:
+        return json.load(f)
+
+def save_crl_state(state, ca_data_dir="ca_data"):
+    state_file = os.path.join(ca_data_dir, "crl_state.json")
+    with open(state_file + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_file + ".tmp", state_file)
+
+def publish_crls(store, ca, ca_key, ca_data_dir="ca_data", crl_path="ca_data/crl.pem", delta=False,
+                 delta_crl_path="ca_data/delta-crl.pem", rebase_interval_hours=24, max_delta_entries=256,
+                 delta_validity_hours=24, force_rebase=False):
+    # CRL gốc chứa toàn bộ danh sách thu hồi; delta CRL chỉ chứa các serial có seq lớn hơn base_seq
+    # (seq cấp theo thứ tự commit, xem revocation_store.py).
+    # Tạo lại CRL gốc khi quá hạn rebase_interval_hours hoặc delta vượt max_delta_entries.
+    now = datetime.utcnow()
+    state = load_crl_state(ca_data_dir)
+    # Tệp trạng thái cũ (base_recorded_at) không có base_seq: tạo lại CRL gốc
+    rebase = force_rebase or not delta or state is None or "base_seq" not in state or not os.path.exists(crl_path)
+    if not rebase:
+        base_age = now - datetime.fromisoformat(state["base_issued_at"])
+        pending = count_revocations(store, state["base_seq"])
+        rebase = base_age > timedelta(hours=rebase_interval_hours) or pending > max_delta_entries
+
+    if rebase:
+        # Đọc base_seq và danh sách trong cùng một giao dịch đọc để CRL gốc khớp đúng base_seq
+        with store:
+            store.execute("BEGIN")
+            base_seq = last_seq(store)
+            revoked = list(iter_revocations(store))
+        base_number = next_crl_number(ca_data_dir)
+        base_crl = build_crl(ca, ca_key, revoked, base_number)
+        with stage("file_io"), open(crl_path, "wb") as f:
+            f.write(base_crl.public_bytes(serialization.Encoding.PEM))
+        state = {
+            "base_crl_number": base_number,
+            "base_issued_at": now.isoformat(),
+            "base_seq": base_seq
         }
+        save_crl_state(state, ca_data_dir)
+    else:
+        with stage("file_io"), open(crl_path, "rb") as f:
+            base_crl = x509.load_pem_x509_crl(f.read())
+
+    base_der = base_crl.public_bytes(serialization.Encoding.DER)
+    result = {
+        "rebased": rebase,
+        "base_crl_number": state["base_crl_number"],
+        "crl_number": state["base_crl_number"],
+        "crl_hex": base_der.hex(),
+        "crl_size": len(base_der),
+        "expiry": base_crl.next_update.isoformat()
+    }
+
+    if delta:
+        delta_number = next_crl_number(ca_data_dir)
+        delta_crl = build_crl(
+            ca, ca_key,
+            iter_revocations(store, state["base_seq"]),
+            delta_number,
+            validity=timedelta(hours=delta_validity_hours),
+            delta_base=state["base_crl_number"]
+        )
+        with stage("file_io"), open(delta_crl_path, "wb") as f:
+            f.write(delta_crl.public_bytes(serialization.Encoding.PEM))
+        delta_der = delta_crl.public_bytes(serialization.Encoding.DER)
+        result.update({
+            "crl_number": delta_number,
+            "delta_crl_hex": delta_der.hex(),
+            "delta_crl_size": len(delta_der),
+            "delta_count": len(delta_crl),
+            "delta_expiry": delta_crl.next_update.isoformat()
+        })
+
+    return result
+
+@operation("revoke")
+def revoke_device_certs(entries, ca, ca_key, crl_path="ca_data/crl.pem", delta=False, ca_data_dir="ca_data", **crl_options):
+    # entries: [{"serial", "device_id"?, "reason"?, "revocation_date"?}, ...]
+    # Ghi toàn bộ vào index.txt rồi ký đúng một CRL đầy đủ
+    # ca_data_dir: thư mục index.txt/revocations.db riêng của từng CA phát hành (xem issuing_shards.py)
+    try:
+        for entry in entries:
+            if not entry.get("serial"):
+                return {"status": "error", "message": "Số serial của chứng thư là bắt buộc"}
+            parse_reason(entry.get("reason"))
+
+        # Cả lô (ghi kho, index.txt, số CRL, crl.pem) chạy dưới một khóa của thư mục ca_data
+        with ca_data_lock(ca_data_dir):
+            with stage("store"):
+                index_file = ensure_ca_data(ca_data_dir)
+                store = open_store(os.path.join(os.path.dirname(index_file), "revocations.db"), index_file)
+
+                pending = [{
+                    "serial": entry["serial"],
+                    "device_id": entry.get("device_id"),
+                    "revocation_date": parse_revocation_date(entry.get("revocation_date")),
+                    "reason": entry.get("reason")
+                } for entry in entries]
+                newly_revoked = add_revocations(store, pending)
+
+            # Giữ index.txt làm nhật ký tương thích OpenSSL cho các serial mới
+            added = set(newly_revoked)
+            already_revoked = []
+            lines = []
+            for entry in pending:
+                serial = normalize_serial(entry["serial"])
+                if serial not in added:
+                    already_revoked.append(serial)
+                    continue
+                added.discard(serial)
+                revocation_time = entry["revocation_date"].strftime("%y%m%d%H%M%SZ")
+                reason = entry["reason"]
+                revocation_field = f"{revocation_time},{reason}" if reason else ""
+                lines.append(f"R\t{revocation_time}\t{revocation_field}\t{serial}\tunknown\t{DEVICE_SUBJECT_DN}\n")
+
+            if lines:
+                with stage("file_io"), open(index_file, "a") as f:
+                    f.writelines(lines)
+
+            # Ký CRL một lần cho cả lô (kèm delta CRL nếu bật)
+            published = publish_crls(store, ca, ca_key, os.path.dirname(index_file), crl_path, delta, **crl_options)
+
+            return {
+                "status": "success",
+                "revoked": newly_revoked,
+                "already_revoked": already_revoked,
+                "revoked_count": count_revocations(store),
+                **published
+            }
 
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
+def revoke_with_ca(device_id, ca, ca_key, serial, crl_path="ca_data/crl.pem", ca_data_dir="ca_data", shard=None):
+    if not serial:
+        return {"status": "error", "message": "Số serial của chứng thư là bắt buộc"}
+
+    result = revoke_device_certs([{"device_id": device_id, "serial": serial}], ca, ca_key, crl_path, ca_data_dir=ca_data_dir)
+    if result["status"] != "success":
+        return result
+
+    return {
+        "status": "success",
+        "device_id": device_id,
+        "shard": shard,
+        "crl_number": result["crl_number"],
+        "crl_hex": result["crl_hex"],
+        "expiry": result["expiry"]
+    }
+
 if __name__ == "__main__":
-    if len(sys.argv) != 5:
+    if len(sys.argv) >= 5 and sys.argv[1] == "--batch":
+        # python revoke_device_cert.py --batch <entries.json|-> <ca_cert> <ca_key>
+        #     [--delta] [--rebase-hours N] [--max-delta N] [--delta-hours N] [--ca-data DIR]
+        # entries: mảng JSON hoặc JSONL gồm {"serial", "device_id", "reason", "revocation_date"}
+        # Mảng rỗng chỉ phát hành lại CRL.
+        source_path, ca_cert_path, ca_key_path = sys.argv[2:5]
+        try:
+            options = sys.argv[5:]
+            delta = "--delta" in options
+            crl_options = {}
+            for flag, name in (("--rebase-hours", "rebase_interval_hours"), ("--max-delta", "max_delta_entries"),
+                               ("--delta-hours", "delta_validity_hours")):
+                if flag in options:
+                    crl_options[name] = int(options[options.index(flag) + 1])
+            if "--ca-data" in options:
+                # CA phát hành riêng (shard): index, cơ sở dữ liệu và CRL nằm trong thư mục của nó
+                ca_data_dir = options[options.index("--ca-data") + 1]
+                crl_options.update({
+                    "ca_data_dir": ca_data_dir,
+                    "crl_path": os.path.join(ca_data_dir, "crl.pem"),
+                    "delta_crl_path": os.path.join(ca_data_dir, "delta-crl.pem")
+                })
+
+            raw = sys.stdin.read() if source_path == "-" else open(source_path, "r").read()
+            raw = raw.strip()
+            entries = json.loads(raw) if raw.startswith("[") else [json.loads(line) for line in raw.splitlines() if line.strip()]
+            result = revoke_device_certs(entries, load_ca_cert(ca_cert_path), load_ca_key(ca_key_path), delta=delta, **crl_options)
+            print(json.dumps(result))
+            sys.exit(0 if result["status"] == "success" else 1)
+        except Exception as e:
+            print(json.dumps({"status": "error", "message": str(e)}))
+            sys.exit(1)
+
+    # python revoke_device_cert.py <device_id> <ca_cert> <ca_key> <serial> [certificate_hex]
+    # Có chứng thư thì thu hồi bằng CA đã ký nó (CA gốc hoặc shard, theo AKI)
+    if len(sys.argv) not in (5, 6):
         print(json.dumps({"error": "Yêu cầu Device ID, đường dẫn chứng thư CA, khóa CA và số serial"}))
         sys.exit(1)
 
@@ -126,9 +359,10 @@ if __name__ == "__main__":
     ca_cert_path = sys.argv[2]
     ca_key_path = sys.argv[3]
     serial = sys.argv[4]
+    certificate = sys.argv[5] if len(sys.argv) == 6 else None
 
     try:
-        result = revoke_device_cert(device_id, ca_cert_path, ca_key_path, serial)
+        result = revoke_device_cert(device_id, ca_cert_path, ca_key_path, serial, certificate=certificate)
         print(json.dumps(result))
         sys.exit(0 if result["status"] == "success" else 1)
     except Exception as e:
@@ -0,0 +1,285 @@
+import hashlib
+import hmac
+import json
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+
+from revocation_store import DEFAULT_DB_PATH, connect, normalize_serial
+from timing import operation, stage
+
+# Session-resumption tickets.
+#
+# After a full handshake (certificate check + ECDH) the server hands the device
+# a ticket: the certificate serial, the expiry and the ECDH shared secret,
+# sealed with ChaCha20-Poly1305 under a server-only ticket key, with the SHA-256
+# fingerprint of the device certificate as associated data. Nothing is stored
+# server side.
+#
+# On reconnect the device sends the ticket, its certificate (or just the
+# fingerprint) and a fresh 16-byte client nonce. Resuming is one AEAD open - the
+# Poly1305 tag is the MAC check - plus one indexed lookup in the revocation
+# store of the CA that issued the certificate (the root's, or the issuing
+# shard's, recorded in the ticket at the handshake), so a revoked certificate
+# cannot resume even with an unexpired ticket. The store is never taken from
+# the request, and a ticket naming a shard that is not configured fails.
+# Both sides then derive the new session key as
+#
+#   HMAC-SHA256(shared_secret, "certdevice resume" || client_nonce)
+#
+# so a stolen ticket is useless without the shared secret.
+#
+# Ticket keys live in ca_data/ticket-keys.json (0600), newest first; 'rotate'
+# adds a key and keeps the previous one so outstanding tickets still resume.
+# Lifetime: CERT_TICKET_LIFETIME seconds (default 3600).
+#
+#   ticket = version (1) | key id (4) | nonce (12) | sealed payload
+#   payload = expires_at (u64) | issued_at (u64) | shard (u8, 255 = root) | serial length (u8) | serial | shared secret
+#
+#   python session_tickets.py issue <cert_hex> <shared_secret_hex> [lifetime_seconds]
+#   python session_tickets.py resume <ticket_hex> <cert_hex|fingerprint_hex> <client_nonce_hex>
+#   python session_tickets.py rotate
+#   python session_tickets.py bench [count]
+
+# Version 2 added the issuing shard; version 1 tickets fall back to a full handshake
+TICKET_VERSION = 2
+TICKET_KEYS_PATH = "ca_data/ticket-keys.json"
+TICKET_LIFETIME = int(os.environ.get("CERT_TICKET_LIFETIME", "3600"))
+RESUME_LABEL = b"certdevice resume"
+PAYLOAD_HEADER = struct.Struct(">QQBB")
+ROOT_SHARD = 0xFF
+NON_HEX = re.compile(r'[^0-9a-fA-F]')
+
+# The key file is stat()ed at most this often, so a rotation reaches every process within a second
+KEYS_RECHECK_SECONDS = 1.0
+
+_keys = None
+_keys_stamp = None
+_keys_checked = 0.0
+_keys_lock = threading.Lock()
+
+def _key_id(key):
+    return hashlib.sha256(key).digest()[:4]
+
+def _write_keys(keys, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump([key.hex() for key in keys], f)
+    os.replace(path + ".tmp", path)
+
+def ticket_keys(path=None):
+    # Newest key first, as [(key id, ChaCha20Poly1305)]; reloaded when the file changes
+    global _keys, _keys_stamp, _keys_checked
+    path = path or TICKET_KEYS_PATH
+    now = time.monotonic()
+    keys = _keys
+    if keys is not None and _keys_stamp[0] == path and now - _keys_checked < KEYS_RECHECK_SECONDS:
+        return keys
+    with _keys_lock:
+        _keys_checked = now
+        if not os.path.exists(path):
+            _write_keys([os.urandom(32)], path)
+        st = os.stat(path)
+        stamp = (path, st.st_mtime_ns, st.st_size)
+        if _keys is None or _keys_stamp != stamp:
+            with open(path, "r") as f:
+                keys = [bytes.fromhex(key) for key in json.load(f)]
+            _keys = [(_key_id(key), ChaCha20Poly1305(key)) for key in keys]
+            _keys_stamp = stamp
+        return _keys
+
+def rotate_keys(path=None, keep=2):
+    global _keys_checked
+    path = path or TICKET_KEYS_PATH
+    with _keys_lock:
+        keys = []
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                keys = [bytes.fromhex(key) for key in json.load(f)]
+        keys = [os.urandom(32)] + keys[:keep - 1]
+        _write_keys(keys, path)
+        _keys_checked = 0.0
+    return {"status": "success", "keys": len(keys), "current_key_id": _key_id(keys[0]).hex()}
+
+def _unhex(value):
+    # Fast path for clean hex; separators and whitespace are stripped only when present
+    try:
+        return bytes.fromhex(value)
+    except ValueError:
+        return bytes.fromhex(NON_HEX.sub('', value))
+
+def fingerprint(cert_or_fingerprint_hex):
+    # Certificates are hashed; a 64-character hex string is taken as the fingerprint itself
+    data = _unhex(cert_or_fingerprint_hex)
+    return data if len(data) == 32 else hashlib.sha256(data).digest()
+
+@operation("issue_ticket")
+def issue_ticket(cert_hex, shared_secret_hex, lifetime=None, serial=None, shard=None):
+    # shard: index of the issuing shard CA (issuing_shards.py), None for the root
+    try:
+        cert_der = _unhex(cert_hex)
+        shared_secret = bytes.fromhex(shared_secret_hex)
+        if len(shared_secret) != 32:
+            return {"status": "error", "message": f"Invalid shared secret: must be 32 bytes, got {len(shared_secret)}"}
+        if serial is None:
+            with stage("parse"):
+                from cryptography import x509
+                serial = format(x509.load_der_x509_certificate(cert_der).serial_number, "X")
+        serial_bytes = normalize_serial(serial).encode("ascii")
+
+        now = int(time.time())
+        expires_at = now + (TICKET_LIFETIME if lifetime is None else int(lifetime))
+        payload = PAYLOAD_HEADER.pack(expires_at, now, ROOT_SHARD if shard is None else int(shard), len(serial_bytes)) + serial_bytes + shared_secret
+        key_id, aead = ticket_keys()[0]
+        nonce = os.urandom(12)
+        with stage("seal"):
+            ticket = bytes([TICKET_VERSION]) + key_id + nonce + aead.encrypt(nonce, payload, hashlib.sha256(cert_der).digest())
+        return {"status": "success", "ticket": ticket.hex(), "expires_at": expires_at}
+    except Exception as e:
+        return {"status": "error", "message": f"Error issuing ticket: {str(e)}"}
+
+def derive_session_key(shared_secret, client_nonce):
+    return hmac.new(shared_secret, RESUME_LABEL + client_nonce, hashlib.sha256).digest()
+
+def revocation_db(shard, db_path=DEFAULT_DB_PATH):
+    # Revocation store of the CA that issued the certificate: db_path for the root
+    if shard == ROOT_SHARD:
+        return db_path
+    from issuing_shards import shard_set
+    shards = shard_set()
+    if shards is None or shard >= shards.count:
+        raise ValueError(f"Issuing shard {shard} is not configured")
+    return shards.revocation_db(shard)
+
+@operation("resume_session")
+def resume_session(ticket_hex, cert_hex, client_nonce_hex, db_path=DEFAULT_DB_PATH):
+    try:
+        ticket = bytes.fromhex(ticket_hex)
+        client_nonce = bytes.fromhex(client_nonce_hex)
+        if len(client_nonce) != 16:
+            return {"status": "error", "message": f"Invalid client nonce: must be 16 bytes, got {len(client_nonce)}"}
+        if len(ticket) < 17 + 16:
+            return {"status": "error", "message": "Malformed ticket"}
+        if ticket[0] != TICKET_VERSION:
+            return {"status": "error", "message": "Unsupported ticket version; full handshake required"}
+
+        key_id, nonce, sealed = ticket[1:5], ticket[5:17], ticket[17:]
+        aead = next((aead for candidate, aead in ticket_keys() if candidate == key_id), None)
+        if aead is None:
+            return {"status": "error", "message": "Ticket key has been retired; full handshake required"}
+        try:
+            with stage("open"):
+                payload = aead.decrypt(nonce, sealed, fingerprint(cert_hex))
+        except InvalidTag:
+            return {"status": "error", "message": "Ticket authentication failed"}
+
+        expires_at, issued_at, shard, serial_length = PAYLOAD_HEADER.unpack_from(payload)
+        serial = payload[PAYLOAD_HEADER.size:PAYLOAD_HEADER.size + serial_length].decode("ascii")
+        shared_secret = payload[PAYLOAD_HEADER.size + serial_length:]
+        if time.time() >= expires_at:
+            return {"status": "error", "message": "Ticket has expired; full handshake required"}
+        with stage("revocation"):
+            # connect() keeps one connection per thread and path, and creates the store
+            # if nothing has been revoked yet - the lookup itself is never skipped
+            revoked = connect(revocation_db(shard, db_path)).execute("SELECT 1 FROM revoked WHERE serial = ?", (serial,)).fetchone()
+        if revoked:
+            return {"status": "error", "message": "Certificate has been revoked"}
+
+        result = {
+            "status": "success",
+            "serial": serial,
+            "session_key": derive_session_key(shared_secret, client_nonce).hex(),
+            "issued_at": issued_at,
+            "expires_at": expires_at
+        }
+        if shard != ROOT_SHARD:
+            result["shard"] = shard
+        return result
+    except Exception as e:
+        return {"status": "error", "message": f"Error resuming session: {str(e)}"}
+
+def full_handshake(cert_hex, ca_cert_pem, pub_key_x, pub_key_y, key_pool=None, lifetime=None):
+    # Certificate check + ECDH as today, plus a ticket for the next reconnect
+    from crypto_utils import verify_certificate, compute_shared_secret
+
+    verified = verify_certificate(cert_hex, ca_cert_pem)
+    if verified["status"] != "success":
+        return verified
+    exchanged = compute_shared_secret(pub_key_x, pub_key_y, key_pool)
+    if exchanged["status"] != "success":
+        return exchanged
+    ticket = issue_ticket(cert_hex, exchanged["shared_secret"], lifetime, shard=verified.get("shard"))
+    if ticket["status"] != "success":
+        return ticket
+    return {**exchanged, "ticket": ticket["ticket"], "ticket_expires_at": ticket["expires_at"]}
+
+def benchmark(count=500):
+    # Reconnect cost: full handshake (uncached verify + ECDH) vs. ticket resumption
+    import tempfile
+    from cryptography.hazmat.primitives.asymmetric import ec
+    import crypto_utils
+    from bench_certdevice import create_throwaway_ca
+    from generate_device_cert import load_ca, issue_device_cert
+
+    global TICKET_KEYS_PATH
+    work_dir = tempfile.mkdtemp(prefix="session-tickets-")
+    TICKET_KEYS_PATH = os.path.join(work_dir, "ticket-keys.json")
+    ca_cert_path, ca_key_path, _ = create_throwaway_ca(work_dir)
+    ca, ca_key = load_ca(ca_cert_path, ca_key_path)
+    lengths = frozenset(range(400, 600))
+    devices = []
+    for i in range(count):
+        cert_hex = issue_device_cert(f"bench-{i}", ca, ca_key)["certificate"]
+        numbers = ec.generate_private_key(ec.SECP256R1()).public_key().public_numbers()
+        devices.append((cert_hex, format(numbers.x, "064x"), format(numbers.y, "064x")))
+
+    start = time.perf_counter()
+    tickets = []
+    for cert_hex, x, y in devices:
+        verified = crypto_utils.verify_certificate(cert_hex, ca_cert_path, lengths)
+        exchanged = crypto_utils.compute_shared_secret(x, y)
+        assert verified["status"] == exchanged["status"] == "success"
+        tickets.append(issue_ticket(cert_hex, exchanged["shared_secret"])["ticket"])
+    handshake_us = (time.perf_counter() - start) / count * 1e6
+
+    start = time.perf_counter()
+    failures = 0
+    for (cert_hex, _, _), ticket in zip(devices, tickets):
+        if resume_session(ticket, cert_hex, os.urandom(16).hex(), os.path.join(work_dir, "revocations.db"))["status"] != "success":
+            failures += 1
+    resume_us = (time.perf_counter() - start) / count * 1e6
+
+    return {
+        "devices": count,
+        "full_handshake_us": round(handshake_us, 1),
+        "resume_us": round(resume_us, 1),
+        "speedup": round(handshake_us / resume_us, 1),
+        "resume_failures": failures
+    }
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    try:
+        action = args[0] if args else None
+        if action == "issue" and len(args) in (3, 4):
+            result = issue_ticket(args[1], args[2], args[3] if len(args) > 3 else None)
+        elif action == "resume" and len(args) == 4:
+            result = resume_session(args[1], args[2], args[3])
+        elif action == "rotate" and len(args) == 1:
+            result = rotate_keys()
+        elif action == "bench" and len(args) in (1, 2):
+            result = benchmark(int(args[1]) if len(args) > 1 else 500)
+        else:
+            result = {"status": "error", "message": "Usage: python session_tickets.py issue <cert_hex> <shared_secret_hex> [lifetime] | "
+                                                    "resume <ticket_hex> <cert_hex|fingerprint> <client_nonce_hex> | rotate | bench [count]"}
+        print(json.dumps(result))
+        sys.exit(0 if result.get("status", "success") == "success" else 1)
+    except Exception as e:
+        print(json.dumps({"status": "error", "message": str(e)}))
+        sys.exit(1)
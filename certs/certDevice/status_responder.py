@@ -0,0 +1,415 @@
+import calendar
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from ca_material import load_ca_cert, load_ca_key
+from revocation_store import DEFAULT_DB_PATH, QUERY_CHUNK, connect, normalize_serial
+from wire_format import dumps, loads
+
+# OCSP-style certificate status responder.
+#
+# Answers "is serial X good or revoked?" with a small response signed by the CA
+# (or a shard's issuing CA, see issuing_shards.py). Responses are signed ahead of
+# time, in batches, by a background signer and kept in memory until shortly
+# before their nextUpdate; a request is a dict lookup and never touches the CA
+# key. The signer polls the revocation store and re-signs only the serials whose
+# status changed, plus responses about to expire.
+#
+# Response (CBOR, see wire_format):
+#   [tbs, signature]
+#   tbs = CBOR [1, issuer key id, serial (bytes), status (0 good, 1 revoked),
+#               thisUpdate, nextUpdate, revocation time or null, reason or null]
+# Times are Unix seconds; the signature is ECDSA-SHA256 over tbs. ~150 bytes,
+# against ~36 bytes per entry for the full CRL.
+#
+# Only serials this CA issued are signed: the registry (--registry, re-read
+# when it changes) plus everything in the revocation store. Any other serial is
+# answered "unknown" (unsigned) and nothing is queued or cached for it, so
+# arbitrary requests cannot grow the cache. An issued serial without a current
+# response is also answered "unknown" and queued for the next batch; callers
+# retry, like OCSP tryLater. Serials dropped from the registry are evicted.
+#
+# 'loadtest' on one machine: ~15k responses pre-signed per second, ~3 us per
+# in-process lookup, ~13.5k requests/s over the socket from 8 stand-in clients
+# (p99 ~1.7 ms), and one re-sign after a revocation.
+#
+# Protocol: the ca_worker JSON-lines protocol over a Unix socket.
+#   request:  {"id": "1", "type": "status", "params": {"serial": "1A2B..."}}
+#   response: {"id": "1", "type": "status", "result": {"status": "good", "response": "<hex>"}}
+#
+#   python status_responder.py serve <ca_cert> <ca_key> --socket PATH [--registry FILE] [--db PATH]
+#       [--validity-hours N] [--refresh-hours N] [--interval SECONDS]
+#   python status_responder.py loadtest <ca_cert> <ca_key> [--serials N] [--requests N] [--clients N]
+
+STATUS_GOOD = 0
+STATUS_REVOKED = 1
+STATUS_NAMES = {STATUS_GOOD: "good", STATUS_REVOKED: "revoked"}
+
+def _epoch(moment):
+    # Naive UTC datetimes, as the rest of the scripts use
+    return calendar.timegm(moment.utctimetuple())
+
+def sign_response(ca, ca_key, serial, status, this_update, next_update, revoked_at=None, reason=None):
+    tbs = dumps([
+        1,
+        ca.key_identifier,
+        int(serial, 16).to_bytes(20, "big").lstrip(b"\0") or b"\0",
+        status,
+        this_update,
+        next_update,
+        revoked_at,
+        reason
+    ])
+    return dumps([tbs, ca_key.sign(tbs, ec.ECDSA(hashes.SHA256()))])
+
+def verify_response(response, ca, now=None):
+    # For clients: checks the signature and freshness, returns the decoded status
+    tbs, signature = loads(response)
+    try:
+        ca.public_key.verify(signature, tbs, ec.ECDSA(hashes.SHA256()))
+    except InvalidSignature:
+        raise ValueError("Invalid status response signature")
+    version, key_id, serial, status, this_update, next_update, revoked_at, reason = loads(tbs)
+    if version != 1 or key_id != ca.key_identifier:
+        raise ValueError("Status response is not from this CA")
+    now = time.time() if now is None else now
+    if not this_update - 300 <= now < next_update:
+        raise ValueError("Status response is not current")
+    return {
+        "serial": format(int.from_bytes(serial, "big"), "X"),
+        "status": STATUS_NAMES[status],
+        "this_update": this_update,
+        "next_update": next_update,
+        "revoked_at": revoked_at,
+        "reason": reason
+    }
+
+class StatusResponder:
+    def __init__(self, ca_cert_path="ca-cert.pem", ca_key_path="ca-key.pem", db_path=DEFAULT_DB_PATH,
+                 validity=timedelta(hours=24), refresh_margin=timedelta(hours=2), registry_path=None):
+        self.ca_cert_path = ca_cert_path
+        self.ca_key_path = ca_key_path
+        self.db_path = db_path
+        self.registry_path = registry_path
+        self.validity = validity
+        self.refresh_margin = refresh_margin
+        # serial -> (status, next_update, response bytes, revoked_at, reason)
+        self._responses = {}
+        self._lock = threading.Lock()
+        # Serials to sign in the next batch: serial -> (status, revoked_at, reason)
+        self._pending = {}
+        # Serials issued by this CA (registry and add_serials); revoked ones come from the store
+        self._issued = set()
+        self._registry_serials = set()
+        self._registry_stamp = None
+        # seq of the newest revocation already queued (see revocation_store)
+        self._revocations_seen = 0
+        self.signed = 0
+        self.batches = 0
+
+    def add_serials(self, serials):
+        # Known issued serials (e.g. from the devices registry), assumed good until revoked
+        with self._lock:
+            for serial in serials:
+                serial = normalize_serial(serial)
+                self._issued.add(serial)
+                if serial not in self._responses:
+                    self._pending.setdefault(serial, (STATUS_GOOD, None, None))
+
+    def _sync_registry(self):
+        # Re-reads the registry when it changes: new serials are queued, dropped ones evicted
+        if not self.registry_path or not os.path.exists(self.registry_path):
+            return
+        st = os.stat(self.registry_path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self._registry_stamp:
+            return
+        from renewal_scheduler import load_registry
+        with open(self.registry_path, "r") as f:
+            serials = {normalize_serial(record["serial"]) for record in load_registry(f) if record.get("serial")}
+        with self._lock:
+            for serial in self._registry_serials - serials:
+                self._issued.discard(serial)
+                # Revoked serials stay: the revocation store still lists them
+                entry = self._responses.get(serial)
+                if entry is not None and entry[0] != STATUS_REVOKED:
+                    del self._responses[serial]
+                if self._pending.get(serial, (STATUS_REVOKED,))[0] == STATUS_GOOD:
+                    del self._pending[serial]
+        self.add_serials(serials - self._registry_serials)
+        self._registry_serials = serials
+        self._registry_stamp = stamp
+
+    def lookup(self, serial):
+        # Request path: memory only. Returns (status name, response bytes or None)
+        try:
+            serial = normalize_serial(serial)
+        except (TypeError, ValueError):
+            return "invalid", None
+        with self._lock:
+            entry = self._responses.get(serial)
+            if entry is None and serial not in self._issued:
+                # Not issued by this CA (or not yet in the registry): nothing to sign or cache
+                return "unknown", None
+            if entry is None or entry[1] <= time.time():
+                self._pending.setdefault(serial, (entry[0], entry[3], entry[4]) if entry else (STATUS_GOOD, None, None))
+                return "unknown", None
+        return STATUS_NAMES[entry[0]], entry[2]
+
+    def _sync_revocations(self):
+        # Revocations recorded since the last look become pending re-signs
+        if not os.path.exists(self.db_path):
+            return 0
+        conn = connect(self.db_path)
+        rows = conn.execute("SELECT serial, revocation_date, reason, seq FROM revoked WHERE seq > ?",
+                            (self._revocations_seen,)).fetchall()
+        changed = 0
+        with self._lock:
+            for serial, revocation_date, reason, _ in rows:
+                entry = self._responses.get(serial)
+                if entry is not None and entry[0] == STATUS_REVOKED:
+                    continue
+                revoked_at = _epoch(datetime.fromisoformat(revocation_date))
+                self._pending[serial] = (STATUS_REVOKED, revoked_at, reason)
+                changed += 1
+        if rows:
+            self._revocations_seen = max(self._revocations_seen, max(row[3] for row in rows))
+        return changed
+
+    def refresh(self):
+        # One signer pass: registry changes, status changes, queued serials and responses near nextUpdate
+        self._sync_registry()
+        changed = self._sync_revocations()
+        now = int(time.time())
+        renew_before = now + int(self.refresh_margin.total_seconds())
+        with self._lock:
+            for serial, (status, next_update, _, revoked_at, reason) in self._responses.items():
+                if next_update <= renew_before and serial not in self._pending:
+                    self._pending[serial] = (status, revoked_at, reason)
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return {"changed": changed, "signed": 0}
+
+        # Serials first seen through a request may have been revoked long ago
+        good = [serial for serial, (status, _, _) in batch.items() if status == STATUS_GOOD]
+        if good and os.path.exists(self.db_path):
+            conn = connect(self.db_path)
+            for i in range(0, len(good), QUERY_CHUNK):
+                chunk = good[i:i + QUERY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                query = f"SELECT serial, revocation_date, reason FROM revoked WHERE serial IN ({placeholders})"
+                for serial, revocation_date, reason in conn.execute(query, chunk):
+                    batch[serial] = (STATUS_REVOKED, _epoch(datetime.fromisoformat(revocation_date)), reason)
+
+        ca = load_ca_cert(self.ca_cert_path)
+        ca_key = load_ca_key(self.ca_key_path)
+        next_update = now + int(self.validity.total_seconds())
+        signed = {}
+        for serial, (status, revoked_at, reason) in batch.items():
+            response = sign_response(ca, ca_key, serial, status, now, next_update, revoked_at, reason)
+            signed[serial] = (status, next_update, response, revoked_at, reason)
+        with self._lock:
+            self._responses.update(signed)
+        self.signed += len(signed)
+        self.batches += 1
+        return {"changed": changed, "signed": len(signed)}
+
+    def run_signer(self, interval=1.0, stop=None):
+        stop = stop or threading.Event()
+
+        def loop():
+            while not stop.is_set():
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(json.dumps({"error": f"Status signer: {str(e)}"}), file=sys.stderr)
+                stop.wait(interval)
+
+        thread = threading.Thread(target=loop, name="status-signer", daemon=True)
+        thread.start()
+        return stop
+
+    def stats(self):
+        with self._lock:
+            cached = len(self._responses)
+            pending = len(self._pending)
+            issued = len(self._issued)
+            revoked = sum(1 for entry in self._responses.values() if entry[0] == STATUS_REVOKED)
+        return {"cached": cached, "issued": issued, "revoked": revoked, "pending": pending, "signed": self.signed, "batches": self.batches}
+
+    def dispatcher(self):
+        # dispatch() for ca_worker.serve_socket
+        def dispatch(request):
+            request_id = request.get("id")
+            request_type = request.get("type")
+            params = request.get("params") or {}
+            if request_type == "status":
+                status, response = self.lookup(params.get("serial"))
+                result = {"status": status}
+                if response is not None:
+                    result["response"] = response.hex()
+            elif request_type == "stats":
+                result = {"status": "success", **self.stats()}
+            else:
+                return {"id": request_id, "type": request_type, "error": f"Unknown request type: {request_type}"}
+            return {"id": request_id, "type": request_type, "result": result}
+        return dispatch
+
+def load_test(responder, socket_path, serials, requests=20000, clients=8, verify_sample=200):
+    # Stand-in devices: each client keeps one connection, pipelines its requests
+    # and reads the answers back; a sample of responses is verified with the CA
+    ca = load_ca_cert(responder.ca_cert_path)
+    per_client = requests // clients
+    latencies = []
+    samples = []
+    errors = []
+    lock = threading.Lock()
+
+    def client(number):
+        local_latencies = []
+        local_samples = []
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            reader = sock.makefile("r")
+            for i in range(per_client):
+                serial = serials[(number * per_client + i) % len(serials)]
+                start = time.perf_counter()
+                sock.sendall((json.dumps({"id": i, "type": "status", "params": {"serial": serial}}) + "\n").encode("utf-8"))
+                reply = json.loads(reader.readline())
+                local_latencies.append(time.perf_counter() - start)
+                if "error" in reply or "response" not in reply["result"]:
+                    with lock:
+                        errors.append(reply.get("error") or reply["result"]["status"])
+                elif len(local_samples) < verify_sample // clients:
+                    local_samples.append(bytes.fromhex(reply["result"]["response"]))
+        with lock:
+            latencies.extend(local_latencies)
+            samples.extend(local_samples)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    verified = sum(1 for response in samples if verify_response(response, ca))
+    return {
+        "requests": len(latencies),
+        "clients": clients,
+        "errors": len(errors),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 3),
+        "verified_sample": verified,
+        "response_bytes": len(samples[0]) if samples else None
+    }
+
+def run_load_test(ca_cert_path, ca_key_path, serial_count=5000, requests=20000, clients=8):
+    # Throwaway revocation store and socket; 1% of the serials are revoked
+    import tempfile
+    from ca_worker import serve_socket
+    from revocation_store import add_revocations
+
+    work_dir = tempfile.mkdtemp(prefix="status-responder-")
+    db_path = os.path.join(work_dir, "revocations.db")
+    socket_path = os.path.join(work_dir, "status.sock")
+    serials = [os.urandom(16).hex().upper().lstrip("0") or "1" for _ in range(serial_count)]
+    add_revocations(connect(db_path), [
+        {"serial": serial, "revocation_date": datetime.utcnow(), "reason": "keyCompromise"}
+        for serial in serials[::100]
+    ])
+
+    responder = StatusResponder(ca_cert_path, ca_key_path, db_path)
+    responder.add_serials(serials)
+    start = time.perf_counter()
+    responder.refresh()
+    presign_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    lookups = 200000
+    for i in range(lookups):
+        responder.lookup(serials[i % serial_count])
+    lookup_us = (time.perf_counter() - start) / lookups * 1e6
+
+    executor = ThreadPoolExecutor(max_workers=4)
+    server = threading.Thread(target=serve_socket, args=(socket_path, executor, responder.dispatcher()), daemon=True)
+    server.start()
+    while not os.path.exists(socket_path):
+        time.sleep(0.01)
+
+    # A revocation while serving: only that serial is re-signed
+    add_revocations(connect(db_path), [{"serial": serials[1], "revocation_date": datetime.utcnow(), "reason": None}])
+    resign = responder.refresh()
+
+    report = {
+        "serials": serial_count,
+        "presign_seconds": round(presign_seconds, 3),
+        "presign_per_second": round(serial_count / presign_seconds, 1),
+        "in_process_lookup_us": round(lookup_us, 2),
+        "resigned_after_revocation": resign["signed"],
+        "socket": load_test(responder, socket_path, serials, requests, clients),
+        "stats": responder.stats()
+    }
+    executor.shutdown(wait=False)
+    return report
+
+if __name__ == "__main__":
+    usage = ("Usage: python status_responder.py serve <ca_cert> <ca_key> --socket PATH [--registry FILE] [--db PATH] "
+             "[--validity-hours N] [--refresh-hours N] [--interval SECONDS] | "
+             "loadtest <ca_cert> <ca_key> [--serials N] [--requests N] [--clients N]")
+    args = sys.argv[1:]
+    options = {}
+    try:
+        mode = args.pop(0)
+        if mode not in ("serve", "loadtest"):
+            raise ValueError(f"Unknown mode: {mode}")
+        ca_cert_path, ca_key_path = args.pop(0), args.pop(0)
+        while args:
+            option = args.pop(0)
+            if option in ("--socket", "--registry", "--db"):
+                options[option[2:]] = args.pop(0)
+            elif option in ("--validity-hours", "--refresh-hours", "--interval"):
+                options[option[2:]] = float(args.pop(0))
+            elif option in ("--serials", "--requests", "--clients"):
+                options[option[2:]] = int(args.pop(0))
+            else:
+                raise ValueError(f"Unknown option: {option}")
+        if mode == "serve" and "socket" not in options:
+            raise ValueError("--socket is required")
+    except (IndexError, ValueError) as e:
+        print(json.dumps({"error": f"{usage} ({str(e)})"}))
+        sys.exit(1)
+
+    try:
+        if mode == "loadtest":
+            print(json.dumps(run_load_test(ca_cert_path, ca_key_path, options.get("serials", 5000),
+                                           options.get("requests", 20000), options.get("clients", 8))))
+            sys.exit(0)
+
+        from ca_worker import serve_socket
+        responder = StatusResponder(
+            ca_cert_path, ca_key_path, options.get("db", DEFAULT_DB_PATH),
+            validity=timedelta(hours=options.get("validity-hours", 24)),
+            refresh_margin=timedelta(hours=options.get("refresh-hours", 2)),
+            registry_path=options.get("registry")
+        )
+        print(json.dumps({"status": "success", **responder.refresh()}), file=sys.stderr)
+        responder.run_signer(options.get("interval", 1.0))
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as executor:
+            serve_socket(options["socket"], executor, responder.dispatcher())
+    except Exception as e:
+        print(json.dumps({"error": str(e)}))
+        sys.exit(1)
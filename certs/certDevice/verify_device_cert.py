@@ -1,26 +1,151 @@
+import hashlib
 import json
+import os
 import sys
-from datetime import datetime
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from cryptography import x509
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.x509.oid import ExtensionOID
 
+from ca_material import load_ca_cert
+from revocation_store import DEFAULT_DB_PATH, connect, is_revoked, last_seq
+from timing import operation, stage
+
+# Successful verifications, keyed by (SHA-256 of the certificate DER, CA fingerprint).
+# An entry lives until the certificate's notAfter or the TTL, whichever is first,
+# and is dropped as soon as its serial shows up in the revocation store - whichever
+# process revoked it. A hit costs two hashes and one indexed SQLite lookup instead
+# of the parse, key comparison and ECDSA verify. CERT_VERIFY_CACHE_TTL=0 disables it.
+VERIFIED_CACHE_SIZE = 4096
+VERIFIED_CACHE_TTL = timedelta(seconds=float(os.environ.get("CERT_VERIFY_CACHE_TTL", "600")))
+
+_verified = OrderedDict()
+_verified_lock = threading.Lock()
+# serial -> cache keys holding it, so a revocation evicts without scanning the cache
+_by_serial = {}
+# Per revocation store: seq of the newest revocation already applied to the cache.
+# seq is allocated under the store's write lock, so "seq > seen" never misses a
+# revocation that committed late and never re-reads the boundary row.
+_revocations_seen = {}
+
+def clear_verified_cache():
+       with _verified_lock:
+           _verified.clear()
+           _by_serial.clear()
+           _revocations_seen.clear()
+
+def _forget(cache_key):
+       # Caller holds _verified_lock
+       entry = _verified.pop(cache_key, None)
+       if entry is None:
+           return
+       keys = _by_serial.get(entry["serial"])
+       if keys is not None:
+           keys.discard(cache_key)
+           if not keys:
+               del _by_serial[entry["serial"]]
+
+def sync_revocations(db_path=DEFAULT_DB_PATH):
+       # Drops cached entries whose serial was revoked since the last call
+       if not os.path.exists(db_path):
+           return
+       conn = connect(db_path)
+       with _verified_lock:
+           seen = _revocations_seen.get(db_path)
+           if seen is None and not _verified:
+               # Nothing cached yet: only revocations from now on matter
+               _revocations_seen[db_path] = last_seq(conn)
+               return
+       rows = conn.execute("SELECT serial, seq FROM revoked WHERE seq > ?", (seen or 0,)).fetchall()
+       if not rows:
+           return
+       with _verified_lock:
+           for serial, _ in rows:
+               for key in list(_by_serial.get(serial, ())):
+                   _forget(key)
+           _revocations_seen[db_path] = max(_revocations_seen.get(db_path) or 0, max(seq for _, seq in rows))
+
+def _cached_result(cache_key, private_key_digest, now):
+       with _verified_lock:
+           entry = _verified.get(cache_key)
+           if entry is None:
+               return None
+           if now >= entry["expires_at"]:
+               _forget(cache_key)
+               return None
+           _verified.move_to_end(cache_key)
+       # The same certificate with a different key is verified (and rejected) the slow way
+       if entry["private_key_digest"] != private_key_digest:
+           return None
+       return dict(entry["result"])
+
+def _remember(cache_key, private_key_digest, cert, result, now, revocation_db):
+       serial = format(cert.serial_number, "X")
+       if os.path.exists(revocation_db) and is_revoked(connect(revocation_db), [serial])[serial]:
+           return
+       entry = {
+           "serial": serial,
+           "private_key_digest": private_key_digest,
+           "expires_at": min(cert.not_valid_after, now + VERIFIED_CACHE_TTL),
+           "result": dict(result)
+       }
+       with _verified_lock:
+           _forget(cache_key)
+           _verified[cache_key] = entry
+           _by_serial.setdefault(serial, set()).add(cache_key)
+           if len(_verified) > VERIFIED_CACHE_SIZE:
+               _forget(next(iter(_verified)))
+
+@operation("verify_device")
 def verify_certificate(cert_hex, private_key_hex, ca_cert_path):
+       try:
+           # Load CA certificate
+           with stage("ca_load"):
+               ca = load_ca_cert(ca_cert_path)
+           # Shard-issued certificates are verified against their intermediate and shard store
+           with stage("issuer"):
+               cert = x509.load_der_x509_certificate(bytes.fromhex(cert_hex))
+               shard = None
+               if cert.issuer != ca.subject:
+                   from issuing_shards import issuer_for
+                   shard, ca = issuer_for(cert, ca)
+       except Exception as e:
+           return {"status": "error", "message": str(e)}
+
+       if shard is None:
+           return verify_certificate_with_ca(cert_hex, private_key_hex, ca)
+       from issuing_shards import shard_set
+       result = verify_certificate_with_ca(cert_hex, private_key_hex, ca, shard_set().revocation_db(shard))
+       result["shard"] = shard
+       return result
+
+@operation("verify_device")
+def verify_certificate_with_ca(cert_hex, private_key_hex, ca, revocation_db=DEFAULT_DB_PATH):
+       # revocation_db: the issuing CA's revocation store, which evicts cached results
        try:
            # Convert hex to bytes
            cert_der = bytes.fromhex(cert_hex)
            private_key_der = bytes.fromhex(private_key_hex)
 
-           # Load certificate
-           cert = x509.load_der_x509_certificate(cert_der)
+           caching = VERIFIED_CACHE_TTL > timedelta(0)
+           if caching:
+               with stage("cache"):
+                   cache_key = (hashlib.sha256(cert_der).digest(), ca.fingerprint)
+                   private_key_digest = hashlib.sha256(private_key_der).digest()
+                   sync_revocations(revocation_db)
+                   result = _cached_result(cache_key, private_key_digest, datetime.utcnow())
+               if result is not None:
+                   return result
 
-           # Load private key
-           private_key = serialization.load_der_private_key(private_key_der, password=None)
+           with stage("parse"):
+               # Load certificate
+               cert = x509.load_der_x509_certificate(cert_der)
 
-           # Load CA certificate
-           with open(ca_cert_path, "rb") as f:
-               ca_cert = x509.load_pem_x509_certificate(f.read())
+               # Load private key
+               private_key = serialization.load_der_private_key(private_key_der, password=None)
 
            # Step 1: Check certificate validity period
            current_time = datetime.utcnow()
@@ -29,33 +154,40 @@ def verify_certificate(cert_hex, private_key_hex, ca_cert_path):
            if cert.not_valid_after < current_time:
                raise ValueError("Certificate has expired")
 
-           # Step 2: Verify private key matches certificate's public key
-           cert_public_key = cert.public_key()
-           private_key_public = private_key.public_key()
-           cert_pub_bytes = cert_public_key.public_bytes(
-               encoding=serialization.Encoding.DER,
-               format=serialization.PublicFormat.SubjectPublicKeyInfo
-           )
-           priv_pub_bytes = private_key_public.public_bytes(
-               encoding=serialization.Encoding.DER,
-               format=serialization.PublicFormat.SubjectPublicKeyInfo
-           )
-           if cert_pub_bytes != priv_pub_bytes:
-               raise ValueError("Private key does not match certificate's public key")
+           with stage("key_match"):
+               # Step 2: Verify private key matches certificate's public key
+               cert_public_key = cert.public_key()
+               private_key_public = private_key.public_key()
+               cert_pub_bytes = cert_public_key.public_bytes(
+                   encoding=serialization.Encoding.DER,
+                   format=serialization.PublicFormat.SubjectPublicKeyInfo
+               )
+               priv_pub_bytes = private_key_public.public_bytes(
+                   encoding=serialization.Encoding.DER,
+                   format=serialization.PublicFormat.SubjectPublicKeyInfo
+               )
+               if cert_pub_bytes != priv_pub_bytes:
+                   raise ValueError("Private key does not match certificate's public key")
 
            # Step 3: Verify CA signature
-           ca_public_key = ca_cert.public_key()
-           ca_public_key.verify(
-               cert.signature,
-               cert.tbs_certificate_bytes,
-               ec.ECDSA(hashes.SHA256()) if isinstance(ca_public_key, ec.EllipticCurvePublicKey) else None
-           )
+           ca_public_key = ca.public_key
+           with stage("signature"):
+               ca_public_key.verify(
+                   cert.signature,
+                   cert.tbs_certificate_bytes,
+                   ec.ECDSA(hashes.SHA256()) if isinstance(ca_public_key, ec.EllipticCurvePublicKey) else None
+               )
+
+           # Compact profile certificates carry only CN=<device_id> and the AKI
+           subject_dict = {attr.oid: attr.value for attr in cert.subject}
+           compact = list(subject_dict) == [x509.NameOID.COMMON_NAME]
 
            # Step 4: Check extensions
-           try:
-               cert.extensions.get_extension_for_oid(ExtensionOID.SUBJECT_KEY_IDENTIFIER)
-           except x509.ExtensionNotFound:
-               print("Warning: Subject Key Identifier extension not found", file=sys.stderr)
+           if not compact:
+               try:
+                   cert.extensions.get_extension_for_oid(ExtensionOID.SUBJECT_KEY_IDENTIFIER)
+               except x509.ExtensionNotFound:
+                   print("Warning: Subject Key Identifier extension not found", file=sys.stderr)
            
            try:
                cert.extensions.get_extension_for_oid(ExtensionOID.AUTHORITY_KEY_IDENTIFIER)
@@ -63,22 +195,28 @@ def verify_certificate(cert_hex, private_key_hex, ca_cert_path):
                print("Warning: Authority Key Identifier extension not found", file=sys.stderr)
 
            # Step 5: Verify certificate subject
-           expected_subject = {
-               "country_name": "VN",
-               "state_or_province_name": "Hanoi",
-               "locality_name": "Giangvo",
-               "organization_name": "MyIoT",
-               "organizational_unit_name": "IoT",
-               "common_name": "ESP32_Sensor"
-           }
-           subject = cert.subject
-           subject_dict = {attr.oid: attr.value for attr in subject}
-           for key, value in expected_subject.items():
-               oid = getattr(x509.NameOID, key.upper())
-               if subject_dict.get(oid) != value:
-                   raise ValueError(f"Unexpected subject attribute {key}: expected {value}, got {subject_dict.get(oid)}")
-
-           return {"status": "success", "message": "Certificate is valid and usable"}
+           if compact:
+               if not subject_dict[x509.NameOID.COMMON_NAME]:
+                   raise ValueError("Compact certificate has an empty common name")
+               result = {"status": "success", "message": "Certificate is valid and usable", "profile": "compact"}
+           else:
+               expected_subject = {
+                   "country_name": "VN",
+                   "state_or_province_name": "Hanoi",
+                   "locality_name": "Giangvo",
+                   "organization_name": "MyIoT",
+                   "organizational_unit_name": "IoT",
+                   "common_name": "ESP32_Sensor"
+               }
+               for key, value in expected_subject.items():
+                   oid = getattr(x509.NameOID, key.upper())
+                   if subject_dict.get(oid) != value:
+                       raise ValueError(f"Unexpected subject attribute {key}: expected {value}, got {subject_dict.get(oid)}")
+               result = {"status": "success", "message": "Certificate is valid and usable"}
+
+           if caching:
+               _remember(cache_key, private_key_digest, cert, result, current_time, revocation_db)
+           return result
 
        except Exception as e:
            return {"status": "error", "message": str(e)}
@@ -3,33 +3,88 @@ import json
 import sys
 import tempfile
 import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.exceptions import InvalidSignature
 
+from timing import operation, stage
+
+# Khóa công khai đã parse, theo dấu vân tay SHA-256 của chứng thư (LRU)
+PUBLIC_KEY_CACHE_SIZE = 4096
+_public_keys = OrderedDict()
+_public_keys_lock = threading.Lock()
+
+def get_public_key(cert_der):
+    fingerprint = hashlib.sha256(cert_der).digest()
+    with _public_keys_lock:
+        public_key = _public_keys.get(fingerprint)
+        if public_key is not None:
+            _public_keys.move_to_end(fingerprint)
+            return public_key
+
+    public_key = x509.load_der_x509_certificate(cert_der).public_key()
+    if not isinstance(public_key, ec.EllipticCurvePublicKey):
+        raise ValueError("Chỉ hỗ trợ khóa công khai EC")
+
+    with _public_keys_lock:
+        _public_keys[fingerprint] = public_key
+        if len(_public_keys) > PUBLIC_KEY_CACHE_SIZE:
+            _public_keys.popitem(last=False)
+    return public_key
+
+@operation("verify_signature")
 def verify_signature(data, signature_hex, cert_hex):
+           try:
+               with stage("parse"):
+                   public_key = get_public_key(bytes.fromhex(cert_hex))
+               with stage("signature"):
+                   public_key.verify(bytes.fromhex(signature_hex), data.encode("utf-8"), ec.ECDSA(hashes.SHA256()))
+               return {"status": "success", "message": "Chữ ký đã được xác minh"}
+
+           except InvalidSignature:
+               return {"status": "error", "message": "Xác minh chữ ký thất bại: chữ ký không hợp lệ"}
+           except Exception as e:
+               return {"status": "error", "message": str(e)}
+
+def verify_signatures(items):
+    # items: iterable of (data, signature_hex, cert_hex); kết quả theo đúng thứ tự đầu vào
+    return [verify_signature(data, signature_hex, cert_hex) for data, signature_hex, cert_hex in items]
+
+@operation("verify_signature_openssl")
+def verify_signature_openssl(data, signature_hex, cert_hex):
+           # Cách cũ: ghi ra tệp tạm và gọi openssl, giữ lại để so sánh hiệu năng
            try:
                with tempfile.TemporaryDirectory() as temp_dir:
                    cert_file = os.path.join(temp_dir, "device.crt")
                    data_file = os.path.join(temp_dir, "data.txt")
                    sig_file = os.path.join(temp_dir, "signature.bin")
 
-                   # Ghi chứng thư
-                   cert_der = bytes.fromhex(cert_hex)
-                   with open(cert_file, "wb") as f:
-                       f.write(cert_der)
+                   with stage("file_io"):
+                       # Ghi chứng thư
+                       cert_der = bytes.fromhex(cert_hex)
+                       with open(cert_file, "wb") as f:
+                           f.write(cert_der)
 
-                   # Ghi dữ liệu
-                   with open(data_file, "w") as f:
-                       f.write(data)
+                       # Ghi dữ liệu
+                       with open(data_file, "w") as f:
+                           f.write(data)
 
-                   # Ghi chữ ký
-                   signature = bytes.fromhex(signature_hex)
-                   with open(sig_file, "wb") as f:
-                       f.write(signature)
+                       # Ghi chữ ký
+                       signature = bytes.fromhex(signature_hex)
+                       with open(sig_file, "wb") as f:
+                           f.write(signature)
 
                    # Xác minh chữ ký
-                   result = subprocess.run([
-                       "openssl", "dgst", "-sha256", "-verify", cert_file,
-                       "-signature", sig_file, data_file
-                   ], capture_output=True, text=True, check=False)
+                   with stage("subprocess"):
+                       result = subprocess.run([
+                           "openssl", "dgst", "-sha256", "-verify", cert_file,
+                           "-signature", sig_file, data_file
+                       ], capture_output=True, text=True, check=False)
 
                    if result.returncode != 0:
                        raise ValueError(f"Xác minh chữ ký thất bại: {result.stderr}")
@@ -41,7 +96,67 @@ def verify_signature(data, signature_hex, cert_hex):
            except Exception as e:
                return {"status": "error", "message": str(e)}
 
+def benchmark(count=200, devices=20):
+    # So sánh thông lượng: openssl subprocess vs. xác minh trong tiến trình (đơn lẻ và theo lô)
+    from cryptography.hazmat.primitives import serialization
+    from generate_device_cert import load_ca, issue_device_cert
+
+    ca, ca_key = load_ca()
+    fleet = []
+    for i in range(devices):
+        issued = issue_device_cert(f"bench-{i}", ca, ca_key)
+        private_key = serialization.load_der_private_key(bytes.fromhex(issued["private_key"]), password=None)
+        fleet.append((issued["certificate"], private_key))
+
+    items = []
+    for i in range(count):
+        cert_hex, private_key = fleet[i % devices]
+        data = json.dumps({"temperature": 20 + i % 10, "seq": i})
+        signature = private_key.sign(data.encode("utf-8"), ec.ECDSA(hashes.SHA256()))
+        items.append((data, signature.hex(), cert_hex))
+
+    def measure(run):
+        start = time.perf_counter()
+        results = run()
+        elapsed = time.perf_counter() - start
+        return {
+            "ops_per_second": round(len(items) / elapsed, 1),
+            "failures": sum(1 for r in results if r["status"] != "success")
+        }
+
+    report = {"signatures": count, "devices": devices}
+    report["openssl_subprocess"] = measure(lambda: [verify_signature_openssl(*item) for item in items])
+    with _public_keys_lock:
+        _public_keys.clear()
+    report["in_process"] = measure(lambda: [verify_signature(*item) for item in items])
+    report["in_process_batch_warm_cache"] = measure(lambda: verify_signatures(items))
+    return report
+
 if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "--bench":
+        # python verify_signature.py --bench [count]
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+        print(json.dumps(benchmark(count)))
+        sys.exit(0)
+
+    if len(sys.argv) == 3 and sys.argv[1] == "--batch":
+        # python verify_signature.py --batch <items.jsonl|->
+        # Mỗi dòng: {"data", "signature", "certificate"}; mỗi dòng kết quả tương ứng một dòng đầu vào
+        source = sys.stdin if sys.argv[2] == "-" else open(sys.argv[2], "r")
+        failed = 0
+        for line in source:
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                result = verify_signature(item["data"], item["signature"], item["certificate"])
+            except Exception as e:
+                result = {"status": "error", "message": str(e)}
+            if result["status"] != "success":
+                failed += 1
+            print(json.dumps(result))
+        sys.exit(0 if failed == 0 else 1)
+
     if len(sys.argv) != 4:
         print(json.dumps({"error": "Yêu cầu dữ liệu, hex chữ ký và hex chứng thư"}))
         sys.exit(1)
@@ -52,4 +167,4 @@ if __name__ == "__main__":
 
     result = verify_signature(data, signature_hex, cert_hex)
     print(json.dumps(result))
-    sys.exit(0 if result["status"] == "success" else 1)
\ No newline at end of file
+    sys.exit(0 if result["status"] == "success" else 1)
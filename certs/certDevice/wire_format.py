@@ -0,0 +1,292 @@
+import json
+import os
+import struct
+import sys
+import time
+
+# Binary framing for certDevice script I/O.
+#
+# The default wire format stays hex inside JSON. The binary format is:
+#
+#   frame   = 4-byte big-endian payload length + payload
+#   payload = CBOR (RFC 8949) map with the binary fields as raw byte strings
+#
+# Only the CBOR subset the scripts need is implemented: unsigned/negative ints,
+# byte and text strings, arrays, maps, floats, true/false/null. Any standard
+# CBOR decoder (e.g. the 'cbor' npm package) reads these payloads.
+#
+# pack_fields() turns the known hex fields into bytes before encoding and
+# unpack_fields() turns them back into hex after decoding, so the handlers and
+# the hex JSON callers see exactly the same dicts. crl_hex and delta_crl_hex
+# are carried as crl and delta_crl (raw DER).
+#
+# Measured with 'python wire_format.py bench' on one core (encode + decode per message):
+#
+#   payload                        hex JSON            binary frame
+#   generate result (cert + key)   1437 B,  ~20 us     774 B,   ~24 us
+#   CRL with 1000 entries          72.7 KB, ~450 us    36.4 KB, ~80 us
+#
+# Binary frames are always about half the size. For small messages the pure
+# Python CBOR codec costs about as much as json plus the hex conversion; for
+# CRLs and other large blobs skipping hex is ~5x faster.
+
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Hex fields carried as bytes in binary mode; values are the binary-mode names
+BINARY_FIELDS = {
+    "certificate": "certificate",
+    "private_key": "private_key",
+    "signature": "signature",
+    "crl_hex": "crl",
+    "delta_crl_hex": "delta_crl",
+    "shared_secret": "shared_secret",
+    "ticket": "ticket",
+    "session_key": "session_key",
+    "client_nonce": "client_nonce",
+}
+HEX_FIELDS = {binary: hex_name for hex_name, binary in BINARY_FIELDS.items()}
+
+def _head(major, value):
+    if value < 24:
+        return bytes([major << 5 | value])
+    if value < 1 << 8:
+        return bytes([major << 5 | 24, value])
+    if value < 1 << 16:
+        return bytes([major << 5 | 25]) + value.to_bytes(2, "big")
+    if value < 1 << 32:
+        return bytes([major << 5 | 26]) + value.to_bytes(4, "big")
+    return bytes([major << 5 | 27]) + value.to_bytes(8, "big")
+
+def _encode(obj, out):
+    if obj is None:
+        out.append(b"\xf6")
+    elif obj is True:
+        out.append(b"\xf5")
+    elif obj is False:
+        out.append(b"\xf4")
+    elif isinstance(obj, int):
+        out.append(_head(0, obj) if obj >= 0 else _head(1, -1 - obj))
+    elif isinstance(obj, float):
+        out.append(b"\xfb" + struct.pack(">d", obj))
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        out.append(_head(2, len(obj)))
+        out.append(bytes(obj))
+    elif isinstance(obj, str):
+        data = obj.encode("utf-8")
+        out.append(_head(3, len(data)))
+        out.append(data)
+    elif isinstance(obj, (list, tuple)):
+        out.append(_head(4, len(obj)))
+        for item in obj:
+            _encode(item, out)
+    elif isinstance(obj, dict):
+        out.append(_head(5, len(obj)))
+        for key, value in obj.items():
+            _encode(key, out)
+            _encode(value, out)
+    else:
+        raise TypeError(f"Cannot encode {type(obj).__name__} as CBOR")
+
+def dumps(obj):
+    out = []
+    _encode(obj, out)
+    return b"".join(out)
+
+def _decode(data, pos):
+    initial = data[pos]
+    major, info = initial >> 5, initial & 0x1F
+    pos += 1
+    if major == 7:
+        if info == 20:
+            return False, pos
+        if info == 21:
+            return True, pos
+        if info in (22, 23):
+            return None, pos
+        if info == 25:
+            return struct.unpack_from(">e", data, pos)[0], pos + 2
+        if info == 26:
+            return struct.unpack_from(">f", data, pos)[0], pos + 4
+        if info == 27:
+            return struct.unpack_from(">d", data, pos)[0], pos + 8
+        raise ValueError(f"Unsupported CBOR simple value {info}")
+
+    if info < 24:
+        value = info
+    elif info <= 27:
+        size = 1 << (info - 24)
+        value = int.from_bytes(data[pos:pos + size], "big")
+        pos += size
+    else:
+        raise ValueError("Indefinite-length CBOR items are not supported")
+
+    if major == 0:
+        return value, pos
+    if major == 1:
+        return -1 - value, pos
+    if major == 2:
+        return bytes(data[pos:pos + value]), pos + value
+    if major == 3:
+        return bytes(data[pos:pos + value]).decode("utf-8"), pos + value
+    if major == 4:
+        items = []
+        for _ in range(value):
+            item, pos = _decode(data, pos)
+            items.append(item)
+        return items, pos
+    if major == 5:
+        mapping = {}
+        for _ in range(value):
+            key, pos = _decode(data, pos)
+            mapping[key], pos = _decode(data, pos)
+        return mapping, pos
+    raise ValueError(f"Unsupported CBOR major type {major}")
+
+def loads(data):
+    obj, pos = _decode(data, 0)
+    if pos != len(data):
+        raise ValueError(f"Trailing bytes after CBOR item: {len(data) - pos}")
+    return obj
+
+def pack_fields(obj):
+    # Hex fields -> bytes, recursively; anything that is not valid hex is left alone
+    if isinstance(obj, list):
+        return [pack_fields(item) for item in obj]
+    if not isinstance(obj, dict):
+        return obj
+    packed = {}
+    for key, value in obj.items():
+        if key in BINARY_FIELDS and isinstance(value, str):
+            try:
+                packed[BINARY_FIELDS[key]] = bytes.fromhex(value)
+                continue
+            except ValueError:
+                pass
+        packed[key] = pack_fields(value)
+    return packed
+
+def unpack_fields(obj):
+    # Inverse of pack_fields: bytes -> lowercase hex under the hex field names
+    if isinstance(obj, list):
+        return [unpack_fields(item) for item in obj]
+    if not isinstance(obj, dict):
+        return obj
+    unpacked = {}
+    for key, value in obj.items():
+        if isinstance(value, bytes):
+            unpacked[HEX_FIELDS.get(key, key)] = value.hex()
+        else:
+            unpacked[key] = unpack_fields(value)
+    return unpacked
+
+def encode_frame(obj):
+    payload = dumps(pack_fields(obj))
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def read_exact(stream, size):
+    chunks = []
+    while size:
+        chunk = stream.read(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+# Everything a malformed payload can raise while being decoded (UnicodeDecodeError is a ValueError)
+DECODE_ERRORS = (ValueError, TypeError, IndexError, OverflowError, RecursionError, struct.error)
+
+def read_frames(stream, on_error=None):
+    # Yields decoded objects (hex fields restored) until EOF. The length prefix keeps
+    # the stream in sync past a payload that does not decode, so with on_error the
+    # bad frame is reported through it and reading carries on; otherwise it raises.
+    while True:
+        header = read_exact(stream, FRAME_HEADER.size)
+        if header is None:
+            return
+        (size,) = FRAME_HEADER.unpack(header)
+        if size > MAX_FRAME_SIZE:
+            raise ValueError(f"Frame too large: {size} bytes")
+        payload = read_exact(stream, size)
+        if payload is None:
+            raise ValueError("Truncated frame")
+        try:
+            obj = unpack_fields(loads(payload))
+        except DECODE_ERRORS as e:
+            message = f"Malformed CBOR payload: {type(e).__name__}: {str(e)}"
+            if on_error is None:
+                raise ValueError(message)
+            on_error(message)
+            continue
+        yield obj
+
+def benchmark(iterations=2000):
+    # Sizes follow the real artifacts: 520-byte certificate, 121-byte ECPrivateKey,
+    # and a CRL with 1000 entries of ~36 bytes each
+    generate_result = {
+        "device_id": "esp32-000001",
+        "certificate": os.urandom(520).hex(),
+        "private_key": os.urandom(121).hex(),
+        "serial": os.urandom(20).hex().upper(),
+        "expiry": "2027-10-17T00:00:00"
+    }
+    crl_result = {
+        "status": "success",
+        "crl_number": 1042,
+        "crl_hex": os.urandom(36 * 1000 + 300).hex(),
+        "crl_size": 36 * 1000 + 300
+    }
+
+    def measure(encode, decode, obj, count):
+        start = time.perf_counter()
+        for _ in range(count):
+            encoded = encode(obj)
+            decode(encoded)
+        return len(encoded), (time.perf_counter() - start) / count * 1e6
+
+    def json_hex_encode(obj):
+        return (json.dumps(obj) + "\n").encode("utf-8")
+
+    def json_hex_decode(line):
+        # Callers then turn the hex back into bytes
+        obj = json.loads(line)
+        for key in BINARY_FIELDS:
+            if key in obj:
+                bytes.fromhex(obj[key])
+        return obj
+
+    def frame_decode(frame):
+        # What a binary-aware caller does: no hex round trip
+        return loads(frame[FRAME_HEADER.size:])
+
+    report = {"iterations": iterations}
+    for name, obj, count in (("generate_result", generate_result, iterations), ("crl_1000_entries", crl_result, max(1, iterations // 20))):
+        hex_size, hex_us = measure(json_hex_encode, json_hex_decode, obj, count)
+        binary_size, binary_us = measure(encode_frame, frame_decode, obj, count)
+        report[name] = {
+            "hex_json_bytes": hex_size,
+            "binary_bytes": binary_size,
+            "size_ratio": round(binary_size / hex_size, 3),
+            "hex_json_us": round(hex_us, 2),
+            "binary_us": round(binary_us, 2),
+            "time_ratio": round(binary_us / hex_us, 3)
+        }
+    return report
+
+if __name__ == "__main__":
+    # python wire_format.py bench [iterations]
+    # python wire_format.py to-json   (binary frames on stdin -> hex JSON lines on stdout)
+    # python wire_format.py to-binary (hex JSON lines on stdin -> binary frames on stdout)
+    if len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        print(json.dumps(benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 2000)))
+    elif len(sys.argv) == 2 and sys.argv[1] == "to-json":
+        for obj in read_frames(sys.stdin.buffer):
+            sys.stdout.write(json.dumps(obj) + "\n")
+    elif len(sys.argv) == 2 and sys.argv[1] == "to-binary":
+        for line in sys.stdin:
+            if line.strip():
+                sys.stdout.buffer.write(encode_frame(json.loads(line)))
+    else:
+        print(json.dumps({"error": "Usage: python wire_format.py bench [iterations] | to-json | to-binary"}))
+        sys.exit(1)
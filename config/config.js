@@ -2,7 +2,7 @@ require('dotenv').config();
 const fs = require('fs');
 const path = require('path');
 const crypto = require('crypto');
-const { spawnSync } = require('child_process');
+const net = require('net');
 
 const mqttConfig = {
   host: process.env.MQTT_HOST,
@@ -41,30 +41,88 @@ try {
   throw new Error(`Unable to load CA private key: ${err.message}`);
 }
 
-function getDecryptedPrivateKey() {
-  const encryptedKeyPath = path.resolve(process.env.ENCRYPTED_KEY_PATH);
-  const passphrase = process.env.CA_KEY_PASSPHRASE;
-  const decryptScriptPath = path.resolve(process.env.DECRYPT_SCRIPT_PATH);
-
-  if (!passphrase) {
-    throw new Error('CA_KEY_PASSPHRASE is missing in .env');
+// DER sizes (bytes) accepted for device certificates, e.g. "520,395-405".
+// Standard profile certificates are 520 bytes; compact ones depend on the device ID length.
+function parseCertLengths(spec) {
+  const lengths = new Set();
+  for (const part of spec.split(',').map(p => p.trim()).filter(Boolean)) {
+    const [low, high] = part.split('-').map(Number);
+    for (let n = low; n <= (high || low); n++) lengths.add(n);
   }
+  return lengths;
+}
+
+const acceptedCertLengths = parseCertLengths(process.env.CERT_ACCEPTED_LENGTHS || '520');
 
-  try {
-    const result = spawnSync('python', [
-      decryptScriptPath,
-      encryptedKeyPath,
-      passphrase
-    ]);
+// CA key agent (certs/certDevice/ca_key_agent.py): the agent decrypts the CA key once and
+// signs certificates and CRLs over a Unix socket, so the server never runs the PBKDF2 unlock
+// itself. Without CA_KEY_AGENT_SOCKET the services keep spawning the scripts with CA_KEY_PATH.
+const caKeyAgentSocket = process.env.CA_KEY_AGENT_SOCKET ? path.resolve(process.env.CA_KEY_AGENT_SOCKET) : null;
+let caKeyAgentConnection = null;
+let caKeyAgentRequestId = 0;
 
-    if (result.error) throw result.error;
-    if (result.status !== 0) throw new Error(result.stderr.toString());
+function connectCaKeyAgent() {
+  if (caKeyAgentConnection) return caKeyAgentConnection;
 
-    return result.stdout.toString('utf8').trim();
-  } catch (err) {
-    console.error('Failed to decrypt CA private key:', err.message);
-    throw new Error(`Unable to decrypt CA private key: ${err.message}`);
+  // One persistent connection; responses are matched to requests by id
+  const socket = net.createConnection(caKeyAgentSocket);
+  const connection = { socket, requests: new Map() };
+  socket.setEncoding('utf8');
+  let buffered = '';
+  socket.on('data', (chunk) => {
+    buffered += chunk;
+    let newline;
+    while ((newline = buffered.indexOf('\n')) >= 0) {
+      const line = buffered.slice(0, newline);
+      buffered = buffered.slice(newline + 1);
+      if (!line.trim()) continue;
+      let response;
+      try {
+        response = JSON.parse(line);
+      } catch (err) {
+        console.error('Invalid response from CA key agent:', err.message);
+        continue;
+      }
+      const request = connection.requests.get(response.id);
+      if (!request) continue;
+      connection.requests.delete(response.id);
+      if (response.error) request.reject(new Error(response.error));
+      else request.resolve(response.result);
+    }
+  });
+
+  const fail = (err) => {
+    if (caKeyAgentConnection === connection) caKeyAgentConnection = null;
+    for (const request of connection.requests.values()) request.reject(err);
+    connection.requests.clear();
+  };
+  socket.on('error', (err) => fail(new Error(`CA key agent unavailable: ${err.message}`)));
+  socket.on('close', () => fail(new Error('CA key agent closed the connection')));
+
+  caKeyAgentConnection = connection;
+  return connection;
+}
+
+function caKeyAgentRequest(type, params = {}) {
+  if (!caKeyAgentSocket) {
+    return Promise.reject(new Error('CA_KEY_AGENT_SOCKET is missing in .env'));
   }
+  const id = String(++caKeyAgentRequestId);
+  return new Promise((resolve, reject) => {
+    const connection = connectCaKeyAgent();
+    connection.requests.set(id, { resolve, reject });
+    connection.socket.write(JSON.stringify({ id, type, params }) + '\n');
+  });
+}
+
+// Same result shape as generate_device_cert.py
+function signDeviceCertificate(deviceId) {
+  return caKeyAgentRequest('sign_certificate', { device_id: deviceId });
+}
+
+// Same result shape as revoke_device_cert.py --batch; options: ca_data_dir, crl_path, delta, ...
+function signCrl(entries, options = {}) {
+  return caKeyAgentRequest('sign_crl', { entries, ...options });
 }
 
 module.exports = {
@@ -74,5 +132,9 @@ module.exports = {
   caPrivateKeyPem,
   caPrivateKeyPemPath: caPrivateKeyPath,
   caCertPemPath: caCertPath,
-  getDecryptedPrivateKey,
+  caKeyAgentSocket,
+  caKeyAgentRequest,
+  signDeviceCertificate,
+  signCrl,
+  acceptedCertLengths,
 };
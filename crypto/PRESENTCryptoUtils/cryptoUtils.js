@@ -1,4 +1,4 @@
-const { caCertPem } = require('../../config/config');
+const { caCertPem, acceptedCertLengths } = require('../../config/config');
 const crypto = require('crypto');
 const { performance } = require('perf_hooks');
 
@@ -70,13 +70,9 @@ async function verifyCertificate(certificate) {
       return null;
     }
     const cleanCert = certificate.replace(/[^0-9a-fA-F]/g, '');
-    if (cleanCert.length !== 1040) {
-      console.error(`Certificate length incorrect: expected 1040, got ${cleanCert.length}`);
-      return null;
-    }
     const certBytes = Buffer.from(cleanCert, 'hex');
-    if (certBytes.length !== 520) {
-      console.error(`Certificate bytes length incorrect: expected 520, got ${certBytes.length}`);
+    if (cleanCert.length % 2 !== 0 || !acceptedCertLengths.has(certBytes.length)) {
+      console.error(`Certificate length incorrect: expected one of ${[...acceptedCertLengths].join(', ')} bytes, got ${cleanCert.length / 2}`);
       return null;
     }
     const certPem = `-----BEGIN CERTIFICATE-----\n${certBytes.toString('base64')}\n-----END CERTIFICATE-----`;
@@ -1,10 +1,104 @@
 const { spawn } = require('child_process');
 const path = require('path');
-const { caCertPem } = require('../../config/config');
+const { caCertPem, acceptedCertLengths } = require('../../config/config');
 const crypto = require('crypto');
+const fs = require('fs');
 const { createDecipheriv } = require('crypto');
 const { performance } = require('perf_hooks');
 
+// Issuing shard CAs (certs/certDevice/issuing_shards.py): a device certificate may be signed by
+// an intermediate rather than the root. The intermediate is looked up by the certificate's
+// authority key identifier in the shard manifest and checked against the root once.
+const shardsDir = path.resolve(process.env.CERT_SHARDS_DIR || path.join(__dirname, '../../certs/certDevice/shards'));
+let shardManifest;
+const chainedIssuers = new Map();
+
+function loadShardManifest() {
+  if (shardManifest === undefined) {
+    const manifestPath = path.join(shardsDir, 'manifest.json');
+    shardManifest = fs.existsSync(manifestPath) ? JSON.parse(fs.readFileSync(manifestPath, 'utf8')) : null;
+  }
+  return shardManifest;
+}
+
+function readTlv(der, pos, end) {
+  // One DER element at pos: tag, content bounds and the offset after it (short and long form lengths)
+  if (pos + 2 > end) throw new Error('Truncated DER element');
+  const tag = der[pos];
+  let length = der[pos + 1];
+  let start = pos + 2;
+  if (length & 0x80) {
+    const octets = length & 0x7f;
+    if (octets === 0 || octets > 4 || start + octets > end) throw new Error('Unsupported DER length');
+    length = der.readUIntBE(start, octets);
+    start += octets;
+  }
+  if (start + length > end) throw new Error('Truncated DER element');
+  return { tag, start, end: start + length };
+}
+
+function children(der, parent) {
+  const elements = [];
+  for (let pos = parent.start; pos < parent.end;) {
+    const element = readTlv(der, pos, parent.end);
+    elements.push(element);
+    pos = element.end;
+  }
+  return elements;
+}
+
+const AKI_OID = Buffer.from([0x55, 0x1d, 0x23]); // 2.5.29.35
+
+function authorityKeyIdentifier(cert) {
+  // keyIdentifier [0] of the AuthorityKeyIdentifier extension, as hex. Walks
+  // Certificate -> tbsCertificate -> extensions [3] -> Extension {extnID, critical?, extnValue}
+  const der = cert.raw;
+  const certificate = readTlv(der, 0, der.length);
+  const tbsCertificate = children(der, certificate)[0];
+  const extensions = children(der, tbsCertificate).find(element => element.tag === 0xa3);
+  if (!extensions) return null;
+  for (const extension of children(der, children(der, extensions)[0])) {
+    const [extnId, ...rest] = children(der, extension);
+    if (extnId.tag !== 0x06 || !der.subarray(extnId.start, extnId.end).equals(AKI_OID)) continue;
+    const extnValue = rest[rest.length - 1];
+    if (!extnValue || extnValue.tag !== 0x04) return null;
+    const keyIdentifier = children(der, readTlv(der, extnValue.start, extnValue.end)).find(element => element.tag === 0x80);
+    return keyIdentifier ? der.subarray(keyIdentifier.start, keyIdentifier.end).toString('hex') : null;
+  }
+  return null;
+}
+
+function resolveIssuer(cert, root) {
+  // The root for certificates it signed directly, otherwise the chained shard intermediate
+  if (cert.issuer === root.subject) return root;
+  const manifest = loadShardManifest();
+  if (!manifest) throw new Error('Certificate issuer does not match CA subject');
+  if (manifest.root_fingerprint !== root.fingerprint256.replace(/:/g, '').toLowerCase()) {
+    throw new Error('Root certificate does not match the shard manifest');
+  }
+  const keyIdentifier = authorityKeyIdentifier(cert);
+  const shard = manifest.shards.find(entry => entry.key_identifier === keyIdentifier);
+  if (!shard) throw new Error('Certificate was not issued by a known issuing CA');
+
+  let intermediate = chainedIssuers.get(shard.index);
+  if (!intermediate) {
+    const certPath = path.join(shardsDir, `shard-${String(shard.index).padStart(2, '0')}`, 'ca-cert.pem');
+    intermediate = new crypto.X509Certificate(fs.readFileSync(certPath, 'utf8'));
+    if (!intermediate.ca || !intermediate.checkIssued(root) || !intermediate.verify(root.publicKey)) {
+      throw new Error(`Issuing CA ${shard.index} is not a CA signed by the root`);
+    }
+    chainedIssuers.set(shard.index, intermediate);
+  }
+  const now = new Date();
+  if (now < new Date(intermediate.validFrom) || now > new Date(intermediate.validTo)) {
+    throw new Error(`Issuing CA ${shard.index} is not valid at current time`);
+  }
+  if (cert.issuer !== intermediate.subject) {
+    throw new Error('Certificate issuer does not match its issuing CA subject');
+  }
+  return intermediate;
+}
+
 // Bỏ pythonScriptPath vì không còn gọi Python nữa
 // const pythonScriptPath = path.join(__dirname, '../certs/certDevice/crypto_utils.py');
 
@@ -50,20 +144,15 @@ async function runPythonScript(args) {
 
 async function verifyCertificate(certificate) {
   try {
-    // Validate input: certificate phải là hex string, độ dài 1040 như trong Python
+    // Validate input: certificate phải là hex string, độ dài thuộc acceptedCertLengths như trong Python
     if (typeof certificate !== 'string' || !/^[0-9a-fA-F]+$/.test(certificate)) {
       console.error('Invalid certificate: must be a hexadecimal string');
       return null;
     }
     const cleanCert = certificate.replace(/[^0-9a-fA-F]/g, ''); // Làm sạch giống Python
-    if (cleanCert.length !== 1040) {
-      console.error(`Certificate length incorrect: expected 1040, got ${cleanCert.length}`);
-      return null;
-    }
-
     const certBytes = Buffer.from(cleanCert, 'hex');
-    if (certBytes.length !== 520) {
-      console.error(`Certificate bytes length incorrect: expected 520, got ${certBytes.length}`);
+    if (cleanCert.length % 2 !== 0 || !acceptedCertLengths.has(certBytes.length)) {
+      console.error(`Certificate length incorrect: expected one of ${[...acceptedCertLengths].join(', ')} bytes, got ${cleanCert.length / 2}`);
       return null;
     }
     const certPem = `-----BEGIN CERTIFICATE-----\n${certBytes.toString('base64')}\n-----END CERTIFICATE-----`;
@@ -71,8 +160,11 @@ async function verifyCertificate(certificate) {
     const cert = new crypto.X509Certificate(certPem);
     const ca = new crypto.X509Certificate(caCertPem);
 
-    if (cert.issuer !== ca.subject) {
-      console.error('Certificate issuer does not match CA subject');
+    let issuer;
+    try {
+      issuer = resolveIssuer(cert, ca);
+    } catch (err) {
+      console.error(err.message);
       return null;
     }
 
@@ -84,8 +176,7 @@ async function verifyCertificate(certificate) {
       return null;
     }
 
-    const caPublicKey = ca.publicKey;
-    const isValid = cert.verify(caPublicKey);
+    const isValid = cert.verify(issuer.publicKey);
     if (!isValid) {
       console.error('Certificate verification failed: invalid signature');
       return null;
@@ -5,6 +5,7 @@ const os = require('os');
 const path = require('path');
 const { spawn } = require('child_process');
 const fs = require('fs');
+const { caKeyAgentSocket, signCrl } = require('../config/config');
 
 const RevokedCertificateSchema = new Schema({
   deviceId: {
@@ -68,14 +69,23 @@ const CRLSchema = new Schema({
   crlPem: {
     type: String,
     required: true
+  },
+  // CA phát hành (shard) của CRL này; null = CA gốc ký trực tiếp (certs/certDevice/issuing_shards.py)
+  shard: {
+    type: Number,
+    default: null
   }
 });
 
 CRLSchema.methods.updateCRL = async function(newRevokedCerts, caPrivateKeyPem) {
   const scriptPath = path.join(__dirname, '../certs/certDevice/revoke_device_cert.py');
-  const caCertPath = path.join(__dirname, '../certs/certDevice/ca-cert.pem');
-  const caKeyPath = path.join(__dirname, '../certs/certDevice/ca-key.pem');
-  const crlPath = path.join(__dirname, '../certs/certDevice/ca_data/crl.pem');
+  // Mỗi shard có chứng thư, khóa và thư mục ca_data riêng
+  const caDir = this.shard === null || this.shard === undefined
+    ? path.join(__dirname, '../certs/certDevice')
+    : path.join(__dirname, '../certs/certDevice/shards', `shard-${String(this.shard).padStart(2, '0')}`);
+  const caCertPath = path.join(caDir, 'ca-cert.pem');
+  const caKeyPath = path.join(caDir, 'ca-key.pem');
+  const crlPath = path.join(caDir, 'ca_data/crl.pem');
 
   // Tạo thư mục nếu chưa tồn tại
   const caDataDir = path.dirname(crlPath);
@@ -84,18 +94,27 @@ CRLSchema.methods.updateCRL = async function(newRevokedCerts, caPrivateKeyPem) {
   }
 
   try {
-    // Thực thi Python script bằng spawn
-    for (const cert of newRevokedCerts) {
+    // Thu hồi cả lô trong một lần gọi: một lần ghi index.txt và một lần ký CRL
+    const entries = newRevokedCerts.map(cert => ({
+      device_id: cert.deviceId,
+      serial: cert.serialNumber,
+      reason: cert.reason || 'unspecified',
+      revocation_date: new Date(cert.revocationDate || Date.now()).toISOString()
+    }));
+
+    const signWithScript = () => {
       const pythonProcess = spawn('python', [
         scriptPath,
-        cert.deviceId,
+        '--batch',
+        '-',
         caCertPath,
         caKeyPath,
-        cert.serialNumber
-      ]);
+        '--ca-data',
+        path.dirname(crlPath)
+      ], { cwd: path.dirname(scriptPath) });
 
       // Xử lý kết quả trả về từ Python script
-      const result = await new Promise((resolve, reject) => {
+      return new Promise((resolve, reject) => {
         let stdout = '';
         let stderr = '';
 
@@ -109,7 +128,7 @@ CRLSchema.methods.updateCRL = async function(newRevokedCerts, caPrivateKeyPem) {
 
         pythonProcess.on('close', (code) => {
           if (code !== 0) {
-            reject(new Error(`Python script exited with code ${code}: ${stderr}`));
+            reject(new Error(`Python script exited with code ${code}: ${stderr || stdout}`));
           } else {
             try {
               resolve(JSON.parse(stdout));
@@ -122,12 +141,25 @@ CRLSchema.methods.updateCRL = async function(newRevokedCerts, caPrivateKeyPem) {
         pythonProcess.on('error', (err) => {
           reject(new Error(`Failed to start Python process: ${err.message}`));
         });
-      });
 
-      if (result.status !== 'success') {
-        throw new Error(result.message || 'Failed to revoke certificate');
-      }
+        pythonProcess.stdin.end(JSON.stringify(entries));
+      });
+    };
+
+    // CRL của CA gốc được ký qua CA key agent khi có cấu hình; shard vẫn dùng khóa riêng của nó
+    const result = caKeyAgentSocket && (this.shard === null || this.shard === undefined)
+      ? await signCrl(entries, {
+          ca_data_dir: caDataDir,
+          crl_path: crlPath,
+          delta_crl_path: path.join(caDataDir, 'delta-crl.pem')
+        })
+      : await signWithScript();
+
+    if (result.status !== 'success') {
+      throw new Error(result.message || 'Failed to revoke certificates');
+    }
 
+    for (const cert of newRevokedCerts) {
       this.revokedCertificates.push({
         deviceId: cert.deviceId,
         serialNumber: cert.serialNumber,
@@ -135,12 +167,11 @@ CRLSchema.methods.updateCRL = async function(newRevokedCerts, caPrivateKeyPem) {
         reason: cert.reason || 'unspecified',
         issuer: this.issuer,
       })
-
     }
 
     // Đọc và cập nhật CRL
     this.crlPem = fs.readFileSync(crlPath, 'utf8');
-    this.crlNumber += 1;
+    this.crlNumber = result.crl_number;
     this.thisUpdate = new Date();
     this.nextUpdate = new Date(Date.now() + 30 * 24 * 60 * 60 * 1000);
 
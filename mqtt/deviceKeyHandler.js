@@ -3,6 +3,7 @@ const util = require('util');
 const crypto = require('crypto');
 const { publish, subscribeToDeviceTopics } = require('./mqttClient');
 const { createSpkiPublicKey, verifyCertificate } = require('./utils/certUtils');
+const { acceptedCertLengths } = require('../config/config');
 const { storeDevice } = require('./utils/dbUtils');
 const cryptoUtils = require('../crypto/chachapolyCryptoUtils/cryptoUtils');
 const socketHandler = require('../websocket/socketHandler.js');
@@ -45,8 +46,8 @@ async function handleDeviceKey(deviceId, data) {
   }
 
   const cleanCert = certificate.replace(/[^0-9a-fA-F]/g, '');
-  if (cleanCert.length !== 1040) {
-    console.error(`Certificate length incorrect for device ${deviceId}: expected 1040, got ${cleanCert.length}`);
+  if (cleanCert.length % 2 !== 0 || !acceptedCertLengths.has(cleanCert.length / 2)) {
+    console.error(`Certificate length incorrect for device ${deviceId}: expected one of ${[...acceptedCertLengths].join(', ')} bytes, got ${cleanCert.length / 2}`);
     return;
   }
 
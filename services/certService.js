@@ -5,6 +5,7 @@ const CRL = require('../models/CRL');
 const CertConfirmation = require('../models/CertConfirmation');
 const path = require('path');
 const fs = require('fs');
+const { caKeyAgentSocket, signDeviceCertificate } = require('../config/config');
 
 const MAX_RETRIES = 3;
 const RETRY_DELAY = 5000; // 5 seconds
@@ -25,36 +26,44 @@ const renewCertificate = async (deviceId, retryCount = 0) => {
         const caCertPath = path.join(__dirname, '../certs/certDevice/ca-cert.pem');
         const caKeyPath = path.join(__dirname, '../certs/certDevice/ca-key.pem');
 
-        // Execute certificate generation script
         const certDir = path.join(__dirname, '../certs/certDevice');
-        const certProcess = spawn('python', [
-            certScriptPath,
-            deviceId,
-            caCertPath,
-            caKeyPath
-        ], { cwd: certDir });
+        const generateWithScript = async () => {
+            // Execute certificate generation script
+            const certProcess = spawn('python', [
+                certScriptPath,
+                deviceId,
+                caCertPath,
+                caKeyPath
+            ], { cwd: certDir });
+
+            let certStdout = '';
+            let certStderr = '';
+
+            certProcess.stdout.on('data', (data) => {
+                certStdout += data.toString();
+            });
 
-        let certStdout = '';
-        let certStderr = '';
+            certProcess.stderr.on('data', (data) => {
+                certStderr += data.toString();
+            });
 
-        certProcess.stdout.on('data', (data) => {
-            certStdout += data.toString();
-        });
+            const certExitCode = await new Promise((resolve) => {
+                certProcess.on('close', (code) => resolve(code));
+            });
 
-        certProcess.stderr.on('data', (data) => {
-            certStderr += data.toString();
-        });
+            if (certExitCode !== 0) {
+                console.error(`Certificate generation error for device ${deviceId}:`, certStderr);
+                throw new Error('Failed to generate certificate');
+            }
 
-        const certExitCode = await new Promise((resolve) => {
-            certProcess.on('close', (code) => resolve(code));
-        });
+            return JSON.parse(certStdout);
+        };
 
-        if (certExitCode !== 0) {
-            console.error(`Certificate generation error for device ${deviceId}:`, certStderr);
-            throw new Error('Failed to generate certificate');
-        }
+        // Sign through the CA key agent when it is configured, otherwise run the script
+        const certResult = caKeyAgentSocket
+            ? await signDeviceCertificate(deviceId)
+            : await generateWithScript();
 
-        const certResult = JSON.parse(certStdout);
         if (certResult.error) {
             console.error(`Certificate generation error for device ${deviceId}:`, certResult.error);
             throw new Error(`Failed to generate certificate: ${certResult.error}`);
@@ -262,19 +271,14 @@ const revokeCertificate = async (deviceId, serial) => {
         const revokeScriptPath = path.join(__dirname, '../certs/certDevice/revoke_device_cert.py');
         const caCertPath = path.join(__dirname, '../certs/certDevice/ca-cert.pem');
         const caKeyPath = path.join(__dirname, '../certs/certDevice/ca-key.pem');
-        const crlPath = path.join(__dirname, '../certs/certDevice/ca_data/crl.pem');
-
-        // Đọc CA certificate để lấy issuer
-        const caCertPem = fs.readFileSync(caCertPath, 'utf8');
 
+        // Gửi kèm chứng thư để script thu hồi bằng CA đã ký nó (CA gốc hoặc shard, theo AKI)
         const certDir = path.join(__dirname, '../certs/certDevice');
-        const revokeProcess = spawn('python', [
-            revokeScriptPath,
-            deviceId,
-            caCertPath,
-            caKeyPath,
-            serial
-        ], { cwd: certDir });
+        const revokeArgs = [revokeScriptPath, deviceId, caCertPath, caKeyPath, serial];
+        if (device.certificate) {
+            revokeArgs.push(device.certificate);
+        }
+        const revokeProcess = spawn('python', revokeArgs, { cwd: certDir });
 
         let revokeStdout = '';
         let revokeStderr = '';
@@ -302,8 +306,13 @@ const revokeCertificate = async (deviceId, serial) => {
             throw new Error(`Failed to revoke certificate: ${revokeResult.message}`);
         }
 
-        // Đọc CRL từ file
-        const crlPem = fs.readFileSync(crlPath, 'utf8');
+        // CRL và chứng thư của CA phát hành: shard có thư mục riêng trong certs/certDevice/shards
+        const shard = revokeResult.shard === undefined ? null : revokeResult.shard;
+        const issuerDir = shard === null
+            ? certDir
+            : path.join(certDir, 'shards', `shard-${String(shard).padStart(2, '0')}`);
+        const caCertPem = fs.readFileSync(path.join(issuerDir, 'ca-cert.pem'), 'utf8');
+        const crlPem = fs.readFileSync(path.join(issuerDir, 'ca_data/crl.pem'), 'utf8');
 
         // Tìm hoặc tạo CRL trong database
         let crl = await CRL.findOne({ issuer: caCertPem });
@@ -311,6 +320,7 @@ const revokeCertificate = async (deviceId, serial) => {
         if (!crl) {
             crl = new CRL({
                 issuer: caCertPem,
+                shard,
                 thisUpdate: new Date(),
                 nextUpdate: new Date(Date.now() + 30 * 24 * 60 * 60 * 1000), // 30 ngày sau
                 revokedCertificates: [],
@@ -331,7 +341,7 @@ const revokeCertificate = async (deviceId, serial) => {
         
 
         // Cập nhật CRL trong database
-        await crl.updateCRL([newRevokedCert], fs.readFileSync(caKeyPath, 'utf8'));
+        await crl.updateCRL([newRevokedCert], fs.readFileSync(path.join(issuerDir, 'ca-key.pem'), 'utf8'));
 
         // Publish revoke request
         const revokeTopic = `iot/${deviceId}/revoke_cert`;